@@ -0,0 +1,239 @@
+#! coding=utf-8
+"""离线benchmark：用本地模拟的llm和embedding(common/fake.py)构建合成的城市文档并查询，结果输出为json
+
+模拟耗时通过环境变量 FAKE_LLM_LATENCY / FAKE_EMBED_LATENCY 设置，例如
+    FAKE_LLM_LATENCY=0.1 python benchmark.py --output bench.json --baseline bench_old.json
+"""
+import argparse
+import atexit
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List
+
+# 必须在导入项目模块之前设置：切换到模拟后端，缓存写到临时目录，每次运行都从空缓存开始
+_BENCH_CACHE_DIR = tempfile.mkdtemp(prefix="bench_cache_")
+# 运行失败或者参数错误退出时也要删除临时缓存
+atexit.register(shutil.rmtree, _BENCH_CACHE_DIR, ignore_errors=True)
+os.environ.setdefault("LLM_BACKEND", "fake")
+os.environ.setdefault("LLM_CACHE_DIR", _BENCH_CACHE_DIR)
+
+import numpy as np
+from llama_index import QueryBundle
+from llama_index.tools.types import ToolMetadata
+
+import build.index
+from build.index import build_index_from_nodes, build_nodes
+from common.config import FAKE_EMBED_LATENCY, FAKE_LLM_LATENCY, LLM_BACKEND
+from query.compose import _index_node, city_summary, index_embed_text
+from query.retrievers import SelectorRetriever
+from query.route import Chatter
+from query.selectors import create_selector
+
+TOPICS = ["历史", "地理", "经济", "交通", "文化", "教育", "旅游", "气候"]
+
+
+def generate_city_text(city: str, paragraphs: int, rng: random.Random) -> str:
+    lines = []
+    for i in range(paragraphs):
+        topic = TOPICS[i % len(TOPICS)]
+        sentences = [f"{city}第{j}区的{topic}指标为{rng.randint(1, 1000)}。" for j in range(1, 9)]
+        lines.append(f"{city}的{topic}（第{i + 1}段）：{''.join(sentences)}\n\n")
+    return "".join(lines)
+
+
+def generate_queries(cities: List[str], num_queries: int, rng: random.Random) -> List[str]:
+    return [f"{rng.choice(cities)}第{rng.randint(1, 8)}区的{rng.choice(TOPICS)}指标是多少？" for _ in range(num_queries)]
+
+
+class StageTimer:
+    """记录每个阶段每次调用的耗时和期间发生的模拟llm调用次数"""
+
+    def __init__(self, llm_calls: Callable[[], int]):
+        self.llm_calls = llm_calls
+        self.seconds: Dict[str, List[float]] = defaultdict(list)
+        self.calls: Dict[str, int] = defaultdict(int)
+
+    def run(self, stage: str, fn: Callable, *args, **kwargs):
+        calls = self.llm_calls()
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.seconds[stage].append(time.perf_counter() - start)
+        self.calls[stage] += self.llm_calls() - calls
+        return result
+
+    def summary(self) -> Dict[str, Dict]:
+        ret = {}
+        for stage, seconds in self.seconds.items():
+            ms = np.asarray(seconds) * 1000
+            ret[stage] = {
+                "count": len(seconds),
+                "mean_ms": round(float(ms.mean()), 3),
+                "p50_ms": round(float(np.percentile(ms, 50)), 3),
+                "p95_ms": round(float(np.percentile(ms, 95)), 3),
+                "max_ms": round(float(ms.max()), 3),
+                "llm_calls": self.calls[stage],
+            }
+        return ret
+
+
+def max_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux 上单位是KB，macOS 上是字节
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def dir_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def bench_build(cities: List[str], paragraphs: int, work_dir: str, rng: random.Random) -> Dict:
+    data_root = os.path.join(work_dir, "data")
+    index_root = os.path.join(work_dir, "index")
+    os.makedirs(data_root)
+    os.makedirs(index_root)
+    llm, embed_model = build.index.llm.llm, build.index.service_context.embed_model.embed_model
+    timer = StageTimer(lambda: llm.calls)
+    embed_calls = embed_model.calls
+    num_nodes = 0
+    for city in cities:
+        data_file = os.path.join(data_root, city)
+        with open(data_file, "w", encoding="utf-8") as f:
+            f.write(generate_city_text(city, paragraphs, rng))
+        nodes = timer.run("parse", build_nodes, data_file)
+        num_nodes += len(nodes)
+        timer.run("index", build_index_from_nodes, os.path.join(index_root, city), nodes)
+    return {
+        "stages": timer.summary(),
+        "seconds": round(sum(sum(s) for s in timer.seconds.values()), 3),
+        "nodes": num_nodes,
+        "llm_calls": llm.calls,
+        "embed_calls": embed_model.calls - embed_calls,
+        "index_bytes": dir_size(index_root),
+        "max_rss_mb": max_rss_mb(),
+    }
+
+
+def bench_query(queries: List[str], index_root: str) -> Dict:
+    chatter = Chatter(root_dir=index_root, debug=False)
+    service_context = chatter.service_context
+    llm = chatter.llm
+    timer = StageTimer(lambda: llm.llm.calls)
+
+    # 完整的问答：第一遍llm缓存和答案缓存都是空的，第二遍命中答案缓存
+    for query in queries:
+        timer.run("end_to_end", chatter.chat, query)
+    for query in queries:
+        timer.run("answer_cache_hit", chatter.chat, query)
+
+    # 逐个阶段计时，关掉llm缓存，每个阶段都真正调用模拟的llm
+    llm.enable_cache = False
+    cities = chatter.registry.cities()
+    route_choices = [ToolMetadata(description=f"提供 {', '.join(cities)} 这几个城市的相关信息", name="index"),
+                     ToolMetadata(description="提供其他所有信息", name="llm")]
+    route_selector = create_selector(service_context)
+    route_selector.precompute([choice.description for choice in route_choices],
+                              [index_embed_text(chatter.registry), route_choices[1].description])
+    index_nodes = [_index_node(city_summary(city), city) for city in cities]
+    compose_selector = create_selector(service_context)
+    compose_selector.precompute([node.text for node in index_nodes],
+                                [chatter.registry.profile(city) for city in cities])
+    compose_retriever = SelectorRetriever(index_nodes, compose_selector)
+    for city in cities:
+        chatter.registry.evict(city)
+    for query in queries:
+        embedding = timer.run("embed", service_context.embed_model.get_query_embedding, query)
+        query_bundle = QueryBundle(query_str=query, embedding=embedding)
+        timer.run("route", route_selector.select, route_choices, query_bundle)
+        city = timer.run("compose", compose_retriever.retrieve, query_bundle)[0].node.index_id
+        # 城市的索引第一次用到时才加载
+        engine = timer.run("load", chatter.registry.get_query_engine, city)
+        nodes = timer.run("retrieve", engine.retriever.retrieve, query_bundle)
+        nodes = timer.run("rerank", engine._apply_node_postprocessors, nodes, query_bundle=query_bundle)
+        timer.run("synthesize", engine.synthesize, query_bundle, nodes)
+
+    # llm缓存本身的开销：同一个prompt第一次未命中，第二次命中
+    llm.enable_cache = True
+    for i, query in enumerate(queries):
+        prompt = f"{i} {query}"
+        timer.run("llm_cache_miss", llm.complete, prompt)
+        timer.run("llm_cache_hit", llm.complete, prompt)
+    return {"stages": timer.summary(), "max_rss_mb": max_rss_mb()}
+
+
+def compare(results: Dict, baseline: Dict) -> List[str]:
+    lines = []
+    for section in ("build", "query"):
+        for stage, stats in results[section]["stages"].items():
+            old = baseline.get(section, {}).get("stages", {}).get(stage)
+            if not old or not old["mean_ms"]:
+                continue
+            lines.append(f"{section}.{stage}: {old['mean_ms']:.1f}ms -> {stats['mean_ms']:.1f}ms "
+                         f"({stats['mean_ms'] / old['mean_ms'] - 1:+.1%})")
+    return lines
+
+
+def run(num_cities: int, paragraphs: int, num_queries: int, seed: int) -> Dict:
+    rng = random.Random(seed)
+    cities = [f"测试城市{i}" for i in range(num_cities)]
+    queries = generate_queries(cities, num_queries, rng)
+    work_dir = tempfile.mkdtemp(prefix="bench_")
+    try:
+        build_result = bench_build(cities, paragraphs, work_dir, rng)
+        query_result = bench_query(queries, os.path.join(work_dir, "index"))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "python": sys.version.split()[0],
+            "backend": LLM_BACKEND,
+            "llm_latency": FAKE_LLM_LATENCY,
+            "embed_latency": FAKE_EMBED_LATENCY,
+            "cities": num_cities,
+            "paragraphs": paragraphs,
+            "queries": num_queries,
+            "seed": seed,
+        },
+        "build": build_result,
+        "query": query_result,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="offline benchmark with fake llm and embedding")
+    parser.add_argument("--cities", type=int, default=3)
+    parser.add_argument("--paragraphs", type=int, default=200, help="paragraphs per city document")
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results as json to this file")
+    parser.add_argument("--baseline", help="results json of a previous run to compare with")
+    args = parser.parse_args()
+    if LLM_BACKEND != "fake":
+        parser.error(f"LLM_BACKEND={LLM_BACKEND}, benchmark only runs with the fake backend")
+
+    results = run(args.cities, args.paragraphs, args.queries, args.seed)
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            print("\n".join(compare(results, json.load(f))))
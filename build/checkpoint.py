@@ -0,0 +1,117 @@
+import json
+import os
+import shutil
+import threading
+from typing import Dict, Iterable, List, Set, Tuple
+
+from llama_index import StorageContext
+from llama_index.schema import BaseNode
+from llama_index.storage.docstore.types import DEFAULT_PERSIST_FNAME as DOCSTORE_FNAME
+from llama_index.vector_stores.types import DEFAULT_PERSIST_FNAME as VECTOR_STORE_FNAME
+
+from build.ingest import batched
+from common.config import OLD_INDEX_SUFFIX, PARTIAL_INDEX_SUFFIX
+from common.vector_store import NumpyVectorStore, load_storage_context
+
+CHECKPOINT_FNAME = "checkpoint.json"
+
+
+def replace_index_dir(new_dir: str, index_file: str):
+    """用构建好的 new_dir 替换 index_file，目录不能直接覆盖，旧的索引先改名，新目录就位后再删除"""
+    old_dir = index_file + OLD_INDEX_SUFFIX
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if os.path.exists(index_file):
+        os.replace(index_file, old_dir)
+    os.replace(new_dir, index_file)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def recover_index_dir(index_file: str):
+    # 在 replace_index_dir 的两次rename之间中断时，恢复旧的索引
+    old_dir = index_file + OLD_INDEX_SUFFIX
+    if not os.path.exists(index_file) and os.path.exists(old_dir):
+        os.replace(old_dir, index_file)
+
+
+class BuildCheckpoint:
+    """构建中的索引保存在 `<index_file>.partial` 目录，全部完成后整体rename为 index_file
+
+    checkpoint.json 记录已经完成的进度：解析出的叶子node、已经写入向量库的node、已经生成summary的tree parent，
+    构建中断后从这里继续，不需要重新解析文档，也不会重复计算embedding和summary
+    """
+
+    def __init__(self, index_file: str):
+        self.index_file = index_file
+        self.partial_dir = index_file + PARTIAL_INDEX_SUFFIX
+        self.storage_context: StorageContext = None
+        self.state: Dict = {}
+        # 向量索引和tree索引在不同的线程里构建，写checkpoint时互斥
+        self._lock = threading.Lock()
+
+    @property
+    def _state_file(self) -> str:
+        return os.path.join(self.partial_dir, CHECKPOINT_FNAME)
+
+    def exists(self) -> bool:
+        return os.path.exists(self._state_file)
+
+    def load(self) -> bool:
+        if not self.exists():
+            return False
+        try:
+            with open(self._state_file) as f:
+                state = json.load(f)
+            storage_context = load_storage_context(self.partial_dir)
+        except Exception as e:
+            # 写checkpoint的过程中被中断，文件可能不完整，只能从头构建
+            print(f"[build] broken checkpoint {self.partial_dir} ({e!r}), rebuild from scratch")
+            shutil.rmtree(self.partial_dir, ignore_errors=True)
+            return False
+        self.state, self.storage_context = state, storage_context
+        return True
+
+    def start(self, nodes: Iterable[BaseNode], batch_size: int = 1024):
+        """nodes 可以是生成器，边解析边写入docstore；docstore是内存里的 SimpleDocumentStore，最终仍然包含所有的nodes"""
+        shutil.rmtree(self.partial_dir, ignore_errors=True)
+        self.storage_context = StorageContext.from_defaults(vector_store=NumpyVectorStore())
+        self.state = {"leaf_ids": [], "embedded_ids": [], "tree_parents": {}}
+        for batch in batched(nodes, batch_size):
+            self.storage_context.docstore.add_documents(batch)
+            self.state["leaf_ids"].extend(node.node_id for node in batch)
+        self.storage_context.persist(persist_dir=self.partial_dir)
+        self._write_state()
+
+    def _write_state(self):
+        # checkpoint.json 最后写入，并且先写临时文件再rename，它记录的进度对应的数据一定已经落盘
+        tmp_path = self._state_file + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(tmp_path, self._state_file)
+
+    def leaf_nodes(self) -> List[BaseNode]:
+        return [self.storage_context.docstore.get_node(node_id) for node_id in self.state["leaf_ids"]]
+
+    def embedded_ids(self) -> Set[str]:
+        return set(self.state["embedded_ids"])
+
+    def tree_parents(self) -> Dict[str, List[str]]:
+        return self.state["tree_parents"]
+
+    def save_vectors(self, node_ids: List[str]):
+        with self._lock:
+            self.storage_context.vector_store.persist(os.path.join(self.partial_dir, VECTOR_STORE_FNAME))
+            self.state["embedded_ids"].extend(node_ids)
+            self._write_state()
+
+    def save_tree_level(self, parents: List[Tuple[BaseNode, List[BaseNode]]]):
+        with self._lock:
+            self.storage_context.docstore.persist(os.path.join(self.partial_dir, DOCSTORE_FNAME))
+            self.state["tree_parents"].update(
+                {parent.node_id: [child.node_id for child in children] for parent, children in parents})
+            self._write_state()
+
+    def commit(self):
+        with self._lock:
+            self.storage_context.persist(persist_dir=self.partial_dir)
+            os.remove(self._state_file)
+            replace_index_dir(self.partial_dir, self.index_file)
@@ -1,26 +1,129 @@
+import json
 import os
+import threading
+from functools import lru_cache
+from typing import Dict, List
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from common.config import DOWNLOAD_TIMEOUT, WIKI_API_URL
+
+# MediaWiki API 一次请求最多可以传50个title
+TITLES_PER_REQUEST = 50
+# 记录每个已下载页面的revision，页面没有变化时不重新下载
+META_FNAME = ".download_meta.json"
+
+_meta_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_session() -> requests.Session:
+    # 复用连接池，连接失败和 429/5xx 按指数退避自动重试
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _query(api_url: str, titles: List[str], **params) -> dict:
+    response = get_session().get(api_url, params={
+        'action': 'query',
+        'format': 'json',
+        'formatversion': 2,
+        'titles': '|'.join(titles),
+        **params,
+    }, timeout=DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def _pages_by_title(titles: List[str], result: dict) -> Dict[str, dict]:
+    # API会把title规范化(例如首字母大写)，这里映射回调用方传入的title
+    normalized = {item['to']: item['from'] for item in result['query'].get('normalized', [])}
+    pages = {}
+    for page in result['query']['pages']:
+        title = normalized.get(page['title'], page['title'])
+        if title in titles:
+            pages[title] = page
+    return pages
+
+
+def _fetch_revisions(api_url: str, titles: List[str]) -> Dict[str, int]:
+    pages = _pages_by_title(titles, _query(api_url, titles, prop='info'))
+    missing = [title for title in titles if title not in pages or pages[title].get('missing')]
+    if missing:
+        raise ValueError(f"Wiki pages not found: {missing}")
+    return {title: page['lastrevid'] for title, page in pages.items()}
+
+
+def _fetch_extracts(api_url: str, titles: List[str]) -> Dict[str, str]:
+    # 全文的extract每次返回的页面数有限制，剩下的页面通过 continue 参数继续获取
+    extracts = {}
+    params = {'prop': 'extracts', 'explaintext': 1, 'exlimit': 'max'}
+    while True:
+        result = _query(api_url, titles, **params)
+        for title, page in _pages_by_title(titles, result).items():
+            if 'extract' in page:
+                extracts[title] = page['extract']
+        if 'continue' not in result:
+            return extracts
+        params = {**params, **result['continue']}
+
+
+def _load_meta(data_dir: str) -> Dict[str, int]:
+    try:
+        with open(os.path.join(data_dir, META_FNAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_meta(data_dir: str, updates: Dict[str, int]):
+    with _meta_lock:
+        meta = _load_meta(data_dir)
+        meta.update(updates)
+        tmp_path = os.path.join(data_dir, META_FNAME + ".tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(data_dir, META_FNAME))
+
+
+def _write_text(file_path: str, text: str):
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as fp:
+        fp.write(text)
+    os.replace(tmp_path, file_path)
+
+
+def download_all(titles: List[str], data_dir: str, api_url: str = WIKI_API_URL) -> List[str]:
+    """批量下载多个维基百科页面，返回和 titles 顺序一致的文件路径
+
+    先用一次请求查询所有页面的最新revision，只有revision变化或者本地没有文件的页面才会下载正文
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    file_paths = [os.path.join(data_dir, f"{title}") for title in titles]
+    meta = _load_meta(data_dir)
+    titles = list(dict.fromkeys(titles))
+    for i in range(0, len(titles), TITLES_PER_REQUEST):
+        batch = titles[i: i + TITLES_PER_REQUEST]
+        revisions = _fetch_revisions(api_url, batch)
+        changed = [title for title in batch
+                   if meta.get(title) != revisions[title] or not os.path.exists(os.path.join(data_dir, title))]
+        if not changed:
+            continue
+        extracts = _fetch_extracts(api_url, changed)
+        if len(extracts) != len(changed):
+            raise ValueError(f"Wiki extracts not returned: {[title for title in changed if title not in extracts]}")
+        for title in changed:
+            _write_text(os.path.join(data_dir, title), extracts[title])
+        _save_meta(data_dir, {title: revisions[title] for title in changed})
+    return file_paths
 
 
 def download(title: str, data_dir: str) -> str:
-    response = requests.get(
-        'https://zh.wikipedia.org/w/api.php',
-        params={
-            'action': 'query',
-            'format': 'json',
-            'titles': title,
-            'prop': 'extracts',
-            'explaintext': True,
-        }
-    ).json()
-    page = next(iter(response['query']['pages'].values()))
-    wiki_text = page['extract']
-
-    if not os.path.exists(data_dir):
-        os.makedirs(data_dir, exist_ok=True)
-
-    file_path = os.path.join(data_dir, f"{title}")
-    with open(file_path, 'w') as fp:
-        fp.write(wiki_text)
-    return file_path
+    return download_all([title], data_dir)[0]
@@ -0,0 +1,65 @@
+import hashlib
+import json
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from llama_index import VectorStoreIndex
+from llama_index.schema import BaseNode, MetadataMode, RelatedNodeInfo
+from llama_index.vector_stores import SimpleVectorStore
+
+
+def content_hash(node: BaseNode) -> str:
+    """node的文本和参与embedding或llm的metadata的hash
+
+    node.hash 包含全部metadata，文件重新下载或者只是被访问过，日期类的metadata就会变化，这里不计入
+    """
+    excluded = set(node.excluded_embed_metadata_keys) & set(node.excluded_llm_metadata_keys)
+    metadata = {key: value for key, value in node.metadata.items() if key not in excluded}
+    content = node.get_content(metadata_mode=MetadataMode.NONE) + json.dumps(
+        metadata, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def reuse_unchanged_nodes(new_nodes: List[BaseNode], old_nodes: List[BaseNode]) -> Tuple[List[BaseNode], List[str]]:
+    """内容hash相同的新node沿用旧node的id，这样旧的embedding和tree summary都可以复用
+
+    返回 (使用最终id的新nodes, 已经不存在的旧node ids)
+    """
+    old_ids_by_hash: Dict[str, List[str]] = defaultdict(list)
+    for node in old_nodes:
+        old_ids_by_hash[content_hash(node)].append(node.node_id)
+    id_mapping = {}
+    for node in new_nodes:
+        # 相同内容的chunk可能出现多次，按出现顺序一一对应
+        candidates = old_ids_by_hash.get(content_hash(node))
+        if candidates:
+            id_mapping[node.node_id] = candidates.pop(0)
+    for node in new_nodes:
+        node.id_ = id_mapping.get(node.node_id, node.node_id)
+        # prev/next 等关系里引用的也是解析时生成的id，需要一起替换
+        for relation, info in node.relationships.items():
+            if isinstance(info, RelatedNodeInfo) and info.node_id in id_mapping:
+                info.node_id = id_mapping[info.node_id]
+    stale_ids = [node_id for node_ids in old_ids_by_hash.values() for node_id in node_ids]
+    return new_nodes, stale_ids
+
+
+def delete_vector_nodes(vector_index: VectorStoreIndex, node_ids: List[str]):
+    # VectorStoreIndex 没有实现按node id删除，这里直接修改 index_struct 和 vector_store
+    vector_store = vector_index.vector_store
+    if hasattr(vector_store, "delete_nodes"):
+        vector_store.delete_nodes(node_ids)
+    elif isinstance(vector_store, SimpleVectorStore):
+        data = vector_store._data
+        for node_id in node_ids:
+            data.embedding_dict.pop(node_id, None)
+            data.text_id_to_ref_doc_id.pop(node_id, None)
+            if data.metadata_dict is not None:
+                data.metadata_dict.pop(node_id, None)
+    else:
+        raise NotImplementedError(f"Can't delete nodes from {vector_store.__class__.__name__}")
+    node_ids = set(node_ids)
+    for vector_id, node_id in list(vector_index.index_struct.nodes_dict.items()):
+        if node_id in node_ids:
+            del vector_index.index_struct.nodes_dict[vector_id]
+    vector_index.storage_context.index_store.add_index_struct(vector_index.index_struct)
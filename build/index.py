@@ -1,73 +1,265 @@
 #! coding: utf-8
 
 
+import argparse
 import os
-from typing import List
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Iterable, List, Optional, Tuple
 
-from llama_index import ServiceContext, StorageContext, VectorStoreIndex, SimpleDirectoryReader, TreeIndex
+from llama_index import ServiceContext, StorageContext, VectorStoreIndex, TreeIndex, \
+    load_indices_from_storage
+from llama_index.data_structs.data_structs import IndexGraph
+from llama_index.indices.utils import embed_nodes
 from llama_index.node_parser import SimpleNodeParser
 from llama_index.schema import BaseNode
 from llama_index.text_splitter import SentenceSplitter
+from tqdm import tqdm
 
-from build.download import download
-from common.config import data_dir, index_dir
+from build.checkpoint import BuildCheckpoint, recover_index_dir, replace_index_dir
+from build.download import download, download_all
+from build.ingest import batched, iter_nodes
+from build.incremental import delete_vector_nodes, reuse_unchanged_nodes
+from build.tree import TreeBuilder
+from common.config import CITY_PROFILE_FNAME, PARTIAL_INDEX_SUFFIX, data_dir, index_dir
+from common.embedding import create_embed_model
 from common.llm import create_llm
 from common.prompt import CH_SUMMARY_PROMPT
+from common.utils import city_profile, find_typed
+from common.vector_store import load_storage_context, migrate_legacy_vector_store
 
 llm = create_llm(timeout=60)
 service_context = ServiceContext.from_defaults(
     llm=llm,
+    embed_model=create_embed_model(),
     node_parser=SimpleNodeParser.from_defaults(text_splitter=SentenceSplitter(
         chunk_size=1024,
         chunk_overlap=200,
     )),
 )
 
+CITY_TITLES = ['北京市', '上海市', '深圳市']
+# 同时构建的文档数，llm和embedding请求的并发另外由 CachedLLM 的限流器控制
+BUILD_MAX_WORKERS = 4
+TREE_NUM_CHILDREN = 8
+# 每计算这么多个node的embedding保存一次checkpoint
+CHECKPOINT_BATCH_SIZE = 1024
+
+
+@contextmanager
+def report_progress(stage: str, title: str):
+    start = time.monotonic()
+    print(f"[build] {title}: {stage} started")
+    yield
+    print(f"[build] {title}: {stage} finished in {time.monotonic() - start:.1f}s")
+
 
 def build_nodes(data_file: str) -> List[BaseNode]:
-    # 把输入的文档解析为Document对象，txt的文件，一个文件一个Document
-    # 如果是pdf文件，会有特殊处理，一页一个Document
-    documents = SimpleDirectoryReader(input_files=[data_file]).load_data()
-    for doc in documents:
-        # 过滤掉自动生成的 `file_path` 这个metadata, 防止对embedding结果造成干扰
-        doc.excluded_llm_metadata_keys.append("file_path")
-        doc.excluded_embed_metadata_keys.append("file_path")
-    # 把 document 按句子进行分割成多个 nodes
-    return service_context.node_parser.get_nodes_from_documents(documents)
-
-
-def build_index(index_file: str, data_file: str):
-    if os.path.exists(index_file):
-        return
-    nodes = build_nodes(data_file)
-    # 两个index共用一个存储目录，可以复用DocumentStore
-    storage_context = StorageContext.from_defaults()
-    vector_index = VectorStoreIndex(nodes,
-                                    service_context=service_context,
-                                    storage_context=storage_context,
-                                    show_progress=True)
-    # TreeIndex的 num_children 是自底向上逐步summary, 生成parent node的时候，每个parent包含多少个children nodes
-    # summary_template 可以替换为中文的prompt，更稳定的得到中文的summary
-    tree_index = TreeIndex(nodes, num_children=8,
+    # 把输入的文档按块流式读取，每块按句子分割成多个 nodes，不需要一次把整个文件读进内存
+    return list(iter_nodes(data_file, service_context.node_parser))
+
+
+def build_tree_index_from_nodes(title: str, nodes: List[BaseNode], storage_context: StorageContext,
+                                previous_graph: Optional[IndexGraph] = None,
+                                checkpoint: Optional[BuildCheckpoint] = None) -> Tuple[TreeIndex, TreeBuilder]:
+    builder = TreeBuilder(TREE_NUM_CHILDREN, CH_SUMMARY_PROMPT, service_context, storage_context.docstore,
+                          previous_graph=previous_graph, name=title,
+                          reusable_parents=checkpoint.tree_parents() if checkpoint else None,
+                          on_level=checkpoint.save_tree_level if checkpoint else None)
+    index_graph = builder.build(nodes)
+    tree_index = TreeIndex(index_struct=index_graph,
                            service_context=service_context,
                            storage_context=storage_context,
-                           summary_template=CH_SUMMARY_PROMPT,
-                           show_progress=True)
+                           summary_template=CH_SUMMARY_PROMPT)
+    return tree_index, builder
+
+
+def build_vector_index_from_nodes(title: str, nodes: List[BaseNode], storage_context: StorageContext,
+                                  checkpoint: BuildCheckpoint) -> VectorStoreIndex:
+    # 叶子node已经在docstore里了，这里只分批计算embedding写入向量库，每一批完成后保存checkpoint
+    vector_index = VectorStoreIndex([], service_context=service_context, storage_context=storage_context)
+    embedded_ids = checkpoint.embedded_ids()
+    pending = []
+    for node in nodes:
+        if node.node_id in embedded_ids:
+            vector_index.index_struct.add_node(node, text_id=node.node_id)
+        else:
+            pending.append(node)
+    for batch in tqdm(batched(pending, CHECKPOINT_BATCH_SIZE), desc=f"{title} embedding",
+                      total=(len(pending) + CHECKPOINT_BATCH_SIZE - 1) // CHECKPOINT_BATCH_SIZE):
+        embeddings = embed_nodes(batch, service_context.embed_model)
+        batch_with_embedding = []
+        for node in batch:
+            node_with_embedding = node.copy()
+            node_with_embedding.embedding = embeddings[node.node_id]
+            batch_with_embedding.append(node_with_embedding)
+        storage_context.vector_store.add(batch_with_embedding)
+        for node in batch:
+            vector_index.index_struct.add_node(node, text_id=node.node_id)
+        checkpoint.save_vectors([node.node_id for node in batch])
+    storage_context.index_store.add_index_struct(vector_index.index_struct)
+    return vector_index
+
+
+def write_city_profile(persist_dir: str, title: str, tree_index: TreeIndex):
+    # 查询时不需要加载索引就可以用城市简介做路由
+    tmp_path = os.path.join(persist_dir, CITY_PROFILE_FNAME + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(city_profile(title, tree_index.index_struct, tree_index.docstore))
+    os.replace(tmp_path, os.path.join(persist_dir, CITY_PROFILE_FNAME))
+
+
+def build_index_from_checkpoint(checkpoint: BuildCheckpoint):
+    title = os.path.basename(checkpoint.index_file)
+    # 两个index共用一个存储目录，可以复用DocumentStore
+    storage_context = checkpoint.storage_context
+    nodes = checkpoint.leaf_nodes()
+
+    def build_vector_index():
+        with report_progress("vector index", title):
+            return build_vector_index_from_nodes(title, nodes, storage_context, checkpoint)
+
+    def build_tree_index():
+        # TreeIndex自底向上逐步summary, 生成parent node的时候，每个parent包含 TREE_NUM_CHILDREN 个children nodes
+        # summary_template 替换为中文的prompt，更稳定的得到中文的summary
+        # 同一层的summary并发生成，失败的请求会重试
+        with report_progress("tree index", title):
+            return build_tree_index_from_nodes(title, nodes, storage_context, checkpoint=checkpoint)
+
+    # 两个索引互不依赖，同时构建
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = [executor.submit(build_vector_index), executor.submit(build_tree_index)]
+        for future in futures:
+            future.result()
+    tree_index, _ = futures[1].result()
+    write_city_profile(checkpoint.partial_dir, title, tree_index)
     # 把两个索引的生成数据存储到index_file这个目录
-    storage_context.persist(persist_dir=index_file)
+    checkpoint.commit()
+
+
+def build_index_from_nodes(index_file: str, nodes: Iterable[BaseNode]):
+    # 解析出的nodes先保存到checkpoint，中断后可以从这里继续构建
+    # embedding存成连续的float32矩阵，查询时mmap加载
+    checkpoint = BuildCheckpoint(index_file)
+    checkpoint.start(nodes)
+    build_index_from_checkpoint(checkpoint)
 
 
-def download_and_build_index(title: str, data_dir: str, index_dir: str):
+def parse_to_checkpoint(index_file: str, data_file: str):
+    # 在子进程里解析文档，构建索引时再从checkpoint加载
+    BuildCheckpoint(index_file).start(iter_nodes(data_file, service_context.node_parser))
+
+
+def resume_or_build_index(index_file: str, data_file: str):
+    checkpoint = BuildCheckpoint(index_file)
+    if checkpoint.load():
+        print(f"[build] {os.path.basename(index_file)}: continue from checkpoint {checkpoint.partial_dir}")
+        build_index_from_checkpoint(checkpoint)
+    else:
+        # 边解析边写入checkpoint，不需要先把整个文件读进内存；解析出的nodes仍然全部保存在内存里的docstore中
+        build_index_from_nodes(index_file, iter_nodes(data_file, service_context.node_parser))
+
+
+def update_index(index_file: str, nodes: List[BaseNode]):
+    # 增量更新已有的索引：内容没变的node沿用旧的id和embedding，只对新增的node计算embedding，
+    # 删除已经不存在的node，TreeIndex只重新summary受影响的分支
+    # 在索引的副本 <index_file>.partial 上更新，完成后整体替换，中断时原来的索引不受影响
+    title = os.path.basename(index_file)
+    partial_dir = index_file + PARTIAL_INDEX_SUFFIX
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    shutil.copytree(index_file, partial_dir)
+    storage_context = load_storage_context(partial_dir)
+    indices = load_indices_from_storage(storage_context=storage_context, service_context=service_context)
+    vector_index = find_typed(indices, VectorStoreIndex)
+    tree_index = find_typed(indices, TreeIndex)
+    docstore = storage_context.docstore
+
+    old_leaf_ids = list(vector_index.index_struct.nodes_dict.values())
+    nodes, stale_ids = reuse_unchanged_nodes(nodes, [docstore.get_node(node_id) for node_id in old_leaf_ids])
+    old_leaf_id_set = set(old_leaf_ids)
+    new_nodes = [node for node in nodes if node.node_id not in old_leaf_id_set]
+    # 沿用旧id的node关系(prev/next)可能变了，docstore里统一更新
+    docstore.add_documents(nodes, allow_update=True)
+
+    with report_progress(f"vector index (+{len(new_nodes)} -{len(stale_ids)} nodes)", title):
+        delete_vector_nodes(vector_index, stale_ids)
+        if new_nodes:
+            vector_index.insert_nodes(new_nodes)
+
+    previous_graph = tree_index.index_struct
+    with report_progress("tree index", title):
+        tree_index, builder = build_tree_index_from_nodes(title, nodes, storage_context, previous_graph)
+    index_graph = tree_index.index_struct
+    old_parent_ids = [node_id for node_id, children in previous_graph.node_id_to_children_ids.items() if children]
+    reused = set(builder.reused_node_ids)
+    stale_parent_ids = [node_id for node_id in old_parent_ids if node_id not in reused]
+    regenerated = len(index_graph.all_nodes) - len(nodes) - len(reused)
+    print(f"[build] {title}: reused {len(reused)} tree summaries, regenerated {regenerated}")
+    for node_id in stale_ids + stale_parent_ids:
+        docstore.delete_document(node_id, raise_error=False)
+    storage_context.persist(persist_dir=partial_dir)
+    write_city_profile(partial_dir, title, tree_index)
+    replace_index_dir(partial_dir, index_file)
+
+
+def prepare_index_dir(index_file: str):
+    # 恢复中断的替换；旧版本的索引在构建时转换为npy格式，查询时不需要写索引目录
+    recover_index_dir(index_file)
+    if os.path.exists(index_file):
+        migrate_legacy_vector_store(index_file)
+
+
+def build_index(index_file: str, data_file: str, incremental: bool = False):
+    prepare_index_dir(index_file)
+    if os.path.exists(index_file):
+        if incremental:
+            update_index(index_file, build_nodes(data_file))
+        return
+    resume_or_build_index(index_file, data_file)
+
+
+def get_index_file(data_file: str, data_dir: str, index_dir: str) -> str:
+    return os.path.join(index_dir, os.path.relpath(data_file, data_dir))
+
+
+def download_and_build_index(title: str, data_dir: str, index_dir: str, incremental: bool = False):
     data_file = download(title, data_dir)
-    build_index(index_file=os.path.join(index_dir, os.path.relpath(data_file, data_dir)), data_file=data_file)
+    build_index(index_file=get_index_file(data_file, data_dir, index_dir), data_file=data_file,
+                incremental=incremental)
 
 
-def build_all():
+def build_all(titles: Optional[List[str]] = None, max_workers: int = BUILD_MAX_WORKERS, incremental: bool = False):
     # 单独构建全部的索引，后续查询会用到多索引
-    titles = ['北京市', '上海市', '深圳市']
-    for title in titles:
-        download_and_build_index(title, data_dir, index_dir)
+    titles = titles or CITY_TITLES
+    # 一次请求查询多个页面，内容没有变化的页面不会重新下载
+    data_files = download_all(titles, data_dir)
+    pending = [(get_index_file(data_file, data_dir, index_dir), data_file) for data_file in data_files]
+    for index_file, _ in pending:
+        prepare_index_dir(index_file)
+    if not incremental:
+        pending = [(index_file, data_file) for index_file, data_file in pending if not os.path.exists(index_file)]
+    if not pending:
+        return
+    # 上次中断的构建从checkpoint继续，不需要重新解析文档
+    parse = [(index_file, data_file) for index_file, data_file in pending
+             if not os.path.exists(index_file) and not BuildCheckpoint(index_file).exists()]
+    if parse:
+        # 文档解析和分句是cpu密集的，用进程池；nodes在子进程里边解析边写入checkpoint，不传回父进程
+        with report_progress("parse nodes", f"{len(parse)} documents"):
+            with ProcessPoolExecutor(max_workers=min(max_workers, len(parse))) as executor:
+                list(executor.map(parse_to_checkpoint, *zip(*parse)))
+    # embedding和summary都是llm请求，用线程池并发构建多个文档的索引，每个任务只加载自己文档的nodes
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(build_index, index_file, data_file, incremental)
+                   for index_file, data_file in pending]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="build index"):
+            future.result()
 
 
 if __name__ == '__main__':
-    build_all()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--incremental", action="store_true", help="增量更新已经存在的索引")
+    args = parser.parse_args()
+    build_all(incremental=args.incremental)
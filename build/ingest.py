@@ -0,0 +1,97 @@
+import uuid
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional
+
+from llama_index.node_parser import NodeParser
+from llama_index.readers.file.base import default_file_metadata_func
+from llama_index.schema import BaseNode, Document, NodeRelationship
+
+# 每次读入内存的文本大小(字符数)，按段落边界切开，块内再交给 node parser 分句
+INGEST_BLOCK_CHARS = 1 << 20
+# 和 SimpleDirectoryReader 一样，日期类的metadata不参与embedding和llm
+_DATE_METADATA_KEYS = ["creation_date", "last_modified_date", "last_accessed_date"]
+
+
+def iter_text_blocks(data_file: str, block_chars: int = INGEST_BLOCK_CHARS) -> Iterator[str]:
+    """逐行读取文件，凑够 block_chars 个字符后在下一个空行处切分，内存里最多只有一个块"""
+    lines: List[str] = []
+    size = 0
+    with open(data_file, encoding="utf-8") as f:
+        for line in f:
+            lines.append(line)
+            size += len(line)
+            if size >= block_chars and not line.strip():
+                yield "".join(lines)
+                lines, size = [], 0
+    if lines:
+        yield "".join(lines)
+
+
+def _locate_nodes(text: str, nodes: List[BaseNode]) -> List[Optional[int]]:
+    # node的文本是原文的片段，相邻node有overlap，依次向后查找每个node的起始位置，找不到时为None
+    positions: List[Optional[int]] = []
+    search_from = 0
+    for node in nodes:
+        pos = text.find(node.get_content(), search_from)
+        positions.append(pos if pos >= 0 else None)
+        if pos >= 0:
+            search_from = pos + 1
+    return positions
+
+
+def iter_nodes(data_file: str, node_parser: NodeParser, block_chars: int = INGEST_BLOCK_CHARS) -> Iterator[BaseNode]:
+    """流式解析文档：文件按块读取，每块解析出的nodes逐个yield
+
+    每块的最后一个node可能被块的边界截断，不交出去，从它的起始位置开始和下一块一起解析，块边界上的node仍然有overlap；
+    分块的位置和一次解析整个文件不同，边界附近的node不保证和整个文件解析的结果一样。
+    所有块属于同一个Document(相同的ref_doc_id)，start_char_idx/end_char_idx 是node在整个文件中的位置
+    """
+    doc_id = str(uuid.uuid4())
+    metadata = default_file_metadata_func(data_file)
+    prev_node: Optional[BaseNode] = None
+    # 上一块留下的文本，以及它在文件中的起始位置
+    carry, carry_start = "", 0
+    blocks = iter_text_blocks(data_file, block_chars)
+    block = next(blocks, None)
+    while block is not None:
+        next_block = next(blocks, None)
+        text, text_start = carry + block, carry_start
+        doc = Document(text=text, id_=doc_id, metadata=dict(metadata))
+        doc.excluded_embed_metadata_keys.extend(_DATE_METADATA_KEYS)
+        doc.excluded_llm_metadata_keys.extend(_DATE_METADATA_KEYS)
+        # 过滤掉自动生成的 `file_path` 这个metadata, 防止对embedding结果造成干扰
+        doc.excluded_llm_metadata_keys.append("file_path")
+        doc.excluded_embed_metadata_keys.append("file_path")
+        nodes = node_parser.get_nodes_from_documents([doc])
+        positions = _locate_nodes(text, nodes)
+        if next_block is not None and nodes and positions[-1] is not None:
+            # 丢掉最后一个node，它的文本留给下一块
+            carry, carry_start = text[positions[-1]:], text_start + positions[-1]
+            nodes, positions = nodes[:-1], positions[:-1]
+        else:
+            carry, carry_start = "", text_start + len(text)
+        for node, pos in zip(nodes, positions):
+            if pos is not None:
+                node.start_char_idx = text_start + pos
+                node.end_char_idx = node.start_char_idx + len(node.get_content())
+        if prev_node is not None and nodes and getattr(node_parser, "include_prev_next_rel", False):
+            prev_node.relationships[NodeRelationship.NEXT] = nodes[0].as_related_node_info()
+            nodes[0].relationships[NodeRelationship.PREVIOUS] = prev_node.as_related_node_info()
+        # 最后一个node要等下一块解析完补上 NEXT 关系后再交出去
+        if nodes:
+            if prev_node is not None:
+                yield prev_node
+            yield from nodes[:-1]
+            prev_node = nodes[-1]
+        block = next_block
+    if prev_node is not None:
+        yield prev_node
+
+
+def batched(items: Iterable, batch_size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
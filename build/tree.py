@@ -0,0 +1,128 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+from llama_index import ServiceContext
+from llama_index.data_structs.data_structs import IndexGraph
+from llama_index.prompts import BasePromptTemplate
+from llama_index.schema import BaseNode, MetadataMode, TextNode
+from llama_index.storage.docstore import BaseDocumentStore
+
+from common.config import LLM_MAX_CONCURRENCY
+
+
+class TreeBuilder:
+    """自底向上构建 TreeIndex 的 IndexGraph，分组方式和 llama_index 的 GPTTreeIndexBuilder 相同
+
+    传入旧的 IndexGraph 时，children 完全相同的 parent 直接复用旧的 summary，只有受影响的分支才会调用llm；
+    分组时在旧的分组边界处也切开，中间插入或删除一个chunk不会让后面所有的分组错位
+    同一层的所有分组并发生成summary，构建时间和树的层数成正比；失败的summary请求按指数退避重试，
+    已经生成过的summary在 CachedLLM 的缓存里，中断后重新构建不会重复调用llm
+    """
+
+    def __init__(self, num_children: int, summary_prompt: BasePromptTemplate, service_context: ServiceContext,
+                 docstore: BaseDocumentStore, previous_graph: Optional[IndexGraph] = None,
+                 max_workers: int = LLM_MAX_CONCURRENCY, max_retries: int = 3, retry_backoff: float = 1.0,
+                 name: str = "", reusable_parents: Optional[Dict[str, List[str]]] = None,
+                 on_level: Optional[Callable[[List[Tuple[BaseNode, List[BaseNode]]]], None]] = None):
+        if num_children < 2:
+            raise ValueError("Invalid number of children.")
+        self.num_children = num_children
+        self.summary_prompt = summary_prompt
+        self.service_context = service_context
+        self.docstore = docstore
+        self.previous_graph = previous_graph
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.name = name
+        self._reusable: Dict[Tuple[str, ...], str] = {}
+        # 旧的 IndexGraph 里每个node的parent，用于对齐分组的边界
+        self._previous_parents: Dict[str, str] = {}
+        if previous_graph is not None:
+            self._reusable = {tuple(children_ids): parent_id
+                              for parent_id, children_ids in previous_graph.node_id_to_children_ids.items()
+                              if children_ids}
+            self._previous_parents = {child_id: parent_id
+                                      for parent_id, children_ids in previous_graph.node_id_to_children_ids.items()
+                                      for child_id in children_ids}
+        # 上次中断的构建已经生成的 parent: parent_id -> children ids
+        for parent_id, children_ids in (reusable_parents or {}).items():
+            self._reusable[tuple(children_ids)] = parent_id
+        # 每一层生成完以后回调，参数是 [(parent, children)]，用于保存构建进度
+        self.on_level = on_level
+        self.reused_node_ids: List[str] = []
+        # 每一层的 (分组数, 耗时秒数)
+        self.level_timings: List[Tuple[int, float]] = []
+
+    def _summarize(self, group: List[BaseNode]) -> str:
+        truncated_chunks = self.service_context.prompt_helper.truncate(
+            prompt=self.summary_prompt,
+            text_chunks=[node.get_content(metadata_mode=MetadataMode.LLM) for node in group],
+        )
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.service_context.llm_predictor.predict(self.summary_prompt,
+                                                                  context_str="\n".join(truncated_chunks))
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_backoff * 2 ** attempt
+                print(f"[build] {self.name}: summary failed ({e!r}), retry in {delay:.1f}s")
+                time.sleep(delay)
+
+    def _build_parent(self, group: List[BaseNode]) -> Tuple[BaseNode, bool]:
+        """返回 (parent node, 是否复用了旧的summary)"""
+        parent_id = self._reusable.get(tuple(node.node_id for node in group))
+        if parent_id is not None and self.docstore.document_exists(parent_id):
+            return self.docstore.get_node(parent_id), True
+        return TextNode(text=self._summarize(group)), False
+
+    def _build_level(self, groups: List[List[BaseNode]]) -> List[BaseNode]:
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(groups)))) as executor:
+            # map 保持分组的顺序，树的结构和串行构建时一致
+            results = list(executor.map(self._build_parent, groups))
+        parents = [parent for parent, _ in results]
+        reused = [parent.node_id for parent, is_reused in results if is_reused]
+        self.reused_node_ids.extend(reused)
+        # docstore 不是线程安全的，整层生成完以后统一写入
+        self.docstore.add_documents([parent for parent, is_reused in results if not is_reused], allow_update=False)
+        if self.on_level is not None:
+            self.on_level(list(zip(parents, groups)))
+        elapsed = time.monotonic() - start
+        self.level_timings.append((len(groups), elapsed))
+        print(f"[build] {self.name}: tree level {len(self.level_timings)}: {len(groups)} parents "
+              f"({len(reused)} reused) in {elapsed:.1f}s")
+        return parents
+
+    def _group(self, nodes: List[BaseNode]) -> List[List[BaseNode]]:
+        # 每组最多 num_children 个；相邻两个node在旧的树里属于不同的parent时也切开，新的node并入所在的分组
+        groups: List[List[BaseNode]] = []
+        group_parent = None
+        for node in nodes:
+            parent = self._previous_parents.get(node.node_id)
+            if not groups or len(groups[-1]) >= self.num_children or \
+                    (parent is not None and group_parent is not None and parent != group_parent):
+                groups.append([])
+                group_parent = None
+            groups[-1].append(node)
+            group_parent = group_parent or parent
+        return groups
+
+    def build(self, leaf_nodes: List[BaseNode]) -> IndexGraph:
+        index_graph = IndexGraph()
+        if self.previous_graph is not None:
+            # 保持 index_id 不变，覆盖 index_store 里旧的索引
+            index_graph.index_id = self.previous_graph.index_id
+        for node in leaf_nodes:
+            index_graph.insert(node)
+        cur_nodes = list(leaf_nodes)
+        while len(cur_nodes) > self.num_children:
+            groups = self._group(cur_nodes)
+            parents = self._build_level(groups)
+            for parent, group in zip(parents, groups):
+                index_graph.insert(parent, children_nodes=group)
+            cur_nodes = parents
+        index_graph.root_nodes = {index_graph.get_index(node): node.node_id for node in cur_nodes}
+        return index_graph
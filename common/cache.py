@@ -0,0 +1,648 @@
+import argparse
+import atexit
+import json
+import os
+import pickle
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # windows 上没有 fcntl，只能保证单进程内安全
+    fcntl = None
+
+from common.config import LLM_CACHE_BACKEND, LLM_CACHE_DIR, LLM_CACHE_EVICTION, LLM_CACHE_LOCK_TIMEOUT, \
+    LLM_CACHE_MAX_AGE, LLM_CACHE_MAX_MB, LLM_CACHE_VERSION
+
+# 超出大小预算时淘汰到预算的这个比例以下，避免每次写入都触发淘汰
+PRUNE_LOW_WATERMARK = 0.9
+# 多个进程共用缓存目录时的锁文件
+LOCK_FNAME = ".lock"
+# 写入中途退出的进程会留下临时文件，超过这个时间(秒)的在淘汰时一起清理
+STALE_TMP_SECONDS = 3600
+# 读取损坏(写了一半、磁盘错误、版本不兼容)的缓存时可能抛出的异常
+_CORRUPT_ERRORS = (EOFError, pickle.UnpicklingError, AttributeError, ImportError, IndexError, TypeError, ValueError)
+
+
+@contextmanager
+def file_lock(lock_path: str, shared: bool = False) -> Iterator[None]:
+    """跨进程的建议锁(flock)，shared=True 时是读锁"""
+    if fcntl is None:
+        yield
+        return
+    with open(lock_path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def connect_sqlite(db_path: str) -> sqlite3.Connection:
+    # timeout 即 busy_timeout：其他进程持有写锁时等待而不是立即报 database is locked
+    conn = sqlite3.connect(db_path, timeout=LLM_CACHE_LOCK_TIMEOUT, check_same_thread=False)
+    # 切换 WAL 需要独占数据库，多个进程同时启动时串行执行
+    with file_lock(db_path + LOCK_FNAME):
+        conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def is_busy(e: sqlite3.OperationalError) -> bool:
+    message = str(e)
+    return "locked" in message or "busy" in message
+
+
+@dataclass
+class CacheItem:
+    # request 是 CacheRequest.dump() 的结果，用于校验 hash 冲突
+    request: bytes
+    response: Optional[object]
+    # 产生这个缓存的方法名(chat/complete/...)，用于分方法统计
+    method: str = ""
+
+
+@dataclass(frozen=True)
+class CacheBudget:
+    """缓存的磁盘预算，max_bytes/max_age 为 None 表示不限制
+
+    policy: lru 先淘汰最久没有命中的; lfu 先淘汰命中次数最少的
+    """
+    max_bytes: Optional[int] = None
+    max_age: Optional[float] = None
+    policy: str = "lru"
+
+    def __post_init__(self):
+        if self.policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown cache eviction policy: {self.policy}")
+
+
+def default_budget() -> CacheBudget:
+    return CacheBudget(max_bytes=None if LLM_CACHE_MAX_MB is None else int(LLM_CACHE_MAX_MB * 1024 * 1024),
+                       max_age=LLM_CACHE_MAX_AGE, policy=LLM_CACHE_EVICTION)
+
+
+class CacheStats:
+    """进程内的缓存统计：每个方法的命中、未命中、写入次数和写入的字节数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[str, int]] = defaultdict(lambda: {"hits": 0, "misses": 0, "puts": 0})
+        self.bytes_written = 0
+        self.evicted = 0
+        self.corrupted = 0
+
+    def record(self, method: str, counter: str, count: int = 1):
+        with self._lock:
+            self._counters[method][counter] += count
+
+    def record_write(self, nbytes: int):
+        with self._lock:
+            self.bytes_written += nbytes
+
+    def record_evict(self, count: int):
+        with self._lock:
+            self.evicted += count
+
+    def record_corrupt(self):
+        with self._lock:
+            self.corrupted += 1
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            by_method = {method: dict(counters) for method, counters in self._counters.items()}
+            bytes_written, evicted, corrupted = self.bytes_written, self.evicted, self.corrupted
+        hits = sum(c["hits"] for c in by_method.values())
+        misses = sum(c["misses"] for c in by_method.values())
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "puts": sum(c["puts"] for c in by_method.values()),
+            "bytes_written": bytes_written,
+            "evicted": evicted,
+            "corrupted": corrupted,
+            "by_method": by_method,
+        }
+
+
+class BaseCacheStore(ABC):
+
+    def __init__(self):
+        self.stats = CacheStats()
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[CacheItem]:
+        ...
+
+    @abstractmethod
+    def put(self, key: str, item: CacheItem):
+        ...
+
+    def touch(self, key: str):
+        """记录一次命中，用于 lru/lfu 淘汰"""
+
+    def usage(self) -> Dict:
+        """磁盘上的缓存条数、字节数和每个方法的条数"""
+        return {}
+
+    def prune(self, budget: CacheBudget) -> int:
+        """按预算淘汰缓存，返回淘汰的条数"""
+        return 0
+
+    def compact(self):
+        """回收淘汰后留下的磁盘空间"""
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class FileCacheStore(BaseCacheStore):
+    """一个请求一个pickle文件，兼容旧版本的 .llm_cache 目录
+
+    先写临时文件再 rename，其他进程不会读到写了一半的文件；读到损坏的文件时删除并当作未命中
+    命中时更新文件的mtime，淘汰时 lru 和 max_age 都按mtime计算；文件上没有命中次数，lfu 也按 lru 处理
+    和sqlite一样，每写入 prune_interval 个文件检查一次 budget
+    """
+
+    def __init__(self, root_dir: str, budget: Optional[CacheBudget] = None, prune_interval: int = 1024):
+        super().__init__()
+        os.makedirs(root_dir, exist_ok=True)
+        self.root_dir = root_dir
+        self.lock_path = os.path.join(root_dir, LOCK_FNAME)
+        self.budget = budget
+        self.prune_interval = prune_interval
+        self._lock = threading.Lock()
+        self._writes_since_prune = 0
+        if self.budget is not None:
+            self.prune(self.budget)
+
+    def get(self, key: str) -> Optional[CacheItem]:
+        cache_path = os.path.join(self.root_dir, key)
+        try:
+            with open(cache_path, "rb") as f:
+                cache_item = pickle.load(f)
+            # 旧版本的缓存文件中 request 是 CacheRequest 对象
+            if not isinstance(cache_item.request, bytes):
+                cache_item = CacheItem(cache_item.request.dump(), cache_item.response)
+        except FileNotFoundError:
+            return None
+        except _CORRUPT_ERRORS:
+            self._remove(key)
+            self.stats.record_corrupt()
+            return None
+        self.touch(key)
+        return cache_item
+
+    def put(self, key: str, item: CacheItem):
+        data = pickle.dumps(item)
+        # 临时文件名带 "."，不会被当作缓存文件
+        fd, tmp_path = tempfile.mkstemp(dir=self.root_dir, prefix=key + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            # 淘汰时持有写锁，写入之间互不影响，只需要读锁
+            with file_lock(self.lock_path, shared=True):
+                os.replace(tmp_path, os.path.join(self.root_dir, key))
+        except BaseException:
+            self._remove(os.path.basename(tmp_path))
+            raise
+        self.stats.record_write(len(data))
+        if self.budget is None:
+            return
+        with self._lock:
+            self._writes_since_prune += 1
+            need_prune = self._writes_since_prune >= self.prune_interval
+            if need_prune:
+                self._writes_since_prune = 0
+        if need_prune:
+            self.prune(self.budget)
+
+    def _remove(self, name: str):
+        try:
+            os.remove(os.path.join(self.root_dir, name))
+        except FileNotFoundError:
+            pass
+
+    def touch(self, key: str):
+        try:
+            os.utime(os.path.join(self.root_dir, key))
+        except FileNotFoundError:
+            pass
+
+    def _entries(self) -> List[Tuple[str, int, float]]:
+        entries = []
+        with os.scandir(self.root_dir) as it:
+            for entry in it:
+                # 缓存文件名是32位的md5，跳过sqlite文件等其他文件
+                if entry.is_file() and len(entry.name) == 32 and "." not in entry.name:
+                    stat = entry.stat()
+                    entries.append((entry.name, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _stale_tmp_files(self) -> List[str]:
+        deadline = time.time() - STALE_TMP_SECONDS
+        with os.scandir(self.root_dir) as it:
+            return [entry.name for entry in it
+                    if entry.name.endswith(".tmp") and entry.is_file() and entry.stat().st_mtime < deadline]
+
+    def usage(self) -> Dict:
+        entries = self._entries()
+        return {"entries": len(entries), "bytes": sum(size for _, size, _ in entries)}
+
+    def prune(self, budget: CacheBudget) -> int:
+        # 多个进程同时淘汰时只有一个在执行，其他进程的写入等淘汰结束
+        with file_lock(self.lock_path):
+            entries = sorted(self._entries(), key=lambda e: e[2])
+            removed = []
+            if budget.max_age is not None:
+                deadline = time.time() - budget.max_age
+                removed = [e for e in entries if e[2] < deadline]
+                entries = entries[len(removed):]
+            if budget.max_bytes is not None:
+                total = sum(size for _, size, _ in entries)
+                if total > budget.max_bytes:
+                    for e in entries:
+                        if total <= budget.max_bytes * PRUNE_LOW_WATERMARK:
+                            break
+                        removed.append(e)
+                        total -= e[1]
+            for key, _, _ in removed:
+                self._remove(key)
+            for name in self._stale_tmp_files():
+                self._remove(name)
+        self.stats.record_evict(len(removed))
+        return len(removed)
+
+
+class SqliteCacheStore(BaseCacheStore):
+    """所有缓存存放在同一个sqlite文件里，写入先攒在内存里批量提交
+
+    多个进程可以共用同一个文件：写锁被占用时等待 LLM_CACHE_LOCK_TIMEOUT 秒，仍然拿不到就留到下次提交；
+    写入用单独的连接，不持有读用的锁，等待写锁的时候 get() 不受影响(WAL模式下读写互不阻塞)；
+    读到无法反序列化的记录时删除并当作未命中
+
+    每条缓存记录大小、写入时间、最近命中时间和命中次数，每写入 prune_interval 条检查一次 budget
+    """
+
+    def __init__(self, db_path: str, batch_size: int = 64, flush_interval: float = 5.0,
+                 budget: Optional[CacheBudget] = None, prune_interval: int = 1024):
+        super().__init__()
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.budget = budget
+        self.prune_interval = prune_interval
+        # _lock 保护内存里的待提交数据和读连接；_write_lock 保证同一时间只有一个线程在写数据库
+        # 需要同时持有时先拿 _write_lock 再拿 _lock
+        self._lock = threading.RLock()
+        self._write_lock = threading.RLock()
+        self._pending: Dict[str, CacheItem] = {}
+        # 正在提交的一批写入，提交完成之前 get() 仍然可以从这里命中
+        self._flushing: Dict[str, CacheItem] = {}
+        # key -> [最近命中时间, 命中次数]，和写入一起批量提交
+        self._pending_access: Dict[str, List] = {}
+        self._writes_since_prune = 0
+        self._last_flush = time.monotonic()
+        self._write_conn = connect_sqlite(db_path)
+        # 多个进程同时启动时只有一个执行建表和迁移，避免重复 ALTER TABLE
+        with file_lock(db_path + LOCK_FNAME):
+            self._write_conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, request BLOB NOT NULL, response BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._migrate()
+            self._write_conn.commit()
+        self._conn = connect_sqlite(db_path)
+        if self.budget is not None:
+            self.prune(self.budget)
+        # 进程退出前把还没提交的写入刷到磁盘
+        atexit.register(self.close)
+
+    def _migrate(self):
+        # 旧版本的表没有统计字段，补上并用已有数据填充
+        conn = self._write_conn
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(llm_cache)")}
+        if "size" not in columns:
+            conn.execute("ALTER TABLE llm_cache ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+            conn.execute("UPDATE llm_cache SET size = length(request) + length(response)")
+        if "accessed_at" not in columns:
+            conn.execute("ALTER TABLE llm_cache ADD COLUMN accessed_at REAL")
+            conn.execute("UPDATE llm_cache SET accessed_at = created_at")
+        if "hits" not in columns:
+            conn.execute("ALTER TABLE llm_cache ADD COLUMN hits INTEGER NOT NULL DEFAULT 0")
+        if "method" not in columns:
+            conn.execute("ALTER TABLE llm_cache ADD COLUMN method TEXT NOT NULL DEFAULT ''")
+        conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed_at ON llm_cache (accessed_at)")
+
+    def get(self, key: str) -> Optional[CacheItem]:
+        with self._lock:
+            item = self._pending.get(key) or self._flushing.get(key)
+            if item is not None:
+                return item
+            row = self._conn.execute("SELECT request, response, method FROM llm_cache WHERE key = ?",
+                                     (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            response = pickle.loads(row[1])
+        except _CORRUPT_ERRORS:
+            self._delete_corrupt(key)
+            return None
+        self.touch(key)
+        return CacheItem(bytes(row[0]), response, row[2])
+
+    def _delete_corrupt(self, key: str):
+        self.stats.record_corrupt()
+        with self._write_lock:
+            try:
+                with self._write_conn:
+                    self._write_conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            except sqlite3.OperationalError as e:
+                # 删除失败不影响这次读取，下次读到时再删
+                if not is_busy(e):
+                    raise
+
+    def put(self, key: str, item: CacheItem):
+        with self._lock:
+            self._pending[key] = item
+            need_flush = len(self._pending) >= self.batch_size or \
+                time.monotonic() - self._last_flush >= self.flush_interval
+        if need_flush:
+            # 其他线程正在提交时不等待，这一条留到下次提交
+            self.flush(wait=False)
+
+    def touch(self, key: str):
+        with self._lock:
+            access = self._pending_access.setdefault(key, [0.0, 0])
+            access[0] = time.time()
+            access[1] += 1
+
+    def flush(self, wait: bool = True):
+        if not self._write_lock.acquire(blocking=wait):
+            return
+        try:
+            flushed = self._flush_locked()
+        finally:
+            self._write_lock.release()
+        if flushed and self.budget is not None and self._writes_since_prune >= self.prune_interval:
+            try:
+                self.prune(self.budget)
+            except sqlite3.OperationalError as e:
+                # 拿不到写锁时跳过这次淘汰，计数已经清零，下一轮再检查
+                if not is_busy(e):
+                    raise
+
+    def _flush_locked(self) -> bool:
+        # 在锁里只取出待提交的数据，写数据库(可能要等其他进程的写锁)时不持有 _lock，不阻塞 get()
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if (not self._pending and not self._pending_access) or self._write_conn is None:
+                return False
+            self._flushing, self._pending = self._pending, {}
+            pending_access, self._pending_access = self._pending_access, {}
+        now = time.time()
+        rows = []
+        for key, item in self._flushing.items():
+            response = pickle.dumps(item.response)
+            rows.append((key, item.request, response, now, len(item.request) + len(response), now, item.method))
+        try:
+            with self._write_conn:
+                self._write_conn.executemany(
+                    "INSERT OR REPLACE INTO llm_cache (key, request, response, created_at, size, accessed_at, "
+                    "method) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                self._write_conn.executemany(
+                    "UPDATE llm_cache SET accessed_at = ?, hits = hits + ? WHERE key = ?",
+                    [(accessed_at, hits, key) for key, (accessed_at, hits) in pending_access.items()])
+        except BaseException as e:
+            # 这一批已经回滚，放回内存里下次再提交，期间新的写入和命中优先
+            with self._lock:
+                self._pending = {**self._flushing, **self._pending}
+                for key, (accessed_at, hits) in pending_access.items():
+                    access = self._pending_access.setdefault(key, [0.0, 0])
+                    access[0] = max(access[0], accessed_at)
+                    access[1] += hits
+                self._flushing = {}
+            # 其他进程长时间持有写锁，等下次提交
+            if isinstance(e, sqlite3.OperationalError) and is_busy(e):
+                return False
+            raise
+        with self._lock:
+            self._flushing = {}
+        self.stats.record_write(sum(row[4] for row in rows))
+        self._writes_since_prune += len(rows)
+        return True
+
+    def usage(self) -> Dict:
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT method, COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0), MIN(created_at) "
+                "FROM llm_cache GROUP BY method").fetchall()
+        oldest = min((row[4] for row in rows), default=None)
+        return {
+            "entries": sum(row[1] for row in rows),
+            "bytes": sum(row[2] for row in rows),
+            "file_bytes": os.path.getsize(self.db_path),
+            "oldest_age": None if oldest is None else time.time() - oldest,
+            "by_method": {row[0]: {"entries": row[1], "bytes": row[2], "hits": row[3]} for row in rows},
+        }
+
+    def prune(self, budget: CacheBudget) -> int:
+        self.flush()
+        with self._write_lock:
+            self._writes_since_prune = 0
+            removed = 0
+            with self._write_conn:
+                if budget.max_age is not None:
+                    removed += self._write_conn.execute("DELETE FROM llm_cache WHERE created_at < ?",
+                                                  (time.time() - budget.max_age,)).rowcount
+                if budget.max_bytes is not None:
+                    total = self._write_conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+                    if total > budget.max_bytes:
+                        order = "accessed_at" if budget.policy == "lru" else "hits, accessed_at"
+                        victims = []
+                        rows = self._write_conn.execute(
+                            f"SELECT key, size FROM llm_cache ORDER BY {order}").fetchall()
+                        for key, size in rows:
+                            if total <= budget.max_bytes * PRUNE_LOW_WATERMARK:
+                                break
+                            victims.append((key,))
+                            total -= size
+                        self._write_conn.executemany("DELETE FROM llm_cache WHERE key = ?", victims)
+                        removed += len(victims)
+        self.stats.record_evict(removed)
+        return removed
+
+    def compact(self):
+        self.flush()
+        with self._write_lock:
+            self._write_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._write_conn.execute("VACUUM")
+
+    def close(self):
+        if self._conn is None:
+            return
+        self.flush()
+        with self._write_lock, self._lock:
+            if self._conn is None:
+                return
+            self._conn.close()
+            self._write_conn.close()
+            self._conn = self._write_conn = None
+
+
+class LRUCacheStore(BaseCacheStore):
+    """进程内的LRU缓存，命中时不需要访问磁盘和反序列化"""
+
+    def __init__(self, backend: BaseCacheStore, capacity: int = 4096):
+        super().__init__()
+        self.backend = backend
+        self.stats = backend.stats
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._items: Dict[str, CacheItem] = OrderedDict()
+
+    def _remember(self, key: str, item: CacheItem):
+        with self._lock:
+            self._items[key] = item
+            self._items.move_to_end(key)
+            while len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+
+    def get(self, key: str) -> Optional[CacheItem]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+        if item is not None:
+            # 内存命中也要告诉后端，磁盘上的 lru/lfu 淘汰才准确
+            self.backend.touch(key)
+            return item
+        item = self.backend.get(key)
+        if item is not None:
+            self._remember(key, item)
+        return item
+
+    def put(self, key: str, item: CacheItem):
+        self._remember(key, item)
+        self.backend.put(key, item)
+
+    def touch(self, key: str):
+        self.backend.touch(key)
+
+    def usage(self) -> Dict:
+        return self.backend.usage()
+
+    def prune(self, budget: CacheBudget) -> int:
+        removed = self.backend.prune(budget)
+        if removed:
+            # 磁盘上已经淘汰的缓存不能再从内存里命中
+            with self._lock:
+                self._items.clear()
+        return removed
+
+    def compact(self):
+        self.backend.compact()
+
+    def flush(self):
+        self.backend.flush()
+
+    def close(self):
+        self.backend.close()
+
+
+def versioned_dir(root_dir: str) -> str:
+    # 当前版本的llm缓存所在的子目录，同一个缓存目录下的embedding缓存的key没有变化，不在其中
+    return os.path.join(root_dir, f"v{LLM_CACHE_VERSION}")
+
+
+def legacy_paths(root_dir: str) -> List[str]:
+    """之前版本的llm缓存：根目录下一个请求一个的pickle文件、llm_cache.sqlite3，以及旧版本号的子目录"""
+    if not os.path.isdir(root_dir):
+        return []
+    paths = []
+    with os.scandir(root_dir) as it:
+        for entry in it:
+            name = entry.name
+            if entry.is_file() and (re.fullmatch(r"[0-9a-f]{32}(\..*\.tmp)?", name)
+                                    or name.startswith("llm_cache.sqlite3") or name == LOCK_FNAME):
+                paths.append(entry.path)
+            elif entry.is_dir() and re.fullmatch(r"v\d+", name) and entry.path != versioned_dir(root_dir):
+                paths.append(entry.path)
+    return sorted(paths)
+
+
+def drop_legacy(root_dir: str) -> int:
+    """删除之前版本的llm缓存，返回释放的字节数"""
+    freed = 0
+    for path in legacy_paths(root_dir):
+        if os.path.isdir(path):
+            freed += sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            freed += os.path.getsize(path)
+            os.remove(path)
+    return freed
+
+
+# 同一个进程内相同目录共用一个store，多个CachedLLM之间可以共享内存中的LRU和待提交的写入
+@lru_cache(maxsize=None)
+def create_cache_store(root_dir: str, backend: str = "sqlite", lru_capacity: int = 4096,
+                       budget: Optional[CacheBudget] = None) -> BaseCacheStore:
+    if backend == "file":
+        store = FileCacheStore(root_dir, budget=budget)
+    elif backend == "sqlite":
+        store = SqliteCacheStore(os.path.join(root_dir, "llm_cache.sqlite3"), budget=budget)
+    else:
+        raise ValueError(f"Unknown llm cache backend: {backend}")
+    if lru_capacity > 0:
+        store = LRUCacheStore(store, capacity=lru_capacity)
+    return store
+
+
+def main():
+    # 缓存维护: python -m common.cache stats|prune|compact|drop-legacy
+    parser = argparse.ArgumentParser(description="llm cache maintenance")
+    parser.add_argument("command", choices=["stats", "prune", "compact", "drop-legacy"],
+                        help="stats: 查看缓存占用; prune: 按预算淘汰; compact: 淘汰后回收磁盘空间; "
+                             "drop-legacy: 删除key格式变化之前的旧版本缓存")
+    parser.add_argument("--dir", default=LLM_CACHE_DIR)
+    parser.add_argument("--backend", default=LLM_CACHE_BACKEND, choices=["sqlite", "file"])
+    parser.add_argument("--max-mb", type=float, default=LLM_CACHE_MAX_MB)
+    parser.add_argument("--max-age-days", type=float,
+                        default=None if LLM_CACHE_MAX_AGE is None else LLM_CACHE_MAX_AGE / 86400)
+    parser.add_argument("--policy", default=LLM_CACHE_EVICTION, choices=["lru", "lfu"])
+    args = parser.parse_args()
+
+    if args.command == "drop-legacy":
+        print(f"freed {drop_legacy(args.dir) / 1024 / 1024:.1f} MB")
+        return
+    store = create_cache_store(versioned_dir(args.dir), args.backend, lru_capacity=0)
+    if args.command in ("prune", "compact"):
+        budget = CacheBudget(max_bytes=None if args.max_mb is None else int(args.max_mb * 1024 * 1024),
+                             max_age=None if args.max_age_days is None else args.max_age_days * 86400,
+                             policy=args.policy)
+        print(f"evicted {store.prune(budget)} entries")
+        if args.command == "compact":
+            store.compact()
+    print(json.dumps(store.usage(), ensure_ascii=False, indent=2))
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -7,12 +7,73 @@ import os
 ROOT_PATH = os.path.dirname(os.path.dirname(__file__))
 DEBUG = True
 LLM_CACHE_ENABLED = True
+# openai: 调用OpenAI; fake: 本地的模拟llm和embedding(common/fake.py)，用于离线benchmark
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'openai')
+# llm和embedding缓存的目录，fake 后端的缓存放在其中的 fake 子目录，不会和真实的缓存混在一起
+LLM_CACHE_DIR = os.environ.get('LLM_CACHE_DIR', os.path.join(ROOT_PATH, '.llm_cache'))
+# fake 后端每次llm调用、每次embedding批量请求的模拟耗时(秒)
+FAKE_LLM_LATENCY = float(os.environ.get('FAKE_LLM_LATENCY', '0.05'))
+FAKE_EMBED_LATENCY = float(os.environ.get('FAKE_EMBED_LATENCY', '0.01'))
+# sqlite: 所有缓存存在一个sqlite文件里; file: 一个请求一个pickle文件
+LLM_CACHE_BACKEND = 'sqlite'
+# llm缓存key的格式版本，CacheRequest 的key变化时加1；每个版本的缓存放在缓存目录下的 v<版本> 子目录，
+# 旧版本的缓存不会再命中，用 python -m common.cache drop-legacy 删除
+LLM_CACHE_VERSION = 2
+# llm缓存的磁盘预算，超过大小(MB)或者写入时间超过 MAX_AGE(秒) 的缓存会被淘汰，None表示不限制
+LLM_CACHE_MAX_MB = 1024
+LLM_CACHE_MAX_AGE = 90 * 24 * 3600
+# 超过大小预算时的淘汰策略 lru: 最久没有命中的先淘汰; lfu: 命中次数最少的先淘汰
+LLM_CACHE_EVICTION = 'lru'
+# 多个进程共用缓存时，等待其他进程释放sqlite写锁的最长时间(秒)，超时后这一批写入留到下次再提交
+LLM_CACHE_LOCK_TIMEOUT = 30.0
+# 同时发往后端的最大请求数(llm和embedding、同步和异步调用合计)，防止并发调用触发限流
+LLM_MAX_CONCURRENCY = 8
+# 每次embedding请求的文本数，OpenAI embedding接口一次最多可以传2048条文本
+EMBED_BATCH_SIZE = 256
 
 OPENAI_API_KEY = ''
 if OPENAI_API_KEY:
     os.environ['OPENAI_API_KEY'] = OPENAI_API_KEY
 
 data_dir = os.path.join(ROOT_PATH, 'data')
+# 下载文档用的 MediaWiki API 地址，测试时可以通过环境变量指向本地的模拟服务
+WIKI_API_URL = os.environ.get('WIKI_API_URL', 'https://zh.wikipedia.org/w/api.php')
+DOWNLOAD_TIMEOUT = 30
 index_dir = os.path.join(ROOT_PATH, 'index')
+# 构建中的索引保存在 <索引目录>.partial，构建完成后才rename为正式的索引目录
+PARTIAL_INDEX_SUFFIX = '.partial'
+# 增量更新完成后替换索引目录时，旧的索引先改名为 <索引目录>.old，新的目录就位后再删除
+OLD_INDEX_SUFFIX = '.old'
+# 每个城市索引目录里的城市简介：城市名加上文档的summary，路由时用它的embedding和问题比较
+CITY_PROFILE_FNAME = 'city_profile.txt'
+CITY_PROFILE_CHARS = 500
+
+# MultiRetriever 中每个retriever的召回超时时间(秒)
+RETRIEVE_TIMEOUT = 10
+# 所有 MultiRetriever 共用的召回线程数，超时的召回仍会占用线程直到结束，要比并发查询数 x retriever数 多留一些
+RETRIEVE_MAX_WORKERS = 32
+# Chatter 中已加载城市索引的总大小上限(MB)，超过后卸载最久没有用到的城市，None表示不限制
+INDEX_MEMORY_BUDGET_MB = 1024
+# 路由时query和选项描述的embedding相似度不低于该阈值，并且领先第二名至少 MARGIN 时直接采用，否则再调用llm选择
+ROUTE_EMBED_THRESHOLD = 0.8
+ROUTE_EMBED_MARGIN = 0.05
+# 不同embedding模型的相似度分布不同，按模型名覆盖 ROUTE_EMBED_THRESHOLD
+# fake: benchmark.py 的合成数据上，相关问题和城市简介的相似度为0.57~0.72，领先第二名0.09~0.12，无关问题低于0.16
+ROUTE_EMBED_THRESHOLDS = {'fake': 0.4}
+# Chatter 的答案缓存：问题的embedding相似度不低于阈值，并且路由到同样的城市时直接返回之前的答案
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_THRESHOLD = 0.95
+# 按模型名覆盖 ANSWER_CACHE_THRESHOLD
+# text-embedding-ada-002: 只差一个城市名的问题(北京气候如何/深圳气候如何)相似度也在0.95以上，城市不同的由路由区分
+# fake: 改写过的同一个问题和不同城市的同一个问题相似度都在0.55~0.73，只有完全相同的问题才命中
+ANSWER_CACHE_THRESHOLDS = {'text-embedding-ada-002': 0.97, 'fake': 0.99}
+# 缓存的有效时间(秒)，None表示不过期
+ANSWER_CACHE_TTL = 24 * 3600
+ANSWER_CACHE_CAPACITY = 1024
+
+# 收集每个阶段的耗时直方图、llm调用次数、token数和缓存命中数(common/metrics.py)
+METRICS_ENABLED = True
+# 不为空时每个问题回答完后追加一行该问题各阶段的汇总(json lines)
+METRICS_JSONL_FILE = None
 
 ROUTE_TODO = True
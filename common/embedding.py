@@ -0,0 +1,178 @@
+import atexit
+import hashlib
+import os
+import sqlite3
+import threading
+from array import array
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+from llama_index.bridge.pydantic import Field
+from llama_index.callbacks import CallbackManager
+from llama_index.embeddings import OpenAIEmbedding
+from llama_index.embeddings.base import BaseEmbedding, Embedding
+
+from common.cache import connect_sqlite, is_busy
+from common.config import EMBED_BATCH_SIZE, LLM_BACKEND, OPENAI_API_KEY
+from common.fake import FakeEmbedding
+from common.llm import RequestLimiter, cache_dir, default_request_limiter
+
+
+class EmbeddingStore:
+    """embedding以float32的形式存在一个sqlite文件里，key是 模型名 + 文本的hash"""
+
+    def __init__(self, db_path: str, batch_size: int = 256):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self._lock = threading.RLock()
+        self._pending: Dict[str, bytes] = {}
+        self._conn = connect_sqlite(db_path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embedding_cache (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self._conn.commit()
+        atexit.register(self.close)
+
+    @staticmethod
+    def _decode(blob: bytes) -> Embedding:
+        vector = array("f")
+        vector.frombytes(blob)
+        return vector.tolist()
+
+    def get_many(self, keys: List[str]) -> Dict[str, Embedding]:
+        found = {}
+        with self._lock:
+            missing = []
+            for key in keys:
+                if key in self._pending:
+                    found[key] = self._decode(self._pending[key])
+                else:
+                    missing.append(key)
+            # sqlite 单条语句的参数个数有限制，分批查询
+            for i in range(0, len(missing), 500):
+                batch = missing[i: i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embedding_cache WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                found.update({key: self._decode(blob) for key, blob in rows})
+        return found
+
+    def put_many(self, vectors: Dict[str, Embedding]):
+        with self._lock:
+            self._pending.update({key: array("f", vector).tobytes() for key, vector in vectors.items()})
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._pending or self._conn is None:
+                return
+            try:
+                with self._conn:
+                    self._conn.executemany("INSERT OR REPLACE INTO embedding_cache (key, vector) VALUES (?, ?)",
+                                           list(self._pending.items()))
+            except sqlite3.OperationalError as e:
+                # 其他进程长时间持有写锁，下次再提交
+                if is_busy(e):
+                    return
+                raise
+            self._pending.clear()
+
+    def close(self):
+        with self._lock:
+            if self._conn is None:
+                return
+            self.flush()
+            self._conn.close()
+            self._conn = None
+
+
+@lru_cache(maxsize=None)
+def get_embedding_store(root_dir: str) -> EmbeddingStore:
+    return EmbeddingStore(os.path.join(root_dir, "embeddings.sqlite3"))
+
+
+class CachedEmbedding(BaseEmbedding):
+    """和 CachedLLM 类似，对embedding模型加一层持久化缓存
+
+    同一批里相同的文本只计算一次，缓存未命中的文本合并成一个大的请求
+    发往后端的请求和 CachedLLM 共用同一个限流器
+    """
+    embed_model: BaseEmbedding = Field()
+    store: EmbeddingStore = Field(exclude=True)
+    enable_cache: bool = Field()
+    limiter: RequestLimiter = Field(exclude=True)
+
+    def __init__(self, embed_model: BaseEmbedding, root_dir: str, enable_cache: bool = True,
+                 embed_batch_size: int = EMBED_BATCH_SIZE, store: Optional[EmbeddingStore] = None,
+                 limiter: Optional[RequestLimiter] = None, **data: Any):
+        super().__init__(embed_model=embed_model, store=store or get_embedding_store(root_dir),
+                         enable_cache=enable_cache, embed_batch_size=embed_batch_size,
+                         model_name=embed_model.model_name, limiter=limiter or default_request_limiter, **data)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    def _key(self, kind: str, text: str) -> str:
+        return hashlib.md5(f"{self.model_name}\0{kind}\0{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, kind: str, texts: List[str]):
+        keys = [self._key(kind, text) for text in texts]
+        found = self.store.get_many(list(set(keys))) if self.enable_cache else {}
+        # 去重后只计算缓存里没有的文本
+        missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in found))
+        return keys, found, missing
+
+    def _fill(self, kind: str, keys: List[str], found: Dict[str, Embedding], missing: List[str],
+              vectors: List[Embedding]) -> List[Embedding]:
+        computed = {self._key(kind, text): vector for text, vector in zip(missing, vectors)}
+        self.store.put_many(computed)
+        found.update(computed)
+        return [found[key] for key in keys]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        keys, found, missing = self._lookup("text", texts)
+        vectors = []
+        if missing:
+            with self.limiter.sync_slot():
+                vectors = self.embed_model._get_text_embeddings(missing)
+        return self._fill("text", keys, found, missing, vectors)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        keys, found, missing = self._lookup("text", texts)
+        vectors = []
+        if missing:
+            async with self.limiter.async_slot():
+                vectors = await self.embed_model._aget_text_embeddings(missing)
+        return self._fill("text", keys, found, missing, vectors)
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        keys, found, missing = self._lookup("query", [query])
+        vectors = []
+        if missing:
+            with self.limiter.sync_slot():
+                vectors = [self.embed_model._get_query_embedding(query)]
+        return self._fill("query", keys, found, missing, vectors)[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        keys, found, missing = self._lookup("query", [query])
+        vectors = []
+        if missing:
+            async with self.limiter.async_slot():
+                vectors = [await self.embed_model._aget_query_embedding(query)]
+        return self._fill("query", keys, found, missing, vectors)[0]
+
+
+def create_embed_model(callback_manager: CallbackManager = None, enable_cache: bool = True,
+                       backend: str = LLM_BACKEND) -> BaseEmbedding:
+    embed_model = FakeEmbedding() if backend == 'fake' else OpenAIEmbedding(api_key=OPENAI_API_KEY)
+    return CachedEmbedding(embed_model,
+                           cache_dir(backend),
+                           enable_cache=enable_cache,
+                           callback_manager=callback_manager)
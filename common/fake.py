@@ -0,0 +1,122 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from typing import Any, List
+
+import numpy as np
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding, Embedding
+from llama_index.llms import CompletionResponse, CompletionResponseGen, CustomLLM, LLMMetadata
+from llama_index.llms.base import llm_completion_callback
+
+from common.config import FAKE_EMBED_LATENCY, FAKE_LLM_LATENCY
+
+_DOC_RE = re.compile(r"^Document (\d+):", re.MULTILINE)
+
+
+def _digest(text: str) -> bytes:
+    return hashlib.md5(text.encode("utf-8")).digest()
+
+
+class FakeLLM(CustomLLM):
+    """本地的模拟llm，用于离线的benchmark和测试：每次调用固定耗时 latency 秒，相同的prompt总是得到相同的回答
+
+    rerank(choice select) 和 selector 的prompt返回可以被解析的格式，其余prompt返回prompt开头的一段文本
+    """
+    latency: float = Field(default=FAKE_LLM_LATENCY)
+    response_chars: int = Field(default=200)
+    context_window: int = Field(default=4096)
+    _calls: int = PrivateAttr(default=0)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FakeLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(context_window=self.context_window, num_output=256, model_name="fake")
+
+    @property
+    def calls(self) -> int:
+        return self._calls
+
+    def _respond(self, prompt: str) -> str:
+        with self._lock:
+            self._calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        digest = _digest(prompt)
+        if "Relevance:" in prompt:
+            # 示例里的 Document 编号也会被匹配到，超出本批数量的编号在解析时会被忽略
+            num_docs = max((int(n) for n in _DOC_RE.findall(prompt)), default=1)
+            return "\n".join(f"Doc: {i}, Relevance: {digest[i % len(digest)] % 10 + 1}"
+                             for i in range(1, num_docs + 1))
+        if "choice:" in prompt and "reason:" in prompt:
+            return json.dumps([{"choice": 1, "reason": "fake"}])
+        return f"{digest.hex()[:8]} {prompt.strip()[:self.response_chars]}"
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
+        return CompletionResponse(text=self._respond(prompt))
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, **kwargs: Any) -> CompletionResponseGen:
+        text = self._respond(prompt)
+
+        def gen() -> CompletionResponseGen:
+            for i in range(0, len(text), 16):
+                yield CompletionResponse(text=text[: i + 16], delta=text[i: i + 16])
+
+        return gen()
+
+
+class FakeEmbedding(BaseEmbedding):
+    """本地的模拟embedding：字符bigram哈希到 embed_dim 维再归一化，包含相同词语的文本相似度更高
+
+    每次批量请求固定耗时 latency 秒
+    """
+    embed_dim: int = Field(default=256)
+    latency: float = Field(default=FAKE_EMBED_LATENCY)
+    _calls: int = PrivateAttr(default=0)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(model_name="fake", **kwargs)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "FakeEmbedding"
+
+    @property
+    def calls(self) -> int:
+        return self._calls
+
+    def _embed(self, text: str) -> Embedding:
+        vector = np.zeros(self.embed_dim, dtype=np.float32)
+        for i in range(max(len(text) - 1, 1)):
+            bucket = int.from_bytes(_digest(text[i: i + 2])[:4], "little")
+            vector[bucket % self.embed_dim] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        with self._lock:
+            self._calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._get_text_embeddings([query])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embedding(text)
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        return self._get_query_embedding(query)
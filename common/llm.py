@@ -1,13 +1,17 @@
+import asyncio
 import hashlib
 import json
 import os.path
-import pickle
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from dataclasses import dataclass
+from enum import Enum
 from functools import wraps
-from typing import Any, Dict, Optional, Sequence, Tuple
+from typing import Any, AsyncGenerator, Dict, Generator, Optional, Sequence, Tuple
 
 from llama_index.bridge.pydantic import Field
-from llama_index.callbacks import CallbackManager
+from llama_index.callbacks import CallbackManager, CBEventType, EventPayload
 from llama_index.llms import (
     ChatMessage,
     ChatResponse,
@@ -20,38 +24,79 @@ from llama_index.llms import (
 )
 from llama_index.llms.base import LLM
 
-from common.config import OPENAI_API_KEY, ROOT_PATH
-from common.utils import ObjectEncoder
+from common.cache import BaseCacheStore, CacheItem, create_cache_store, default_budget, versioned_dir
+from common.config import LLM_BACKEND, LLM_CACHE_BACKEND, LLM_CACHE_DIR, LLM_MAX_CONCURRENCY, OPENAI_API_KEY
+from common.fake import FakeLLM
+from common.metrics import CACHE_HIT
+from common.single_flight import SingleFlight
+
+
+# 这些参数只影响调用方式(超时、回调)，不影响llm的输出，不参与缓存的key
+_IGNORED_KWARGS = frozenset(["callback_manager", "request_timeout", "timeout"])
+# llm上只影响请求怎么发送(服务地址、重试、模拟的耗时)的字段，不参与缓存的key
+_TRANSPORT_PARAMS = frozenset(["callback_manager", "api_key", "api_base", "api_type", "api_version", "max_retries",
+                               "timeout", "request_timeout", "latency"])
+
+
+def _canonical(obj: Any) -> Any:
+    # json.dumps 遇到不能直接序列化的对象时调用，只保留和llm输出有关的字段
+    if isinstance(obj, ChatMessage):
+        ret = {"role": obj.role.value, "content": obj.content}
+        if obj.additional_kwargs:
+            ret["additional_kwargs"] = obj.additional_kwargs
+        return ret
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=str)
+    if isinstance(obj, CallbackManager):
+        return None
+    if hasattr(obj, "__dict__"):
+        return {k: v for k, v in vars(obj).items() if not k.startswith("_") and k not in _IGNORED_KWARGS}
+    return str(obj)
 
 
 @dataclass
 class CacheRequest:
+    """缓存的key：方法名、模型参数(model/temperature/max_tokens等)和调用参数
+
+    规范化成按key排序的json，不依赖dict顺序和对象上无关的字段，每个请求只序列化一次
+    """
     func: str
     args: Optional[Tuple]
     kwargs: Optional[Dict]
+    params: Optional[Dict] = None
 
-    def __init__(self, func, *args, **kwargs):
-        self.func = func
-        self.args = args
-        self.kwargs = kwargs
+    def __post_init__(self):
+        self._dump: Optional[bytes] = None
+        self._key: Optional[str] = None
 
     def dump(self) -> bytes:
-        return json.dumps(self, cls=ObjectEncoder, ensure_ascii=False).encode('utf-8')
+        # 旧版本pickle的 CacheRequest 没有这些属性
+        if getattr(self, "_dump", None) is None:
+            self._dump = json.dumps({
+                "func": self.func,
+                "params": getattr(self, "params", None) or {},
+                "args": self.args or [],
+                "kwargs": {k: v for k, v in (self.kwargs or {}).items() if k not in _IGNORED_KWARGS},
+            }, default=_canonical, sort_keys=True, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        return self._dump
 
-
-@dataclass
-class CacheItem:
-    request: CacheRequest
-    response: Optional[object]
+    @property
+    def key(self) -> str:
+        if getattr(self, "_key", None) is None:
+            self._key = hashlib.md5(self.dump()).hexdigest()
+        return self._key
 
 
 def cached_call(method):
     @wraps(method)
     def wrapper(self, *args, **kwargs):
-        cache_req = CacheRequest(method.__name__, *args, **kwargs)
+        cache_req = self._cache_request(method.__name__, args, kwargs)
         if self.enable_cache:
             cache_item = self._get_cache(cache_req)
             if cache_item.response:
+                self._on_cache_hit(cache_item.response)
                 return cache_item.response
         response = method(self, *args, **kwargs)
         self._save_cache(cache_req, response)
@@ -60,16 +105,84 @@ def cached_call(method):
     return wrapper
 
 
+def acached_call(cache_func: str):
+    # 异步方法和对应的同步方法结果相同，用同一个 cache_func 共用一份缓存
+    def decorator(method):
+        @wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            cache_req = self._cache_request(cache_func, args, kwargs)
+            if self.enable_cache:
+                cache_item = self._get_cache(cache_req)
+                if cache_item.response:
+                    self._on_cache_hit(cache_item.response)
+                    return cache_item.response
+            response = await method(self, *args, **kwargs)
+            self._save_cache(cache_req, response)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+class RequestLimiter:
+    """限制同时发往后端(llm和embedding)的请求数，同步调用和所有event loop里的异步调用共用 max_concurrency 个名额"""
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        # 异步调用拿不到名额时在这里的线程里等待，不阻塞event loop
+        self._waiters = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="request-limiter")
+
+    @contextmanager
+    def sync_slot(self):
+        with self._semaphore:
+            yield
+
+    def _release_if_acquired(self, future: Future):
+        if not future.cancelled() and future.exception() is None and future.result():
+            self._semaphore.release()
+
+    @asynccontextmanager
+    async def async_slot(self):
+        if not self._semaphore.acquire(blocking=False):
+            future = self._waiters.submit(self._semaphore.acquire)
+            try:
+                await asyncio.shield(asyncio.wrap_future(future))
+            except asyncio.CancelledError:
+                # 调用方被取消后等待的线程仍然会拿到名额，拿到后在等待的线程里立即归还(event loop可能已经关闭)
+                future.add_done_callback(self._release_if_acquired)
+                raise
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+
+# 进程内所有 CachedLLM 和 CachedEmbedding 共用一个限流器
+default_request_limiter = RequestLimiter(LLM_MAX_CONCURRENCY)
+default_single_flight = SingleFlight()
+
+
 class CachedLLM(LLM):
     llm: LLM = Field()
     root_dir: str = Field()
     request_timeout: int = Field()
     enable_cache: bool = Field()
+    cache_store: BaseCacheStore = Field(exclude=True)
+    limiter: RequestLimiter = Field(exclude=True)
+    single_flight: SingleFlight = Field(exclude=True)
 
-    def __init__(self, llm: LLM, root_dir: str, request_timeout=60, enable_cache: bool = False, **data: Any):
+    def __init__(self, llm: LLM, root_dir: str, request_timeout=60, enable_cache: bool = False,
+                 cache_store: Optional[BaseCacheStore] = None, limiter: Optional[RequestLimiter] = None,
+                 single_flight: Optional[SingleFlight] = None, **data: Any):
         if not os.path.exists(root_dir):
             os.makedirs(root_dir, exist_ok=True)
-        super().__init__(llm=llm, root_dir=root_dir, request_timeout=request_timeout, enable_cache=enable_cache, **data)
+        if cache_store is None:
+            cache_store = create_cache_store(versioned_dir(root_dir), LLM_CACHE_BACKEND, budget=default_budget())
+        super().__init__(llm=llm, root_dir=root_dir, request_timeout=request_timeout, enable_cache=enable_cache,
+                         cache_store=cache_store, limiter=limiter or default_request_limiter,
+                         single_flight=single_flight or default_single_flight, **data)
 
     @classmethod
     def class_name(cls) -> str:
@@ -79,67 +192,138 @@ class CachedLLM(LLM):
     def metadata(self) -> LLMMetadata:
         return self.llm.metadata
 
+    def _cache_request(self, func: str, args: Tuple, kwargs: Dict) -> CacheRequest:
+        # 所有影响输出的模型参数都参与缓存的key，只影响请求怎么发送的参数除外
+        params = {k: v for k, v in self.llm.dict().items() if k not in _TRANSPORT_PARAMS}
+        params["class_name"] = self.llm.class_name()
+        params["model"] = self.llm.metadata.model_name
+        return CacheRequest(func, args, kwargs, params)
+
     def _get_cache(
             self,
             req: CacheRequest,
     ) -> CacheItem:
         req_dump = req.dump()
-        md5 = hashlib.md5(req_dump).hexdigest()
-        cache_path = os.path.join(self.root_dir, md5)
-        if os.path.exists(cache_path):
-            with open(cache_path, "rb") as f:
-                cache_item: CacheItem = pickle.load(f)
-                if cache_item.request.dump() == req_dump:
-                    return cache_item
-                else:
-                    print("llm cache request hash conflict: %s != %s", req, cache_item.request)
-        return CacheItem(req, None)
+        cache_item = self.cache_store.get(req.key)
+        if cache_item is not None:
+            if cache_item.request == req_dump:
+                self.cache_store.stats.record(req.func, "hits")
+                return cache_item
+            else:
+                print("llm cache request hash conflict: %s != %s", req_dump, cache_item.request)
+        self.cache_store.stats.record(req.func, "misses")
+        return CacheItem(req_dump, None)
 
     def _save_cache(self, cache_request: CacheRequest, response: object):
-        md5 = hashlib.md5(cache_request.dump()).hexdigest()
-        cache_path = os.path.join(self.root_dir, md5)
-        with open(cache_path, "wb") as f:
-            pickle.dump(CacheItem(cache_request, response), f)
+        self.cache_store.put(cache_request.key, CacheItem(cache_request.dump(), response, cache_request.func))
+        self.cache_store.stats.record(cache_request.func, "puts")
+
+    def _on_cache_hit(self, response: object):
+        # 命中缓存时不会调用底层llm，这里补发一个LLM事件，指标里可以统计缓存命中次数
+        with self.callback_manager.event(CBEventType.LLM) as event:
+            event.on_end(payload={EventPayload.RESPONSE: response, CACHE_HIT: True})
 
     @cached_call
     def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
-        return self.llm.chat(messages, request_timeout=self.request_timeout, timeout=self.request_timeout, **kwargs)
+        with self.limiter.sync_slot():
+            return self.llm.chat(messages, request_timeout=self.request_timeout, timeout=self.request_timeout,
+                                 **kwargs)
 
     @cached_call
     def complete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
-        return self.llm.complete(prompt, request_timeout=self.request_timeout, timeout=self.request_timeout, **kwargs)
+        with self.limiter.sync_slot():
+            return self.llm.complete(prompt, request_timeout=self.request_timeout, timeout=self.request_timeout,
+                                     **kwargs)
+
+    def _cached_stream(self, cache_func: str, stream_fn, *args, **kwargs) -> Generator:
+        # 流式结果边产生边记录，流结束后整体写入缓存，下次相同请求直接回放
+        cache_req = self._cache_request(cache_func, args, kwargs)
+        if self.enable_cache:
+            cache_item = self._get_cache(cache_req)
+            if cache_item.response:
+                self._on_cache_hit(cache_item.response[-1])
+                return (chunk for chunk in cache_item.response)
+
+        def open_stream():
+            with self.limiter.sync_slot():
+                yield from stream_fn(*args, request_timeout=self.request_timeout, timeout=self.request_timeout,
+                                     **kwargs)
+
+        # 并发的相同请求(例如用户重试)共享同一个上游流
+        key = cache_req.key
+        return self.single_flight.stream(key, open_stream, lambda chunks: self._save_cache(cache_req, chunks))
 
     def stream_chat(
             self, messages: Sequence[ChatMessage], **kwargs: Any
     ) -> ChatResponseGen:
-        return self.llm.stream_chat(messages)
+        return self._cached_stream("stream_chat", self.llm.stream_chat, messages, **kwargs)
 
     def stream_complete(self, prompt: str, **kwargs: Any) -> CompletionResponseGen:
-        return self.llm.stream_complete(prompt, **kwargs)
+        return self._cached_stream("stream_complete", self.llm.stream_complete, prompt, **kwargs)
 
+    @acached_call("chat")
     async def achat(
             self, messages: Sequence[ChatMessage], **kwargs: Any
     ) -> ChatResponse:
-        return await self.achat(messages, **kwargs)
+        async with self.limiter.async_slot():
+            return await self.llm.achat(messages, request_timeout=self.request_timeout,
+                                        timeout=self.request_timeout, **kwargs)
 
+    @acached_call("complete")
     async def acomplete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
-        return await self.acomplete(prompt, **kwargs)
+        async with self.limiter.async_slot():
+            return await self.llm.acomplete(prompt, request_timeout=self.request_timeout,
+                                            timeout=self.request_timeout, **kwargs)
+
+    def _acached_stream(self, cache_func: str, stream_fn, *args, **kwargs) -> AsyncGenerator:
+        # 异步流和同步流的结果相同，共用一份缓存
+        cache_req = self._cache_request(cache_func, args, kwargs)
+        if self.enable_cache:
+            cache_item = self._get_cache(cache_req)
+            if cache_item.response:
+                self._on_cache_hit(cache_item.response[-1])
+                return _areplay(cache_item.response)
+
+        async def open_stream():
+            # 流式请求在整个流读完之前都占用一个并发名额
+            async with self.limiter.async_slot():
+                gen = await stream_fn(*args, request_timeout=self.request_timeout, timeout=self.request_timeout,
+                                      **kwargs)
+                async for chunk in gen:
+                    yield chunk
+
+        key = cache_req.key
+        return self.single_flight.astream(key, open_stream, lambda chunks: self._save_cache(cache_req, chunks))
 
     async def astream_chat(
             self, messages: Sequence[ChatMessage], **kwargs: Any
     ) -> ChatResponseAsyncGen:
-        return await self.astream_chat(messages, **kwargs)
+        return self._acached_stream("stream_chat", self.llm.astream_chat, messages, **kwargs)
 
     async def astream_complete(
             self, prompt: str, **kwargs: Any
     ) -> CompletionResponseAsyncGen:
-        return await self.astream_complete(prompt, **kwargs)
+        return self._acached_stream("stream_complete", self.llm.astream_complete, prompt, **kwargs)
+
 
+async def _areplay(chunks) -> AsyncGenerator:
+    for chunk in chunks:
+        yield chunk
 
-def create_llm(callback_manager: CallbackManager = None, enable_cache: bool = True, timeout=15):
-    _llm_gpt3 = OpenAI(temperature=0, model="gpt-3.5-turbo", callback_manager=callback_manager, api_key=OPENAI_API_KEY)
-    return CachedLLM(_llm_gpt3,
-                     os.path.join(ROOT_PATH, '.llm_cache'),
+
+def cache_dir(backend: str = LLM_BACKEND) -> str:
+    # 不同后端的缓存分目录存放，可以单独清理
+    return LLM_CACHE_DIR if backend == 'openai' else os.path.join(LLM_CACHE_DIR, backend)
+
+
+def create_llm(callback_manager: CallbackManager = None, enable_cache: bool = True, timeout=15,
+               backend: str = LLM_BACKEND):
+    if backend == 'fake':
+        llm = FakeLLM(callback_manager=callback_manager)
+    else:
+        llm = OpenAI(temperature=0, model="gpt-3.5-turbo", callback_manager=callback_manager, api_key=OPENAI_API_KEY)
+    return CachedLLM(llm,
+                     cache_dir(backend),
                      request_timeout=timeout,
                      enable_cache=enable_cache)
 
@@ -149,3 +333,8 @@ def llm_predict(llm: LLM, content: str):
         content=content
     )])
     return response.message.content
+
+
+def llm_stream_predict(llm: LLM, content: str) -> Generator[str, None, None]:
+    for response in llm.stream_chat([ChatMessage(content=content)]):
+        yield response.delta or ""
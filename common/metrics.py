@@ -0,0 +1,175 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from llama_index.callbacks import CBEventType
+from llama_index.callbacks.base_handler import BaseCallbackHandler
+from llama_index.callbacks.schema import BASE_TRACE_EVENT, EventPayload
+from llama_index.callbacks.token_counting import get_llm_token_counts
+from llama_index.utils import globals_helper
+
+# CachedLLM 命中缓存时也会发出一个LLM事件，payload里带上这个key，不算作真正的llm调用
+CACHE_HIT = "cache_hit"
+# 耗时直方图的桶(秒)，和 Prometheus client 的默认值一致
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0, float("inf"))
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self) -> List[int]:
+        ret, total = [], 0
+        for count in self.counts:
+            total += count
+            ret.append(total)
+        return ret
+
+
+@dataclass
+class LLMStats:
+    calls: int = 0
+    cache_hits: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    def add(self, other: "LLMStats"):
+        self.calls += other.calls
+        self.cache_hits += other.cache_hits
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+
+
+@dataclass
+class _QueryRecord:
+    query: str
+    start: float
+    stage_seconds: Dict[str, float] = field(default_factory=lambda: defaultdict(float))
+    stage_counts: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    llm: Dict[str, LLMStats] = field(default_factory=lambda: defaultdict(LLMStats))
+
+
+class MetricsHandler(BaseCallbackHandler):
+    """轻量的指标收集：每种事件(query/retrieve/reranking/synthesize/llm/embedding...)的耗时直方图，
+    以及按所在阶段统计的llm调用次数、prompt/completion token数和缓存命中数
+
+    不保存事件的payload，token数优先使用llm返回的usage，没有时才用tokenizer计算
+    jsonl_file 不为空时，每个顶层query结束后追加一行这个query各阶段的汇总
+    """
+
+    def __init__(self, jsonl_file: Optional[str] = None, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(event_starts_to_ignore=[CBEventType.EXCEPTION], event_ends_to_ignore=[])
+        self.jsonl_file = jsonl_file
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.durations: Dict[str, Histogram] = {}
+        self.llm: Dict[str, LLMStats] = defaultdict(LLMStats)
+        # event_id -> (事件类型, 开始时间, 父事件id, 顶层事件id)
+        self._events: Dict[str, Tuple[str, float, str, str]] = {}
+        self._records: Dict[str, _QueryRecord] = {}
+
+    def on_event_start(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None, event_id: str = "",
+                       parent_id: str = "", **kwargs: Any) -> str:
+        parent = self._events.get(parent_id)
+        root_id = parent[3] if parent else event_id
+        self._events[event_id] = (event_type.value, time.perf_counter(), parent_id, root_id)
+        if parent is None and event_type == CBEventType.QUERY and self.jsonl_file:
+            query = str((payload or {}).get(EventPayload.QUERY_STR, ""))
+            self._records[event_id] = _QueryRecord(query=query, start=time.time())
+        return event_id
+
+    def on_event_end(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None, event_id: str = "",
+                     **kwargs: Any) -> None:
+        event = self._events.pop(event_id, None)
+        if event is None:
+            return
+        stage, start, parent_id, root_id = event
+        seconds = time.perf_counter() - start
+        record = self._records.get(root_id)
+        llm_stats = None
+        if event_type == CBEventType.LLM:
+            # llm调用计到它所在的阶段(父事件的类型)上，例如 reranking、synthesize
+            parent = self._events.get(parent_id)
+            stage = parent[0] if parent else BASE_TRACE_EVENT
+            llm_stats = self._llm_stats(payload or {})
+        # 命中缓存的LLM事件只计数，不计入耗时
+        timed = llm_stats is None or not llm_stats.cache_hits
+        with self._lock:
+            if timed:
+                if event_type.value not in self.durations:
+                    self.durations[event_type.value] = Histogram(self.buckets)
+                self.durations[event_type.value].observe(seconds)
+            if llm_stats is not None:
+                self.llm[stage].add(llm_stats)
+            if record is not None:
+                if timed:
+                    record.stage_seconds[event_type.value] += seconds
+                    record.stage_counts[event_type.value] += 1
+                if llm_stats is not None:
+                    record.llm[stage].add(llm_stats)
+        if record is not None and event_id == root_id:
+            self._write_record(self._records.pop(root_id))
+
+    @staticmethod
+    def _llm_stats(payload: Dict[str, Any]) -> LLMStats:
+        if payload.get(CACHE_HIT):
+            return LLMStats(cache_hits=1)
+        response = payload.get(EventPayload.RESPONSE) or payload.get(EventPayload.COMPLETION)
+        raw = getattr(response, "raw", None) or {}
+        usage = raw.get("usage") if isinstance(raw, dict) else None
+        if usage:
+            return LLMStats(calls=1, prompt_tokens=usage.get("prompt_tokens", 0),
+                            completion_tokens=usage.get("completion_tokens", 0))
+        try:
+            counts = get_llm_token_counts(globals_helper.tokenizer, payload)
+        except ValueError:
+            return LLMStats(calls=1)
+        return LLMStats(calls=1, prompt_tokens=counts.prompt_token_count,
+                        completion_tokens=counts.completion_token_count)
+
+    def _write_record(self, record: _QueryRecord):
+        line = json.dumps({
+            "time": record.start,
+            "query": record.query,
+            "stages": {stage: {"count": record.stage_counts[stage], "seconds": round(seconds, 6)}
+                       for stage, seconds in record.stage_seconds.items()},
+            "llm": {stage: vars(stats) for stage, stats in record.llm.items()},
+        }, ensure_ascii=False)
+        with self._lock:
+            with open(self.jsonl_file, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(self, trace_id: Optional[str] = None, trace_map: Optional[Dict[str, List[str]]] = None) -> None:
+        pass
+
+    def to_prometheus(self, prefix: str = "rag") -> str:
+        """导出为 Prometheus 的文本格式"""
+        lines = [f"# TYPE {prefix}_stage_duration_seconds histogram"]
+        with self._lock:
+            for stage, histogram in sorted(self.durations.items()):
+                for le, count in zip(histogram.buckets, histogram.cumulative_counts()):
+                    le_str = "+Inf" if le == float("inf") else repr(le)
+                    lines.append(f'{prefix}_stage_duration_seconds_bucket{{stage="{stage}",le="{le_str}"}} {count}')
+                lines.append(f'{prefix}_stage_duration_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{prefix}_stage_duration_seconds_count{{stage="{stage}"}} {histogram.count}')
+            for name, attr in [("llm_calls", "calls"), ("llm_cache_hits", "cache_hits"),
+                               ("llm_prompt_tokens", "prompt_tokens"), ("llm_completion_tokens", "completion_tokens")]:
+                lines.append(f"# TYPE {prefix}_{name}_total counter")
+                for stage, stats in sorted(self.llm.items()):
+                    lines.append(f'{prefix}_{name}_total{{stage="{stage}"}} {getattr(stats, attr)}')
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,134 @@
+import asyncio
+import contextvars
+import threading
+import weakref
+from typing import AsyncGenerator, Callable, Dict, Generator, Hashable, List
+
+
+class StreamFlight:
+    """一个上游流在后台线程中读取，多个读者各自从头回放已经收到的chunk"""
+
+    def __init__(self):
+        self.chunks: List = []
+        self.done = False
+        self.error = None
+        self._cond = threading.Condition()
+
+    def run(self, stream_factory: Callable[[], Generator], on_complete: Callable[[List], None]):
+        try:
+            for chunk in stream_factory():
+                with self._cond:
+                    self.chunks.append(chunk)
+                    self._cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+        if self.error is None:
+            on_complete(self.chunks)
+
+    def subscribe(self) -> Generator:
+        i = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: i < len(self.chunks) or self.done)
+                if i < len(self.chunks):
+                    chunk = self.chunks[i]
+                    i += 1
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+            yield chunk
+
+
+class AsyncStreamFlight:
+    """StreamFlight 的异步版本，上游在同一个event loop的后台task中读取"""
+
+    def __init__(self):
+        self.chunks: List = []
+        self.done = False
+        self.error = None
+        self.task = None
+        self._cond = asyncio.Condition()
+
+    async def run(self, stream_factory: Callable[[], AsyncGenerator], on_complete: Callable[[List], None]):
+        try:
+            async for chunk in stream_factory():
+                async with self._cond:
+                    self.chunks.append(chunk)
+                    self._cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            async with self._cond:
+                self.done = True
+                self._cond.notify_all()
+        if self.error is None:
+            on_complete(self.chunks)
+
+    async def subscribe(self) -> AsyncGenerator:
+        i = 0
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: i < len(self.chunks) or self.done)
+                if i < len(self.chunks):
+                    chunk = self.chunks[i]
+                    i += 1
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+            yield chunk
+
+
+class SingleFlight:
+    """相同key的并发流式请求共享同一个上游流"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, StreamFlight] = {}
+        # 异步的flight只能在创建它的event loop里使用
+        self._async_flights: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    def stream(self, key: Hashable, stream_factory: Callable[[], Generator],
+               on_complete: Callable[[List], None]) -> Generator:
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = StreamFlight()
+                self._flights[key] = flight
+                # 上游流沿用发起请求时的contextvars，callback事件的父事件和指标能对应到这次query
+                threading.Thread(target=contextvars.copy_context().run,
+                                 args=(self._run, key, flight, stream_factory, on_complete), daemon=True).start()
+        return flight.subscribe()
+
+    def _run(self, key, flight: StreamFlight, stream_factory, on_complete):
+        try:
+            flight.run(stream_factory, on_complete)
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    def astream(self, key: Hashable, stream_factory: Callable[[], AsyncGenerator],
+                on_complete: Callable[[List], None]) -> AsyncGenerator:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            flights = self._async_flights.setdefault(loop, {})
+            flight = flights.get(key)
+            if flight is None:
+                flight = AsyncStreamFlight()
+                flights[key] = flight
+                flight.task = loop.create_task(self._arun(flights, key, flight, stream_factory, on_complete))
+        return flight.subscribe()
+
+    async def _arun(self, flights: Dict, key, flight: AsyncStreamFlight, stream_factory, on_complete):
+        try:
+            await flight.run(stream_factory, on_complete)
+        finally:
+            with self._lock:
+                if flights.get(key) is flight:
+                    del flights[key]
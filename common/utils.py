@@ -1,7 +1,14 @@
+import contextvars
 import json
+from concurrent.futures import Executor, Future
 from typing import List
 
+from llama_index.data_structs.data_structs import IndexGraph
 from llama_index.indices.base import BaseIndex
+from llama_index.schema import MetadataMode
+from llama_index.storage.docstore import BaseDocumentStore
+
+from common.config import CITY_PROFILE_CHARS
 
 
 class ObjectEncoder(json.JSONEncoder):
@@ -14,3 +21,15 @@ def find_typed(objs: List, typ):
         if isinstance(obj, typ):
             return obj
     raise Exception(f"Can't found type={typ.__name__}")
+
+
+def submit_with_context(executor: Executor, fn, *args, **kwargs) -> Future:
+    # 任务在线程池里沿用提交时的contextvars，callback事件的父事件(trace stack)在线程之间保持正确
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def city_profile(city: str, index_graph: IndexGraph, docstore: BaseDocumentStore) -> str:
+    # 城市名加上 TreeIndex 根节点的summary，不同城市的简介内容不同，embedding的区分度比统一模板的描述高
+    summaries = [docstore.get_node(node_id).get_content(metadata_mode=MetadataMode.NONE)
+                 for node_id in index_graph.root_nodes.values()]
+    return f"{city}：{' '.join(summaries)}"[:CITY_PROFILE_CHARS]
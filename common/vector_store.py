@@ -0,0 +1,210 @@
+import json
+import os
+import threading
+import uuid
+from typing import Any, Dict, List, Optional
+
+import fsspec
+import numpy as np
+from llama_index import StorageContext
+from llama_index.schema import BaseNode
+from llama_index.vector_stores import SimpleVectorStore
+from llama_index.vector_stores.types import (
+    DEFAULT_PERSIST_FNAME,
+    VectorStore,
+    VectorStoreQuery,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+
+from common.cache import file_lock
+
+# 旧版本固定的矩阵文件名，现在每次持久化写入一个新的 vector_store.<随机串>.npy，由ids文件记录使用哪一个
+MATRIX_FNAME = "vector_store.npy"
+IDS_FNAME = "vector_store_ids.json"
+# 多个进程写同一个索引目录时用这个锁文件串行执行
+LOCK_FNAME = ".vector_store.lock"
+# 加载时矩阵文件刚好被并发的写入替换掉，重新读取的次数
+LOAD_RETRIES = 3
+
+
+def _current_matrix_fname(persist_dir: str) -> Optional[str]:
+    try:
+        with open(os.path.join(persist_dir, IDS_FNAME)) as f:
+            return json.load(f).get("matrix", MATRIX_FNAME)
+    except FileNotFoundError:
+        return None
+
+
+class NumpyVectorStore(VectorStore):
+    """embedding保存为一个连续的float32矩阵(.npy)，加载时用mmap打开，查询时用矩阵乘法+argpartition取top k
+
+    向量在写入时就做了归一化，点积即为cosine相似度，和 SimpleVectorStore 的默认打分一致
+    """
+
+    stores_text: bool = False
+
+    def __init__(self, matrix: Optional[np.ndarray] = None, ids: Optional[List[str]] = None,
+                 ref_doc_ids: Optional[List[str]] = None) -> None:
+        self._lock = threading.RLock()
+        self._matrix = matrix
+        self._ids: List[str] = list(ids or [])
+        self._ref_doc_ids: List[str] = list(ref_doc_ids or ["None"] * len(self._ids))
+        self._id_to_pos: Dict[str, int] = {node_id: pos for pos, node_id in enumerate(self._ids)}
+        # 新增和删除先记录下来，查询或者持久化之前再合并成一个矩阵
+        self._pending: List[np.ndarray] = []
+        self._deleted: set = set()
+
+    @property
+    def client(self) -> None:
+        return
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def _consolidate(self):
+        if not self._pending and not self._deleted:
+            return
+        parts = [self._matrix] if self._matrix is not None and len(self._matrix) else []
+        matrix = np.vstack(parts + self._pending).astype(np.float32, copy=False)
+        keep = [pos for pos in range(len(self._ids)) if pos not in self._deleted]
+        self._matrix = np.ascontiguousarray(matrix[keep]) if self._deleted else matrix
+        self._ids = [self._ids[pos] for pos in keep]
+        self._ref_doc_ids = [self._ref_doc_ids[pos] for pos in keep]
+        self._id_to_pos = {node_id: pos for pos, node_id in enumerate(self._ids)}
+        self._pending = []
+        self._deleted = set()
+
+    def add(self, nodes: List[BaseNode]) -> List[str]:
+        if not nodes:
+            return []
+        with self._lock:
+            # 相同id重复写入时覆盖旧的向量
+            self.delete_nodes([node.node_id for node in nodes if node.node_id in self._id_to_pos])
+            vectors = np.asarray([node.get_embedding() for node in nodes], dtype=np.float32)
+            self._pending.append(self._normalize(vectors))
+            for node in nodes:
+                self._id_to_pos[node.node_id] = len(self._ids)
+                self._ids.append(node.node_id)
+                self._ref_doc_ids.append(node.ref_doc_id or "None")
+        return [node.node_id for node in nodes]
+
+    def delete_nodes(self, node_ids: List[str]) -> None:
+        with self._lock:
+            for node_id in node_ids:
+                pos = self._id_to_pos.pop(node_id, None)
+                if pos is not None:
+                    self._deleted.add(pos)
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        with self._lock:
+            self.delete_nodes([node_id for node_id, ref in zip(self._ids, self._ref_doc_ids) if ref == ref_doc_id])
+
+    def get(self, text_id: str) -> List[float]:
+        with self._lock:
+            self._consolidate()
+            return self._matrix[self._id_to_pos[text_id]].tolist()
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"NumpyVectorStore does not support query mode {query.mode}")
+        if query.filters is not None:
+            raise ValueError("NumpyVectorStore does not support metadata filters")
+        with self._lock:
+            self._consolidate()
+            matrix, ids, ref_doc_ids = self._matrix, self._ids, self._ref_doc_ids
+        if matrix is None or len(ids) == 0:
+            return VectorStoreQueryResult(nodes=None, similarities=[], ids=[])
+        query_embedding = self._normalize(np.asarray(query.query_embedding, dtype=np.float32))
+        scores = matrix @ query_embedding
+        if query.node_ids is not None or query.doc_ids is not None:
+            node_ids = set(query.node_ids or ids)
+            doc_ids = set(query.doc_ids) if query.doc_ids is not None else None
+            mask = np.array([node_id in node_ids and (doc_ids is None or ref in doc_ids)
+                             for node_id, ref in zip(ids, ref_doc_ids)])
+            scores = np.where(mask, scores, -np.inf)
+        top_k = min(query.similarity_top_k, int(np.isfinite(scores).sum()))
+        if top_k <= 0:
+            return VectorStoreQueryResult(nodes=None, similarities=[], ids=[])
+        top_idx = np.argpartition(-scores, top_k - 1)[:top_k]
+        top_idx = top_idx[np.argsort(-scores[top_idx], kind="stable")]
+        return VectorStoreQueryResult(nodes=None, similarities=scores[top_idx].tolist(),
+                                      ids=[ids[i] for i in top_idx])
+
+    def persist(self, persist_path: str, fs: Optional[fsspec.AbstractFileSystem] = None) -> None:
+        # StorageContext.persist 传入的是 vector_store.json 的路径，这里只取目录
+        persist_dir = os.path.dirname(persist_path)
+        os.makedirs(persist_dir, exist_ok=True)
+        with file_lock(os.path.join(persist_dir, LOCK_FNAME)):
+            self._persist_locked(persist_dir)
+
+    def _persist_locked(self, persist_dir: str):
+        with self._lock:
+            self._consolidate()
+            matrix = self._matrix if self._matrix is not None else np.zeros((0, 0), dtype=np.float32)
+            old_matrix_fname = _current_matrix_fname(persist_dir)
+            # 矩阵写入新文件，ids文件rename的那一刻矩阵和ids一起生效，中途中断时读到的仍然是旧的一对
+            matrix_fname = f"vector_store.{uuid.uuid4().hex}.npy"
+            with open(os.path.join(persist_dir, matrix_fname), "wb") as f:
+                np.save(f, matrix)
+            tmp_path = os.path.join(persist_dir, f".{IDS_FNAME}.{uuid.uuid4().hex}.tmp")
+            with open(tmp_path, "w") as f:
+                json.dump({"matrix": matrix_fname, "ids": self._ids, "ref_doc_ids": self._ref_doc_ids}, f,
+                          ensure_ascii=False)
+            os.replace(tmp_path, os.path.join(persist_dir, IDS_FNAME))
+        # 只删除被替换掉的矩阵，正在mmap旧文件的进程不受影响
+        if old_matrix_fname is not None and old_matrix_fname != matrix_fname:
+            try:
+                os.remove(os.path.join(persist_dir, old_matrix_fname))
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def from_simple_vector_store(cls, simple_store: SimpleVectorStore) -> "NumpyVectorStore":
+        data = simple_store._data
+        ids = list(data.embedding_dict.keys())
+        if not ids:
+            return cls()
+        matrix = np.asarray([data.embedding_dict[node_id] for node_id in ids], dtype=np.float32)
+        return cls(matrix=cls._normalize(matrix), ids=ids,
+                   ref_doc_ids=[data.text_id_to_ref_doc_id.get(node_id, "None") for node_id in ids])
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir: str) -> "NumpyVectorStore":
+        ids_path = os.path.join(persist_dir, IDS_FNAME)
+        if not os.path.exists(ids_path):
+            # 旧版本构建的索引只有 vector_store.json，只在内存里转换，查询时不写索引目录(可能是只读的)
+            return cls.from_simple_vector_store(
+                SimpleVectorStore.from_persist_path(os.path.join(persist_dir, DEFAULT_PERSIST_FNAME)))
+        for attempt in range(LOAD_RETRIES):
+            with open(ids_path) as f:
+                meta = json.load(f)
+            try:
+                # 空矩阵没有办法mmap
+                matrix = np.load(os.path.join(persist_dir, meta.get("matrix", MATRIX_FNAME)),
+                                 mmap_mode="r" if meta["ids"] else None)
+                break
+            except FileNotFoundError:
+                # 读完ids文件之后其他进程写入了新的矩阵，旧的已经删除，重新读取ids文件
+                if attempt == LOAD_RETRIES - 1:
+                    raise
+        if len(matrix) != len(meta["ids"]):
+            raise ValueError(f"Vector store in {persist_dir} is broken: {len(matrix)} vectors, {len(meta['ids'])} ids")
+        return cls(matrix=matrix, ids=meta["ids"], ref_doc_ids=meta["ref_doc_ids"])
+
+
+def migrate_legacy_vector_store(persist_dir: str) -> bool:
+    """构建时把旧版本索引的 vector_store.json 转换为npy格式，之后查询时可以mmap加载；返回是否做了转换"""
+    with file_lock(os.path.join(persist_dir, LOCK_FNAME)):
+        if os.path.exists(os.path.join(persist_dir, IDS_FNAME)) or \
+                not os.path.exists(os.path.join(persist_dir, DEFAULT_PERSIST_FNAME)):
+            return False
+        NumpyVectorStore.from_persist_dir(persist_dir)._persist_locked(persist_dir)
+    return True
+
+
+def load_storage_context(persist_dir: str) -> StorageContext:
+    return StorageContext.from_defaults(persist_dir=persist_dir,
+                                        vector_store=NumpyVectorStore.from_persist_dir(persist_dir))
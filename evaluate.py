@@ -1,23 +1,30 @@
 #! coding=utf-8
+import json
 import os
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Dict, List, Tuple
 
 import pandas as pd
 from llama_index import ServiceContext
 from llama_index.evaluation import RetrieverEvaluator, generate_question_context_pairs, RetrievalEvalResult
+from llama_index.evaluation.retrieval.metrics_base import RetrievalMetricResult
 from llama_index.finetuning import EmbeddingQAFinetuneDataset
 from llama_index.indices.base import BaseIndex
 from llama_index.indices.base_retriever import BaseRetriever
 from llama_index.query_engine import RetrieverQueryEngine
 from tqdm import tqdm
 
-from common.config import ROOT_PATH
+from common.config import ROOT_PATH, LLM_MAX_CONCURRENCY
+from common.embedding import create_embed_model
 from common.llm import create_llm
 from common.prompt import CH_QA_GENERATE_PROMPT_TMPL
 from import_route import load_indices, QueryEngineToRetriever, DocumentQueryEngineFactory
 
 QA_DATASET_DIR = os.path.join(ROOT_PATH, "qa_dataset")
+# 每个城市的评估结果逐条追加写入 <城市>.jsonl，中断后重新运行只评估还没有结果的 (retriever, query)
+EVAL_RESULT_DIR = os.path.join(ROOT_PATH, "eval_result")
 
 FORCE_REBUILD_DATASET = False
 
@@ -29,7 +36,8 @@ class Evaluator:
         self.force_rebuild_dataset = force_rebuild_dataset
         self.llm = create_llm()
         self.service_context = ServiceContext.from_defaults(
-            llm=self.llm
+            llm=self.llm,
+            embed_model=create_embed_model(),
         )
         indices = load_indices(self.service_context)
         self.city_indices: List[Tuple[str, List[BaseIndex]]] = [(city, indices[city]) for city in TEST_CITIES]
@@ -56,31 +64,102 @@ class Evaluator:
             os.makedirs(QA_DATASET_DIR, exist_ok=True)
         qa_dataset.save_json(os.path.join(QA_DATASET_DIR, f"{name}.json"))
 
-    def evaluate(self):
+    def evaluate(self, max_workers: int = LLM_MAX_CONCURRENCY):
         for city_name, indices in tqdm(self.city_indices, desc="document index"):
-            doc_query_engine = DocumentQueryEngineFactory(indices)
             dataset_file = os.path.join(QA_DATASET_DIR, f"{city_name}.json")
+            result_file = os.path.join(EVAL_RESULT_DIR, f"{city_name}.jsonl")
             if self.force_rebuild_dataset or not os.path.exists(dataset_file):
                 self.generate_qa_dataset(city_name, indices)
+                # 数据集变了，之前的评估结果不再有效
+                if os.path.exists(result_file):
+                    os.remove(result_file)
             qa_dataset = EmbeddingQAFinetuneDataset.from_json(dataset_file)
-            doc_query_engine.create_query_engine(self.service_context)
-            retriever_query_engine = doc_query_engine.create_query_engine(self.service_context)
-            name_to_retrievers = self._find_retrievers(retriever_query_engine)
-            results = {}
-            for name, retriever in tqdm(name_to_retrievers, desc="retrievers"):
-                eval_results = []
-                for query, doc_ids in qa_dataset.query_docid_pairs:
-                    retriever_evaluator = RetrieverEvaluator.from_metric_names(
-                        ["mrr", "hit_rate"], retriever=retriever
-                    )
-                    eval_result = retriever_evaluator.evaluate(query, doc_ids)
-                    eval_results.append(eval_result)
-                    print(display_eval_result(city_name, name, eval_result))
-                results[name] = eval_results
+            retriever_query_engine = DocumentQueryEngineFactory(indices).create_query_engine(self.service_context)
+            results = evaluate_retrievers(
+                dict(self._find_retrievers(retriever_query_engine)),
+                qa_dataset.query_docid_pairs,
+                result_file,
+                max_workers=max_workers,
+                desc=city_name,
+            )
             print('')
             print(display_results(results))
 
 
+class EvalResultStore:
+    """评估结果的jsonl文件，每完成一条就追加一行，文件末尾被中断写了一半的行在读取时忽略"""
+
+    def __init__(self, result_file: str):
+        self.result_file = result_file
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict[Tuple[str, str], RetrievalEvalResult]:
+        results = {}
+        if not os.path.exists(self.result_file):
+            return results
+        with open(self.result_file, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    result = RetrievalEvalResult(
+                        query=record["query"],
+                        expected_ids=record["expected_ids"],
+                        retrieved_ids=record["retrieved_ids"],
+                        metric_dict={k: RetrievalMetricResult(score=v) for k, v in record["metrics"].items()},
+                    )
+                except (ValueError, KeyError):
+                    continue
+                results[(record["retriever"], result.query)] = result
+        return results
+
+    def append(self, name: str, eval_result: RetrievalEvalResult):
+        line = json.dumps({
+            "retriever": name,
+            "query": eval_result.query,
+            "expected_ids": eval_result.expected_ids,
+            "retrieved_ids": eval_result.retrieved_ids,
+            "metrics": eval_result.metric_vals_dict,
+        }, ensure_ascii=False)
+        with self._lock:
+            os.makedirs(os.path.dirname(self.result_file) or ".", exist_ok=True)
+            with open(self.result_file, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+def evaluate_retrievers(
+        retrievers: Dict[str, BaseRetriever],
+        query_docid_pairs: List[Tuple[str, List[str]]],
+        result_file: str,
+        max_workers: int = LLM_MAX_CONCURRENCY,
+        desc: str = "evaluate",
+) -> Dict[str, List[RetrievalEvalResult]]:
+    """用线程池并发评估所有的 (retriever, query)，每个retriever只创建一个 RetrieverEvaluator
+
+    结果按 query_docid_pairs 的顺序返回，已经写入 result_file 的结果直接复用
+    """
+    store = EvalResultStore(result_file)
+    done = store.load()
+    evaluators = {
+        name: RetrieverEvaluator.from_metric_names(["mrr", "hit_rate"], retriever=retriever)
+        for name, retriever in retrievers.items()
+    }
+    pending = [(name, query, doc_ids) for name in evaluators for query, doc_ids in query_docid_pairs
+               if (name, query) not in done]
+    if pending:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(evaluators[name].evaluate, query, doc_ids): name
+                for name, query, doc_ids in pending
+            }
+            for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+                name = futures[future]
+                eval_result = future.result()
+                store.append(name, eval_result)
+                done[(name, eval_result.query)] = eval_result
+                print(display_eval_result(desc, name, eval_result))
+    return {name: [done[(name, query)] for query, _ in query_docid_pairs] for name in evaluators}
+
+
 def display_eval_result(city, name, eval_result: RetrievalEvalResult):
     return f"Document: {city}\nRetriever: {name}\n{eval_result}"
 
@@ -1,20 +1,21 @@
 import os
 
 from llama_index import ServiceContext, ComposableGraph, TreeIndex, VectorStoreIndex, get_response_synthesizer, \
-    StorageContext, load_indices_from_storage
+    load_indices_from_storage
 from llama_index.response_synthesizers import ResponseMode
 
 from common.config import index_dir
 from common.llm import create_llm
 from common.prompt import CH_QUERY_PROMPT, CH_TREE_SUMMARIZE_PROMPT
 from common.utils import find_typed
+from common.vector_store import load_storage_context
 
 service_context = ServiceContext.from_defaults(llm=create_llm())
 titles = ["北京市", "上海市"]
 summaries = []
 indices = []
 for city in titles:
-    storage_context = StorageContext.from_defaults(persist_dir=os.path.join(index_dir, city))
+    storage_context = load_storage_context(os.path.join(index_dir, city))
     city_indices = load_indices_from_storage(
         storage_context=storage_context,
         service_context=service_context,
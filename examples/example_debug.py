@@ -1,16 +1,17 @@
 import os
 
-from llama_index import VectorStoreIndex, StorageContext, \
+from llama_index import VectorStoreIndex, \
     load_indices_from_storage, ServiceContext
 from llama_index.callbacks import CallbackManager, LlamaDebugHandler
 
 from common.config import index_dir
 from common.llm import create_llm
+from common.vector_store import load_storage_context
 
 title = "北京市"
 debug_handler = LlamaDebugHandler()
 cb_manager = CallbackManager([debug_handler])
-storage_context = StorageContext.from_defaults(persist_dir=os.path.join(index_dir, title))
+storage_context = load_storage_context(os.path.join(index_dir, title))
 service_context = ServiceContext.from_defaults(llm=create_llm(), callback_manager=cb_manager)
 indices = load_indices_from_storage(
     storage_context=storage_context,
@@ -1,16 +1,17 @@
 import os
 
 from llama_index import TreeIndex
-from llama_index import VectorStoreIndex, StorageContext, \
+from llama_index import VectorStoreIndex, \
     load_indices_from_storage, ServiceContext
 from llama_index.indices.tree.base import TreeRetrieverMode
 
 from common.config import index_dir
 from common.llm import create_llm
+from common.vector_store import load_storage_context
 from import_route import MultiRetriever
 
 title = "北京市"
-storage_context = StorageContext.from_defaults(persist_dir=os.path.join(index_dir, title))
+storage_context = load_storage_context(os.path.join(index_dir, title))
 service_context = ServiceContext.from_defaults(llm=create_llm())
 indices = load_indices_from_storage(
     storage_context=storage_context,
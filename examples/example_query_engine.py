@@ -1,6 +1,6 @@
 import os
 
-from llama_index import VectorStoreIndex, ServiceContext, StorageContext, \
+from llama_index import VectorStoreIndex, ServiceContext, \
     load_indices_from_storage, TreeIndex, QueryBundle, get_response_synthesizer
 from llama_index.indices.postprocessor import LLMRerank
 from llama_index.indices.tree.base import TreeRetrieverMode
@@ -10,10 +10,11 @@ from llama_index.response_synthesizers import ResponseMode
 from common.config import index_dir
 from common.llm import create_llm
 from common.prompt import CH_CHOICE_SELECT_PROMPT, CH_TREE_SUMMARIZE_PROMPT
+from common.vector_store import load_storage_context
 from import_route import MultiRetriever
 
 title = "北京市"
-storage_context = StorageContext.from_defaults(persist_dir=os.path.join(index_dir, title))
+storage_context = load_storage_context(os.path.join(index_dir, title))
 service_context = ServiceContext.from_defaults(llm=create_llm())
 indices = load_indices_from_storage(
     storage_context=storage_context,
@@ -1,16 +1,37 @@
+import json
+
+from llama_index.response.schema import StreamingResponse
+
 from import_route import Chatter
 
 
 def chat_loop():
-    chatter = Chatter()
+    chatter = Chatter(streaming=True)
     while True:
         query = input("\nEnter a query:")
         if query == "exit":
             break
         if query.strip() == "":
             continue
+        metrics_handler = getattr(chatter, "metrics_handler", None)
+        if query == "metrics" and metrics_handler:
+            # 输出 Prometheus 文本格式的指标
+            print(metrics_handler.to_prometheus())
+            continue
+        if query == "cache":
+            # 本进程的缓存命中统计和磁盘占用
+            cache_store = chatter.llm.cache_store
+            print(json.dumps({"stats": cache_store.stats.snapshot(), "usage": cache_store.usage()},
+                             ensure_ascii=False, indent=2))
+            continue
         ans = chatter.chat(query)
-        print(ans)
+        if isinstance(ans, StreamingResponse):
+            # 边生成边输出
+            for token in ans.response_gen:
+                print(token, end="", flush=True)
+            print()
+        else:
+            print(ans)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional
+
+import numpy as np
+from llama_index.response.schema import RESPONSE_TYPE
+
+from common.config import ANSWER_CACHE_CAPACITY, ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL
+
+
+@dataclass
+class AnswerCacheEntry:
+    query: str
+    embedding: np.ndarray
+    response: RESPONSE_TYPE
+    created_at: float
+    # 回答时用到的城市索引及其版本，任意一个城市的索引重新构建后这条缓存失效
+    index_versions: Dict[str, int] = field(default_factory=dict)
+    # 问题路由到的城市，新问题路由到同样的城市时才命中
+    cities: FrozenSet[str] = frozenset()
+
+
+class SemanticAnswerCache:
+    """以问题的embedding为key的答案缓存，和已缓存问题的cosine相似度不低于 threshold 时直接返回缓存的答案
+
+    只差一个实体(城市名)的问题embedding也很相似，get/put 传入问题路由到的城市时，城市不同的缓存不会命中
+
+    超过 ttl 秒的缓存失效，数量超过 capacity 时按LRU淘汰
+    """
+
+    def __init__(self, threshold: float = ANSWER_CACHE_THRESHOLD, ttl: Optional[float] = ANSWER_CACHE_TTL,
+                 capacity: int = ANSWER_CACHE_CAPACITY):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._entries: Dict[int, AnswerCacheEntry] = OrderedDict()
+        self._next_id = 0
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _expired(self, entry: AnswerCacheEntry, now: float) -> bool:
+        return self.ttl is not None and now - entry.created_at > self.ttl
+
+    def get(self, embedding: List[float], current_versions: Callable[[Iterable[str]], Dict[str, int]],
+            cities: Optional[FrozenSet[str]] = None) -> Optional[RESPONSE_TYPE]:
+        now = time.time()
+        with self._lock:
+            for entry_id in [i for i, entry in self._entries.items() if self._expired(entry, now)]:
+                del self._entries[entry_id]
+            if not self._entries:
+                return None
+            entry_ids = list(self._entries.keys())
+            matrix = np.stack([self._entries[i].embedding for i in entry_ids])
+        scores = matrix @ self._normalize(embedding)
+        for pos in np.argsort(-scores, kind="stable"):
+            if scores[pos] < self.threshold:
+                break
+            with self._lock:
+                entry = self._entries.get(entry_ids[pos])
+            if entry is None or (cities is not None and entry.cities != cities):
+                continue
+            if current_versions(entry.index_versions.keys()) != entry.index_versions:
+                self.invalidate(entry_ids[pos])
+                continue
+            with self._lock:
+                if entry_ids[pos] in self._entries:
+                    self._entries.move_to_end(entry_ids[pos])
+            return entry.response
+        return None
+
+    def put(self, query: str, embedding: List[float], response: RESPONSE_TYPE,
+            index_versions: Optional[Dict[str, int]] = None, cities: Optional[FrozenSet[str]] = None):
+        entry = AnswerCacheEntry(query=query, embedding=self._normalize(embedding), response=response,
+                                 created_at=time.time(), index_versions=dict(index_versions or {}),
+                                 cities=frozenset(cities or ()))
+        with self._lock:
+            self._entries[self._next_id] = entry
+            self._next_id += 1
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, entry_id: int):
+        with self._lock:
+            self._entries.pop(entry_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,37 +1,123 @@
-from typing import Dict, List
+from typing import Dict, List, Optional, Sequence
 
-from llama_index import ServiceContext, ComposableGraph, TreeIndex
+from llama_index import ServiceContext, ComposableGraph, SummaryIndex, QueryBundle, TreeIndex
+from llama_index.callbacks import CallbackManager
 from llama_index.indices.base import BaseIndex
 from llama_index.indices.query.base import BaseQueryEngine
+from llama_index.prompts.mixin import PromptMixinType
+from llama_index.query_engine import RetrieverQueryEngine
+from llama_index.response.schema import RESPONSE_TYPE
+from llama_index.schema import IndexNode, NodeRelationship, NodeWithScore, ObjectType, RelatedNodeInfo
 
-from common.prompt import CH_QUERY_PROMPT
+from common.utils import city_profile, find_typed
 from query.query_engine import DocumentQueryEngineFactory, create_response_synthesizer
+from query.registry import CityIndexRegistry
+from query.retrievers import SelectorRetriever
+from query.selectors import create_selector
 
 
-def create_compose_query_engine(city_indices: Dict[str, List[BaseIndex]],
-                                service_context: ServiceContext) -> BaseQueryEngine:
-    query_engines = []
-    for city, indices in city_indices.items():
-        summary = f"""
+def city_summary(city: str) -> str:
+    return f"""
             此内容包含关于{city}的维基百科文章。
             如果您需要查找有关{city}的具体事实，请使用此索引。"
             如果您想分析多个城市，请不要使用此索引。
             """
+
+
+def _index_node(summary: str, index_id: str) -> IndexNode:
+    return IndexNode(
+        text=summary,
+        index_id=index_id,
+        relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=index_id, node_type=ObjectType.INDEX)},
+    )
+
+
+def _create_graph_query_engine(index_nodes: List[IndexNode], children_indices: List[BaseIndex],
+                               custom_query_engines: Dict[str, BaseQueryEngine], embed_texts: List[str],
+                               service_context: ServiceContext, streaming: bool = False) -> BaseQueryEngine:
+    # 根节点不再用 TreeIndex 逐层让大模型选择，而是用embedding相似度选出城市，只有不确定的时候才调用llm
+    root_index = SummaryIndex(nodes=index_nodes, service_context=service_context)
+    graph = ComposableGraph(
+        all_indices={index.index_id: index for index in [*children_indices, root_index]},
+        root_id=root_index.index_id,
+    )
+    selector = create_selector(service_context)
+    # 各个城市的summary只差一个城市名，embedding几乎相同，用城市的简介计算embedding才能区分
+    selector.precompute([node.text for node in index_nodes], embed_texts)
+    root_query_engine = RetrieverQueryEngine.from_args(
+        SelectorRetriever(index_nodes, selector),
+        service_context=service_context,
+        # 城市的回答作为根节点的上下文，只有根节点的最后一次总结需要流式输出
+        response_synthesizer=create_response_synthesizer(service_context=service_context, streaming=streaming),
+    )
+    return graph.as_query_engine(
+        custom_query_engines={root_index.index_id: root_query_engine, **custom_query_engines},
+    )
+
+
+def create_compose_query_engine(city_indices: Dict[str, List[BaseIndex]],
+                                service_context: ServiceContext) -> BaseQueryEngine:
+    query_engines = []
+    for city, indices in city_indices.items():
         query_engines.append(DocumentQueryEngineFactory(
             indices=indices,
-            summary=summary
+            summary=city_summary(city)
         ))
 
-    # 为每个城市的query engine指定一个summary，ComposableGraph会使用大模型来判断问题需要使用哪一个QueryEngine
-    graph = ComposableGraph.from_indices(
-        TreeIndex,
+    # 为每个城市的query engine指定一个summary，根据问题和summary的相关程度判断问题需要使用哪一个QueryEngine
+    return _create_graph_query_engine(
+        [_index_node(e.summary, e.first_index().index_id) for e in query_engines],
         [e.first_index() for e in query_engines],
-        [e.summary for e in query_engines],
-        service_context=service_context,
+        {e.first_index().index_id: e.create_query_engine(service_context) for e in query_engines},
+        [_loaded_city_profile(city, indices) for city, indices in city_indices.items()],
+        service_context,
     )
-    return graph.as_query_engine(
-        response_synthesizer=create_response_synthesizer(service_context=service_context),
-        custom_query_engines={e.first_index().index_id: e.create_query_engine(service_context) for e in query_engines},
-        service_context=service_context,
-        query_template=CH_QUERY_PROMPT,
+
+
+def _loaded_city_profile(city: str, indices: List[BaseIndex]) -> str:
+    tree_index = find_typed(indices, TreeIndex)
+    return city_profile(city, tree_index.index_struct, tree_index.docstore)
+
+
+class LazyCityQueryEngine(BaseQueryEngine):
+    """真正查询时才从 registry 取城市的query engine，索引在这时才会被加载"""
+
+    def __init__(self, registry: CityIndexRegistry, city: str, callback_manager: CallbackManager = None):
+        self.registry = registry
+        self.city = city
+        super().__init__(callback_manager)
+
+    def _get_prompt_modules(self) -> PromptMixinType:
+        return {}
+
+    def retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self.registry.get_query_engine(self.city).retrieve(query_bundle)
+
+    def synthesize(self, query_bundle: QueryBundle, nodes: List[NodeWithScore],
+                   additional_source_nodes: Optional[Sequence[NodeWithScore]] = None) -> RESPONSE_TYPE:
+        return self.registry.get_query_engine(self.city).synthesize(query_bundle, nodes, additional_source_nodes)
+
+    def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        return self.registry.get_query_engine(self.city).query(query_bundle)
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        return await self.registry.get_query_engine(self.city).aquery(query_bundle)
+
+
+def create_lazy_compose_query_engine(registry: CityIndexRegistry, service_context: ServiceContext,
+                                     streaming: bool = False) -> BaseQueryEngine:
+    # 和 create_compose_query_engine 一样用城市的summary选择城市，
+    # 但是子节点只记录城市名，路由命中后再由 LazyCityQueryEngine 加载对应城市的索引
+    return _create_graph_query_engine(
+        [_index_node(city_summary(city), city) for city in registry.cities()],
+        [],
+        {city: LazyCityQueryEngine(registry, city, service_context.callback_manager) for city in registry.cities()},
+        [registry.profile(city) for city in registry.cities()],
+        service_context,
+        streaming=streaming,
     )
+
+
+def index_embed_text(registry: CityIndexRegistry) -> str:
+    # 路由时"城市索引"这个选项用所有城市的简介计算embedding
+    return "\n".join(registry.profile(city) for city in registry.cities())
@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from llama_index import QueryBundle
+from llama_index.bridge.pydantic import Field
+from llama_index.callbacks import CBEventType, EventPayload
+from llama_index.indices.postprocessor import LLMRerank
+from llama_index.schema import BaseNode, NodeWithScore
+
+from common.utils import submit_with_context
+
+
+class ParallelLLMRerank(LLMRerank):
+    """LLMRerank 的每个 choice batch 是独立的一次llm调用，这里把所有batch并发发出去"""
+
+    max_workers: int = Field(default=4, description="Max concurrent choice select calls.")
+
+    def __init__(self, max_workers: int = 4, **kwargs):
+        super().__init__(**kwargs)
+        self.max_workers = max_workers
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ParallelLLMRerank"
+
+    def _rerank_batch(self, nodes_batch: List[BaseNode], query_str: str) -> List[Tuple[BaseNode, float]]:
+        fmt_batch_str = self._format_node_batch_fn(nodes_batch)
+        raw_response = self.service_context.llm_predictor.predict(
+            self.choice_select_prompt,
+            context_str=fmt_batch_str,
+            query_str=query_str,
+        )
+        raw_choices, relevances = self._parse_choice_select_answer_fn(raw_response, len(nodes_batch))
+        choice_nodes = [nodes_batch[int(choice) - 1] for choice in raw_choices]
+        relevances = relevances or [1.0 for _ in choice_nodes]
+        return list(zip(choice_nodes, relevances))
+
+    def postprocess_nodes(
+            self,
+            nodes: List[NodeWithScore],
+            query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if query_bundle is None:
+            raise ValueError("Query bundle must be provided.")
+        batches = [
+            [n.node for n in nodes[idx: idx + self.choice_batch_size]]
+            for idx in range(0, len(nodes), self.choice_batch_size)
+        ]
+        if not batches:
+            return []
+        # 发出 RERANKING 事件，rerank 的llm调用在指标里单独统计
+        with self.service_context.callback_manager.event(
+                CBEventType.RERANKING,
+                payload={EventPayload.QUERY_STR: query_bundle.query_str, EventPayload.TOP_K: self.top_n},
+        ) as event:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as executor:
+                # 按batch的顺序取结果，相同分数的node保持召回时的顺序，合并结果是确定的
+                futures = [submit_with_context(executor, self._rerank_batch, batch, query_bundle.query_str)
+                           for batch in batches]
+                results = [NodeWithScore(node=node, score=relevance)
+                           for future in futures for node, relevance in future.result()]
+            results = sorted(results, key=lambda x: x.score or 0.0, reverse=True)[: self.top_n]
+            event.on_end(payload={EventPayload.NODES: results})
+        return results
@@ -3,21 +3,23 @@ import os
 from dataclasses import dataclass
 from typing import List, Dict, Optional
 
-from llama_index import ServiceContext, get_response_synthesizer, VectorStoreIndex, StorageContext, \
+from llama_index import ServiceContext, VectorStoreIndex, \
     load_indices_from_storage, TreeIndex
 from llama_index.indices.base import BaseIndex
-from llama_index.indices.postprocessor import LLMRerank
 from llama_index.indices.tree.base import TreeRetrieverMode
 from llama_index.query_engine import RetrieverQueryEngine
-from llama_index.response_synthesizers import ResponseMode, BaseSynthesizer
+from llama_index.response_synthesizers import BaseSynthesizer
 
-from common.config import index_dir
+from common.config import OLD_INDEX_SUFFIX, PARTIAL_INDEX_SUFFIX, RETRIEVE_TIMEOUT, index_dir
 from common.prompt import CH_CHOICE_SELECT_PROMPT, CH_TREE_SUMMARIZE_PROMPT
-from query.retrievers import MultiRetriever
+from common.vector_store import load_storage_context
+from query.postprocessor import ParallelLLMRerank
+from query.retrievers import FusionMode, MultiRetriever
+from query.synthesizer import ParallelTreeSummarize
 
 
-def load_index(title: str, service_context: ServiceContext=None) -> List[BaseIndex]:
-    storage_context = StorageContext.from_defaults(persist_dir=os.path.join(index_dir, title))
+def load_index(title: str, service_context: ServiceContext=None, root_dir: str = index_dir) -> List[BaseIndex]:
+    storage_context = load_storage_context(os.path.join(root_dir, title))
     return load_indices_from_storage(
         storage_context=storage_context,
         service_context=service_context,
@@ -27,17 +29,22 @@ def load_index(title: str, service_context: ServiceContext=None) -> List[BaseInd
 def load_indices(service_context: ServiceContext) -> Dict[str, List[BaseIndex]]:
     indices: Dict[str, List[BaseIndex]] = {}
     for title in os.listdir(index_dir):
+        # 跳过还没有构建完成的索引，以及增量更新替换时暂存的旧索引
+        if title.endswith((PARTIAL_INDEX_SUFFIX, OLD_INDEX_SUFFIX)):
+            continue
         indices[title] = load_index(title, service_context)
     return indices
 
 
-def create_response_synthesizer(service_context: ServiceContext = None) -> BaseSynthesizer:
+def create_response_synthesizer(service_context: ServiceContext = None, streaming: bool = False) -> BaseSynthesizer:
     # 采用TreeSummarize的方式对多个上下文进行逐步总结，防止超过llm的context limit
     # 同时用中文prompt得到更加稳定的中文summary
-    return get_response_synthesizer(
-        response_mode=ResponseMode.TREE_SUMMARIZE,
+    # streaming=True 时最后一次总结以token流的形式返回 StreamingResponse
+    # 同一层的多个chunk并发总结，多个chunk的答案耗时接近 树的层数 次llm调用
+    return ParallelTreeSummarize(
         summary_template=CH_TREE_SUMMARIZE_PROMPT,
         service_context=service_context,
+        streaming=streaming,
     )
 
 
@@ -66,11 +73,14 @@ class DocumentQueryEngineFactory:
 
     def create_query_engine(self, service_context: ServiceContext) -> RetrieverQueryEngine:
         # 组合多索引召回、排序，答案合成，构建最终的query engine
-        retriever = MultiRetriever(self.create_retrievers())
+        # 多路召回结果按 reciprocal rank 融合排序，只把前 top_k 个交给后面的 rerank
+        retriever = MultiRetriever(self.create_retrievers(), timeout=RETRIEVE_TIMEOUT,
+                                   fusion_mode=FusionMode.RECIPROCAL_RANK, top_k=8)
         # LLMRerank只选取最相关的top_n, 进一步提高命中率，防止召回阶段拿到不相关的内容
+        # 多个batch并发调用llm，rerank的耗时接近一次llm调用
         node_postprocessors = [
-            LLMRerank(top_n=4, choice_batch_size=2, choice_select_prompt=CH_CHOICE_SELECT_PROMPT,
-                      service_context=service_context)
+            ParallelLLMRerank(max_workers=8, top_n=4, choice_batch_size=2,
+                              choice_select_prompt=CH_CHOICE_SELECT_PROMPT, service_context=service_context)
         ]
         return RetrieverQueryEngine.from_args(
             retriever,
@@ -0,0 +1,147 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set
+
+from llama_index import ServiceContext
+from llama_index.indices.base import BaseIndex
+from llama_index.indices.query.base import BaseQueryEngine
+
+from common.config import CITY_PROFILE_FNAME, INDEX_MEMORY_BUDGET_MB, OLD_INDEX_SUFFIX, PARTIAL_INDEX_SUFFIX, \
+    index_dir
+from query.query_engine import DocumentQueryEngineFactory, load_index
+
+
+@dataclass
+class CitySummary:
+    title: str
+    persist_dir: str
+    # 用索引目录在磁盘上的大小粗略估计加载后占用的内存
+    size_bytes: int
+    # 构建时保存的城市简介，路由时计算embedding用；旧版本的索引没有简介，只用城市名
+    profile: str
+
+
+def load_city_summaries(root_dir: str = index_dir) -> Dict[str, CitySummary]:
+    # 启动时只扫描目录，不读取索引内容
+    summaries = {}
+    for title in sorted(os.listdir(root_dir)):
+        persist_dir = os.path.join(root_dir, title)
+        # 还没有构建完成的索引目录，以及正在被替换的旧索引
+        if not os.path.isdir(persist_dir) or title.endswith((PARTIAL_INDEX_SUFFIX, OLD_INDEX_SUFFIX)):
+            continue
+        size_bytes = sum(entry.stat().st_size for entry in os.scandir(persist_dir) if entry.is_file())
+        summaries[title] = CitySummary(title=title, persist_dir=persist_dir, size_bytes=size_bytes,
+                                       profile=_read_profile(persist_dir) or title)
+    return summaries
+
+
+def _read_profile(persist_dir: str) -> str:
+    try:
+        with open(os.path.join(persist_dir, CITY_PROFILE_FNAME), encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ""
+
+
+@dataclass
+class _LoadedCity:
+    indices: List[BaseIndex]
+    query_engine: BaseQueryEngine
+    version: int
+
+
+class CityIndexRegistry:
+    """按需加载城市索引：第一次路由到某个城市时才加载，总大小超过内存预算时按LRU卸载最久没用过的城市"""
+
+    def __init__(self, service_context: ServiceContext, root_dir: str = index_dir,
+                 memory_budget_mb: Optional[int] = INDEX_MEMORY_BUDGET_MB):
+        self.service_context = service_context
+        self.root_dir = root_dir
+        self.summaries = load_city_summaries(root_dir)
+        self.memory_budget = memory_budget_mb * 1024 * 1024 if memory_budget_mb else None
+        self._loaded: Dict[str, _LoadedCity] = OrderedDict()
+        self._lock = threading.RLock()
+        # 每个城市一把锁，不同城市可以同时加载，同一个城市只加载一次
+        self._city_locks = {title: threading.Lock() for title in self.summaries}
+        self._local = threading.local()
+
+    def cities(self) -> List[str]:
+        return list(self.summaries.keys())
+
+    def profile(self, city: str) -> str:
+        return self.summaries[city].profile
+
+    def loaded_cities(self) -> List[str]:
+        with self._lock:
+            return list(self._loaded.keys())
+
+    def version(self, city: str) -> int:
+        # 每次构建(全量或增量)都会重新写 index_store.json，用它的修改时间作为索引的版本
+        try:
+            return os.stat(os.path.join(self.summaries[city].persist_dir, "index_store.json")).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def versions(self, cities: Iterable[str]) -> Dict[str, int]:
+        return {city: self.version(city) for city in cities}
+
+    @contextmanager
+    def track_access(self):
+        """记录当前线程在with块里用到了哪些城市的索引"""
+        accessed: Set[str] = set()
+        self._local.accessed = accessed
+        try:
+            yield accessed
+        finally:
+            self._local.accessed = None
+
+    def _get(self, city: str) -> _LoadedCity:
+        if city not in self.summaries:
+            raise KeyError(f"Unknown city={city}")
+        accessed = getattr(self._local, "accessed", None)
+        if accessed is not None:
+            accessed.add(city)
+        version = self.version(city)
+        with self._lock:
+            # 索引被重新构建过的城市需要重新加载
+            if city in self._loaded and self._loaded[city].version == version:
+                self._loaded.move_to_end(city)
+                return self._loaded[city]
+        with self._city_locks[city]:
+            with self._lock:
+                if city in self._loaded and self._loaded[city].version == version:
+                    return self._loaded[city]
+            indices = load_index(city, self.service_context, self.root_dir)
+            factory = DocumentQueryEngineFactory(indices=indices)
+            loaded = _LoadedCity(indices=indices, query_engine=factory.create_query_engine(self.service_context),
+                                 version=version)
+            with self._lock:
+                self._loaded[city] = loaded
+                self._evict(keep=city)
+            return loaded
+
+    def _evict(self, keep: str):
+        if self.memory_budget is None:
+            return
+        total = sum(self.summaries[city].size_bytes for city in self._loaded)
+        for city in list(self._loaded.keys()):
+            if total <= self.memory_budget:
+                break
+            # 刚加载的城市即使单独超过预算也保留
+            if city == keep:
+                continue
+            del self._loaded[city]
+            total -= self.summaries[city].size_bytes
+
+    def get_indices(self, city: str) -> List[BaseIndex]:
+        return self._get(city).indices
+
+    def get_query_engine(self, city: str) -> BaseQueryEngine:
+        return self._get(city).query_engine
+
+    def evict(self, city: str):
+        with self._lock:
+            self._loaded.pop(city, None)
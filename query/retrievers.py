@@ -1,9 +1,30 @@
-from typing import List
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from enum import Enum
+from typing import Dict, List, Optional
 
 from llama_index import QueryBundle
 from llama_index.indices.base_retriever import BaseRetriever
 from llama_index.query_engine import RetrieverQueryEngine
-from llama_index.schema import NodeWithScore
+from llama_index.schema import IndexNode, NodeWithScore
+from llama_index.selectors.types import BaseSelector
+from llama_index.tools.types import ToolMetadata
+
+from common.config import RETRIEVE_MAX_WORKERS
+from common.utils import submit_with_context
+
+# 所有 MultiRetriever 共用一个线程池，registry 重新加载索引时不会留下无人关闭的线程
+_executor = ThreadPoolExecutor(max_workers=RETRIEVE_MAX_WORKERS, thread_name_prefix="multi_retriever")
+
+
+class FusionMode(str, Enum):
+    # 按node_id取并集，不保留排序
+    UNION = "union"
+    # reciprocal rank fusion, 只看每个retriever内的排名，不受不同retriever分数尺度的影响
+    RECIPROCAL_RANK = "reciprocal_rank"
+    # 每个retriever的分数归一化到[0, 1]后加权求和
+    WEIGHTED = "weighted"
 
 
 class MultiRetriever(BaseRetriever):
@@ -12,21 +33,103 @@ class MultiRetriever(BaseRetriever):
     def __init__(
             self,
             retrievers,
+            timeout: Optional[float] = None,
+            fusion_mode: FusionMode = FusionMode.UNION,
+            top_k: Optional[int] = None,
+            weights: Optional[List[float]] = None,
+            rrf_k: int = 60,
     ) -> None:
         if retrievers is None:
             raise ValueError("Invalid retrievers.")
+        if weights is not None and len(weights) != len(retrievers):
+            raise ValueError("weights must have the same length as retrievers.")
         self._retrievers = retrievers
+        self._fusion_mode = FusionMode(fusion_mode)
+        # 融合排序后只保留前 top_k 个node，减少后面 rerank 和 summarize 的llm调用
+        self._top_k = top_k
+        self._weights = weights or [1.0] * len(retrievers)
+        self._rrf_k = rrf_k
+        # 每个retriever最多等待 timeout 秒，超时的retriever不参与合并，只使用已经返回的结果
+        self._timeout = timeout
+
+    @staticmethod
+    def _normalize_scores(nodes: List[NodeWithScore]) -> List[float]:
+        scores = [n.score for n in nodes]
+        if not nodes or any(score is None for score in scores):
+            # 没有分数(例如TreeRetriever)的按排名线性打分
+            return [1.0 - i / len(nodes) for i in range(len(nodes))]
+        low, high = min(scores), max(scores)
+        if high == low:
+            return [1.0] * len(nodes)
+        return [(score - low) / (high - low) for score in scores]
+
+    def _fuse(self, results: List[List[NodeWithScore]]) -> List[NodeWithScore]:
+        fused_scores: Dict[str, float] = {}
+        node_by_id: Dict[str, NodeWithScore] = {}
+        for weight, cur_nodes in zip(self._weights, results):
+            if self._fusion_mode == FusionMode.RECIPROCAL_RANK:
+                scores = [weight / (self._rrf_k + rank + 1) for rank in range(len(cur_nodes))]
+            else:
+                scores = [weight * score for score in self._normalize_scores(cur_nodes)]
+            for n, score in zip(cur_nodes, scores):
+                fused_scores[n.node.node_id] = fused_scores.get(n.node.node_id, 0.0) + score
+                node_by_id.setdefault(n.node.node_id, n)
+        # 分数相同时按node_id排序，保证结果稳定
+        node_ids = sorted(fused_scores, key=lambda node_id: (-fused_scores[node_id], node_id))
+        return [NodeWithScore(node=node_by_id[node_id].node, score=fused_scores[node_id]) for node_id in node_ids]
+
+    def _merge(self, results: List[List[NodeWithScore]]) -> List[NodeWithScore]:
+        # 对多个retrieve的召回结果进行合并
+        if self._fusion_mode == FusionMode.UNION:
+            combined_dict = {}
+            for cur_nodes in results:
+                combined_dict.update({n.node.node_id: n for n in cur_nodes})
+            retrieve_nodes = sorted(list(combined_dict.values()), key=lambda n: n.node_id)
+        else:
+            retrieve_nodes = self._fuse(results)
+        if self._top_k is not None:
+            retrieve_nodes = retrieve_nodes[:self._top_k]
+        return retrieve_nodes
 
     def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
         if self._retrievers is None:
             return []
-        # 对多个retrieve的召回结果进行合并
-        combined_dict = {}
-        for retriever in self._retrievers:
-            cur_nodes = retriever.retrieve(query_bundle)
-            combined_dict.update({n.node.node_id: n for n in cur_nodes})
-        retrieve_nodes = sorted(list(combined_dict.values()), key=lambda n: n.node_id)
-        return retrieve_nodes
+        # 多个retriever并发召回，总耗时取决于最慢的一个而不是所有retriever之和
+        futures = [submit_with_context(_executor, retriever.retrieve, query_bundle)
+                   for retriever in self._retrievers]
+        # 所有retriever同时开始，deadline从提交时开始计算
+        deadline = None if self._timeout is None else time.monotonic() + self._timeout
+        results = []
+        for retriever, future in zip(self._retrievers, futures):
+            try:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                results.append(future.result(timeout=remaining))
+            except TimeoutError:
+                print(f"retriever {retriever.__class__.__name__} timeout after {self._timeout}s, skipped")
+                results.append([])
+        return self._merge(results)
+
+    async def _aretrieve_one(self, retriever: BaseRetriever, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if type(retriever)._aretrieve is not BaseRetriever._aretrieve:
+            return await retriever.aretrieve(query_bundle)
+        # 没有实现异步召回的retriever放到线程池里执行，避免阻塞event loop，和同步召回一样沿用当前的contextvars
+        return await asyncio.wrap_future(submit_with_context(_executor, retriever.retrieve, query_bundle))
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        if self._retrievers is None:
+            return []
+        tasks = [asyncio.wait_for(self._aretrieve_one(retriever, query_bundle), self._timeout)
+                 for retriever in self._retrievers]
+        results = []
+        for retriever, result in zip(self._retrievers, await asyncio.gather(*tasks, return_exceptions=True)):
+            if isinstance(result, asyncio.TimeoutError):
+                print(f"retriever {retriever.__class__.__name__} timeout after {self._timeout}s, skipped")
+                results.append([])
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                results.append(result)
+        return self._merge(results)
 
 
 class QueryEngineToRetriever(BaseRetriever):
@@ -35,3 +138,21 @@ class QueryEngineToRetriever(BaseRetriever):
 
     def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
         return self._retriever.retrieve(query_bundle)
+
+
+class SelectorRetriever(BaseRetriever):
+    """从固定的一组 IndexNode 里用 selector 选出和问题最相关的一个，代替 TreeIndex 根节点逐层调用llm的选择"""
+
+    def __init__(self, index_nodes: List[IndexNode], selector: BaseSelector):
+        self._index_nodes = index_nodes
+        self._selector = selector
+        self._choices = [ToolMetadata(description=node.text, name=node.index_id) for node in index_nodes]
+
+    def _to_nodes(self, result) -> List[NodeWithScore]:
+        return [NodeWithScore(node=self._index_nodes[i]) for i in result.inds]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self._to_nodes(self._selector.select(self._choices, query_bundle))
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        return self._to_nodes(await self._selector.aselect(self._choices, query_bundle))
@@ -1,23 +1,26 @@
 import json
-from typing import Dict, List
+from typing import FrozenSet, Generator, List, Optional, Set
 
 import llama_index.query_engine
 from llama_index import ServiceContext, QueryBundle
 from llama_index.callbacks import CBEventType, LlamaDebugHandler, CallbackManager
-from llama_index.indices.base import BaseIndex
 from llama_index.indices.query.base import BaseQueryEngine
 from llama_index.llms.base import LLM
 from llama_index.prompts.mixin import PromptMixinType
-from llama_index.response.schema import RESPONSE_TYPE, Response
-from llama_index.selectors import LLMSingleSelector
-from llama_index.tools import QueryEngineTool
-
-from common.config import DEBUG, LLM_CACHE_ENABLED
-from common.llm import llm_predict, create_llm
-from common.prompt import CH_SINGLE_SELECT_PROMPT_TMPL
+from llama_index.response.schema import RESPONSE_TYPE, Response, StreamingResponse
+from llama_index.types import TokenGen
+from llama_index.tools import QueryEngineTool, ToolMetadata
+
+from common.config import ANSWER_CACHE_ENABLED, ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_THRESHOLDS, DEBUG, \
+    LLM_CACHE_ENABLED, METRICS_ENABLED, METRICS_JSONL_FILE, index_dir
+from common.embedding import create_embed_model
+from common.llm import llm_predict, llm_stream_predict, create_llm
+from common.metrics import MetricsHandler
 from common.utils import ObjectEncoder
-from query.query_engine import load_indices
-from query.compose import create_compose_query_engine
+from query.answer_cache import SemanticAnswerCache
+from query.compose import city_summary, create_lazy_compose_query_engine, index_embed_text
+from query.registry import CityIndexRegistry
+from query.selectors import EmbeddingThresholdSelector, create_selector
 
 
 class EchoNameEngine(BaseQueryEngine):
@@ -37,14 +40,17 @@ class EchoNameEngine(BaseQueryEngine):
 
 class LlmQueryEngine(BaseQueryEngine):
 
-    def __init__(self, llm: LLM, callback_manager: CallbackManager):
+    def __init__(self, llm: LLM, callback_manager: CallbackManager, streaming: bool = False):
         self.llm = llm
+        self.streaming = streaming
         super().__init__(callback_manager=callback_manager)
 
     def _get_prompt_modules(self) -> PromptMixinType:
         return {}
 
     def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        if self.streaming:
+            return StreamingResponse(llm_stream_predict(self.llm, query_bundle.query_str))
         return Response(llm_predict(self.llm, query_bundle.query_str))
 
     async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
@@ -52,7 +58,7 @@ class LlmQueryEngine(BaseQueryEngine):
 
 
 def create_route_query_engine(query_engines: List[BaseQueryEngine], descriptions: List[str],
-                              service_context: ServiceContext = None):
+                              service_context: ServiceContext = None, embed_texts: Optional[List[str]] = None):
     assert len(query_engines) == len(descriptions)
     tools = []
     for i, query_engine in enumerate(query_engines):
@@ -61,9 +67,11 @@ def create_route_query_engine(query_engines: List[BaseQueryEngine], descriptions
             description=descriptions[i]
         )
         tools.append(query_tool)
+    # 大部分问题用embedding相似度就能确定路由，只有不确定的时候才调用llm选择
+    selector = create_selector(service_context)
+    selector.precompute(descriptions, embed_texts)
     return llama_index.query_engine.RouterQueryEngine(
-        selector=LLMSingleSelector.from_defaults(service_context=service_context,
-                                                 prompt_template_str=CH_SINGLE_SELECT_PROMPT_TMPL),
+        selector=selector,
         service_context=service_context,
         query_engine_tools=tools
     )
@@ -71,35 +79,52 @@ def create_route_query_engine(query_engines: List[BaseQueryEngine], descriptions
 
 class Chatter:
 
-    def __init__(self):
-        if DEBUG:
-            debug_handler = LlamaDebugHandler()
-            cb_manager = CallbackManager([debug_handler])
-        else:
-            debug_handler = None
-            cb_manager = CallbackManager()
+    def __init__(self, streaming: bool = False, root_dir: str = index_dir, debug: bool = DEBUG,
+                 metrics: bool = METRICS_ENABLED):
+        handlers = []
+        debug_handler = LlamaDebugHandler() if debug else None
+        if debug_handler:
+            handlers.append(debug_handler)
+        # 指标只记录耗时和计数，不保存payload，一直开着开销也很小
+        self.metrics_handler = MetricsHandler(jsonl_file=METRICS_JSONL_FILE) if metrics else None
+        if self.metrics_handler:
+            handlers.append(self.metrics_handler)
+        cb_manager = CallbackManager(handlers)
         llm = create_llm(cb_manager, LLM_CACHE_ENABLED)
         service_context = ServiceContext.from_defaults(
             llm=llm,
+            embed_model=create_embed_model(cb_manager, LLM_CACHE_ENABLED),
             callback_manager=cb_manager
         )
         self.cb_manager = cb_manager
-        self.city_indices: Dict[str, List[BaseIndex]] = load_indices(service_context)
+        # 启动时只扫描有哪些城市，城市的索引在第一次被路由到时才加载
+        self.registry = CityIndexRegistry(service_context, root_dir=root_dir)
         self.service_context = service_context
         self.llm = llm
         self.debug_handler = debug_handler
+        # streaming=True 时 chat 返回 StreamingResponse，路由、召回和rerank完成后边生成边输出答案
+        self.streaming = streaming
+        embed_model = service_context.embed_model
+        self.answer_cache = SemanticAnswerCache(
+            threshold=ANSWER_CACHE_THRESHOLDS.get(embed_model.model_name, ANSWER_CACHE_THRESHOLD)
+        ) if ANSWER_CACHE_ENABLED else None
+        # 没有fallback，总是选出城市简介和问题最相似的城市，不调用llm
+        self.city_selector = EmbeddingThresholdSelector(embed_model)
         self.query_engine = self.create_query_engine()
 
     def create_query_engine(self):
-        index_query_engine = create_compose_query_engine(self.city_indices, self.service_context)
-        index_summary = f"提供 {', '.join(self.city_indices.keys())} 这几个城市的相关信息"
-        llm_query_engine = LlmQueryEngine(llm=self.llm, callback_manager=self.cb_manager)
+        index_query_engine = create_lazy_compose_query_engine(self.registry, self.service_context,
+                                                              streaming=self.streaming)
+        index_summary = f"提供 {', '.join(self.registry.cities())} 这几个城市的相关信息"
+        llm_query_engine = LlmQueryEngine(llm=self.llm, callback_manager=self.cb_manager, streaming=self.streaming)
         llm_summary = "提供其他所有信息"
 
         route_query_engine = create_route_query_engine(
             [index_query_engine, llm_query_engine],
             [index_summary, llm_summary],
-            service_context=self.service_context)
+            service_context=self.service_context,
+            # 和城市相关的问题与某个城市的简介最相似
+            embed_texts=[index_embed_text(self.registry), llm_summary])
         return route_query_engine
 
     def _print_and_flush_debug_info(self):
@@ -110,7 +135,48 @@ class Chatter:
                         f"[DebugInfo] event_type={event.event_type}, content={json.dumps(event.payload, ensure_ascii=False, cls=ObjectEncoder)}")
             self.debug_handler.flush_event_logs()
 
-    def chat(self, query):
-        response = self.query_engine.query(query)
+    def _route_cities(self, query_bundle: QueryBundle) -> FrozenSet[str]:
+        # 答案缓存用：只差城市名的问题embedding也很相似，按城市简介选出问题对应的城市，城市不同的缓存不命中
+        cities = self.registry.cities()
+        if not cities:
+            return frozenset()
+        choices = [ToolMetadata(description=city_summary(city), name=city) for city in cities]
+        self.city_selector.precompute([choice.description for choice in choices],
+                                      [self.registry.profile(city) for city in cities])
+        return frozenset(cities[i] for i in self.city_selector.select(choices, query_bundle).inds)
+
+    def _on_answered(self, query_bundle: QueryBundle, response: RESPONSE_TYPE, cities: Set[str],
+                     route: FrozenSet[str]):
+        if self.answer_cache is not None:
+            self.answer_cache.put(query_bundle.query_str, query_bundle.embedding, response,
+                                  self.registry.versions(cities), route)
         self._print_and_flush_debug_info()
+
+    def _finish_stream(self, query_bundle: QueryBundle, response: StreamingResponse, response_gen: TokenGen,
+                       cities: Set[str], route: FrozenSet[str]) -> Generator[str, None, None]:
+        tokens = []
+        for token in response_gen:
+            tokens.append(token)
+            yield token
+        # 答案全部输出以后再写缓存和打印调试信息
+        self._on_answered(query_bundle, Response("".join(tokens), source_nodes=response.source_nodes,
+                                                 metadata=response.metadata), cities, route)
+
+    def chat(self, query) -> RESPONSE_TYPE:
+        query_bundle = QueryBundle(query_str=query)
+        route = frozenset()
+        if self.answer_cache is not None:
+            # query的embedding只算一次，路由和召回时都直接使用
+            query_bundle.embedding = self.service_context.embed_model.get_query_embedding(query)
+            route = self._route_cities(query_bundle)
+            response = self.answer_cache.get(query_bundle.embedding, self.registry.versions, route)
+            if response is not None:
+                return response
+        with self.registry.track_access() as cities:
+            response = self.query_engine.query(query_bundle)
+        if isinstance(response, StreamingResponse):
+            response.response_gen = self._finish_stream(query_bundle, response, response.response_gen, cities,
+                                                        route)
+        else:
+            self._on_answered(query_bundle, response, cities, route)
         return response
@@ -0,0 +1,96 @@
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index import QueryBundle, ServiceContext
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.prompts.mixin import PromptDictType, PromptMixinType
+from llama_index.selectors import LLMSingleSelector
+from llama_index.selectors.types import BaseSelector, SelectorResult, SingleSelection
+from llama_index.tools.types import ToolMetadata
+
+from common.config import ROUTE_EMBED_MARGIN, ROUTE_EMBED_THRESHOLD, ROUTE_EMBED_THRESHOLDS
+from common.prompt import CH_SINGLE_SELECT_PROMPT_TMPL
+
+
+class EmbeddingThresholdSelector(BaseSelector):
+    """先用query和各个选项描述的embedding相似度做选择，只有不确定的时候才交给 fallback(llm) 选择
+
+    最相似的选项相似度不低于 threshold，并且比第二名至少高出 margin 时，认为embedding的结果足够可信
+    选项描述的embedding只计算一次
+    """
+
+    def __init__(self, embed_model: BaseEmbedding, fallback: Optional[BaseSelector] = None,
+                 threshold: float = ROUTE_EMBED_THRESHOLD, margin: float = ROUTE_EMBED_MARGIN):
+        self.embed_model = embed_model
+        self.fallback = fallback
+        self.threshold = threshold
+        self.margin = margin
+        self._lock = threading.Lock()
+        self._description_embeddings: Dict[str, np.ndarray] = {}
+
+    def _get_prompts(self) -> Dict[str, Any]:
+        return {}
+
+    def _update_prompts(self, prompts: PromptDictType) -> None:
+        pass
+
+    def _get_prompt_modules(self) -> PromptMixinType:
+        return {"fallback": self.fallback} if self.fallback is not None else {}
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def precompute(self, descriptions: Sequence[str], embed_texts: Optional[Sequence[str]] = None):
+        """embed_texts 不为空时，用它代替对应的选项描述计算embedding，例如用城市的简介代替模板化的描述"""
+        texts = dict(zip(descriptions, embed_texts or descriptions))
+        with self._lock:
+            missing = [d for d in texts if d not in self._description_embeddings]
+        if not missing:
+            return
+        vectors = self._normalize(np.asarray(self.embed_model.get_text_embedding_batch([texts[d] for d in missing]),
+                                             dtype=np.float32))
+        with self._lock:
+            self._description_embeddings.update(zip(missing, vectors))
+
+    def _rank(self, choices: Sequence[ToolMetadata], query_embedding: List[float]) -> Tuple[np.ndarray, np.ndarray]:
+        self.precompute([choice.description for choice in choices])
+        matrix = np.stack([self._description_embeddings[choice.description] for choice in choices])
+        scores = matrix @ self._normalize(np.asarray(query_embedding, dtype=np.float32))
+        return scores, np.argsort(-scores, kind="stable")
+
+    def _confident_result(self, choices: Sequence[ToolMetadata], query_embedding: List[float]) \
+            -> Optional[SelectorResult]:
+        scores, order = self._rank(choices, query_embedding)
+        top = int(order[0])
+        second = float(scores[order[1]]) if len(order) > 1 else -1.0
+        if self.fallback is not None and (scores[top] < self.threshold or scores[top] - second < self.margin):
+            return None
+        reason = f"Top similarity match: {scores[top]:.2f}, {choices[top].name or choices[top].description}"
+        return SelectorResult(selections=[SingleSelection(index=top, reason=reason)])
+
+    def _select(self, choices: Sequence[ToolMetadata], query: QueryBundle) -> SelectorResult:
+        query_embedding = query.embedding or self.embed_model.get_query_embedding(query.query_str)
+        result = self._confident_result(choices, query_embedding)
+        if result is None:
+            return self.fallback.select(choices, query)
+        return result
+
+    async def _aselect(self, choices: Sequence[ToolMetadata], query: QueryBundle) -> SelectorResult:
+        query_embedding = query.embedding or await self.embed_model.aget_query_embedding(query.query_str)
+        result = self._confident_result(choices, query_embedding)
+        if result is None:
+            return await self.fallback.aselect(choices, query)
+        return result
+
+
+def create_selector(service_context: ServiceContext = None) -> BaseSelector:
+    service_context = service_context or ServiceContext.from_defaults()
+    return EmbeddingThresholdSelector(
+        service_context.embed_model,
+        threshold=ROUTE_EMBED_THRESHOLDS.get(service_context.embed_model.model_name, ROUTE_EMBED_THRESHOLD),
+        fallback=LLMSingleSelector.from_defaults(service_context=service_context,
+                                                 prompt_template_str=CH_SINGLE_SELECT_PROMPT_TMPL),
+    )
@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Sequence
+
+from llama_index.response_synthesizers import TreeSummarize
+from llama_index.types import RESPONSE_TEXT_TYPE
+
+from common.config import LLM_MAX_CONCURRENCY
+from common.utils import submit_with_context
+
+
+class ParallelTreeSummarize(TreeSummarize):
+    """TreeSummarize 在同步调用时每一层的chunk是逐个总结的，这里把同一层的所有chunk并发总结
+
+    每一层都会先repack，让每个prompt尽量填满context window，chunk数量越少llm调用越少
+    异步的 aget_response 本身就是并发的，并发数由 CachedLLM 的 RequestLimiter 限制
+    """
+
+    def __init__(self, max_workers: int = LLM_MAX_CONCURRENCY, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._max_workers = max_workers
+
+    def _summarize_level(self, summary_template, text_chunks: Sequence[str], **response_kwargs: Any):
+        def summarize(text_chunk: str) -> str:
+            return self._service_context.llm_predictor.predict(
+                summary_template,
+                output_cls=self._output_cls,
+                context_str=text_chunk,
+                **response_kwargs,
+            )
+
+        with ThreadPoolExecutor(max_workers=min(self._max_workers, len(text_chunks))) as executor:
+            # 按chunk的顺序取结果，下一层的输入和串行总结时一致
+            futures = [submit_with_context(executor, summarize, text_chunk) for text_chunk in text_chunks]
+            return [future.result() for future in futures]
+
+    def get_response(
+            self,
+            query_str: str,
+            text_chunks: Sequence[str],
+            **response_kwargs: Any,
+    ) -> RESPONSE_TEXT_TYPE:
+        summary_template = self._summary_template.partial_format(query_str=query_str)
+        prompt_helper = self._service_context.prompt_helper
+        text_chunks = prompt_helper.repack(summary_template, text_chunks=text_chunks)
+        level = 0
+        while len(text_chunks) > 1:
+            if self._verbose:
+                print(f"level {level}: {len(text_chunks)} text chunks after repacking")
+            summaries = self._summarize_level(summary_template, text_chunks, **response_kwargs)
+            text_chunks = prompt_helper.repack(summary_template, text_chunks=summaries)
+            level += 1
+
+        # 只剩一个chunk时生成最终答案
+        if self._streaming:
+            return self._service_context.llm_predictor.stream(
+                summary_template, context_str=text_chunks[0], **response_kwargs
+            )
+        response = self._service_context.llm_predictor.predict(
+            summary_template,
+            output_cls=self._output_cls,
+            context_str=text_chunks[0],
+            **response_kwargs,
+        )
+        return response if self._output_cls is None else self._output_cls.parse_raw(response)
@@ -9,7 +9,7 @@ from query_todo.query_engine import DocumentQueryEngineFactory, create_response_
 
 
 def create_compose_query_engine(city_indices: Dict[str, List[BaseIndex]],
-                                service_context: ServiceContext) -> BaseQueryEngine:
+                                service_context: ServiceContext, streaming: bool = False) -> BaseQueryEngine:
     query_engines = []
     for city, indices in city_indices.items():
         summary = f"""
@@ -23,5 +23,6 @@ def create_compose_query_engine(city_indices: Dict[str, List[BaseIndex]],
         ))
     # TODO
     # 创建一个 ComposableGraphQueryEngine, 组合多个城市的 query_engine
+    # 最后的答案合成使用 create_response_synthesizer(service_context, streaming=streaming)
     # https://docs.llamaindex.ai/en/stable/module_guides/indexing/composability.html#querying-the-graph
     raise NotImplementedError
\ No newline at end of file
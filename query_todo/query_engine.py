@@ -3,7 +3,7 @@ import os
 from dataclasses import dataclass
 from typing import List, Dict, Optional
 
-from llama_index import ServiceContext, get_response_synthesizer, VectorStoreIndex, StorageContext, \
+from llama_index import ServiceContext, get_response_synthesizer, VectorStoreIndex, \
     load_indices_from_storage, TreeIndex
 from llama_index.indices.base import BaseIndex
 from llama_index.indices.postprocessor import LLMRerank
@@ -11,13 +11,14 @@ from llama_index.indices.tree.base import TreeRetrieverMode
 from llama_index.query_engine import RetrieverQueryEngine
 from llama_index.response_synthesizers import ResponseMode, BaseSynthesizer
 
-from common.config import index_dir
+from common.config import OLD_INDEX_SUFFIX, PARTIAL_INDEX_SUFFIX, index_dir
 from common.prompt import CH_CHOICE_SELECT_PROMPT, CH_TREE_SUMMARIZE_PROMPT
+from common.vector_store import load_storage_context
 from query_todo.retrievers import MultiRetriever
 
 
 def load_index(title: str, service_context: ServiceContext = None) -> List[BaseIndex]:
-    storage_context = StorageContext.from_defaults(persist_dir=os.path.join(index_dir, title))
+    storage_context = load_storage_context(os.path.join(index_dir, title))
     return load_indices_from_storage(
         storage_context=storage_context,
         service_context=service_context,
@@ -27,12 +28,16 @@ def load_index(title: str, service_context: ServiceContext = None) -> List[BaseI
 def load_indices(service_context: ServiceContext) -> Dict[str, List[BaseIndex]]:
     indices: Dict[str, List[BaseIndex]] = {}
     for title in os.listdir(index_dir):
+        # 跳过还没有构建完成的索引，以及增量更新替换时暂存的旧索引
+        if title.endswith((PARTIAL_INDEX_SUFFIX, OLD_INDEX_SUFFIX)):
+            continue
         indices[title] = load_index(title, service_context)
     return indices
 
 
-def create_response_synthesizer(service_context: ServiceContext = None) -> BaseSynthesizer:
+def create_response_synthesizer(service_context: ServiceContext = None, streaming: bool = False) -> BaseSynthesizer:
     # TODO
+    # streaming=True 时最后一次总结以token流的形式返回 StreamingResponse
     # https://docs.llamaindex.ai/en/stable/module_guides/querying/response_synthesizers/root.html#get-started
     raise NotImplementedError
 
@@ -8,12 +8,12 @@ from llama_index.indices.base import BaseIndex
 from llama_index.indices.query.base import BaseQueryEngine
 from llama_index.llms.base import LLM
 from llama_index.prompts.mixin import PromptMixinType
-from llama_index.response.schema import RESPONSE_TYPE, Response
+from llama_index.response.schema import RESPONSE_TYPE, Response, StreamingResponse
 from llama_index.selectors import LLMSingleSelector
 from llama_index.tools import QueryEngineTool
 
 from common.config import DEBUG, LLM_CACHE_ENABLED
-from common.llm import llm_predict, create_llm
+from common.llm import llm_predict, llm_stream_predict, create_llm
 from common.prompt import CH_SINGLE_SELECT_PROMPT_TMPL
 from common.utils import ObjectEncoder
 from query_todo.query_engine import load_indices
@@ -37,14 +37,17 @@ class EchoNameEngine(BaseQueryEngine):
 
 class LlmQueryEngine(BaseQueryEngine):
 
-    def __init__(self, llm: LLM, callback_manager: CallbackManager):
+    def __init__(self, llm: LLM, callback_manager: CallbackManager, streaming: bool = False):
         self.llm = llm
+        self.streaming = streaming
         super().__init__(callback_manager=callback_manager)
 
     def _get_prompt_modules(self) -> PromptMixinType:
         return {}
 
     def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        if self.streaming:
+            return StreamingResponse(llm_stream_predict(self.llm, query_bundle.query_str))
         return Response(llm_predict(self.llm, query_bundle.query_str))
 
     async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
@@ -62,7 +65,7 @@ def create_route_query_engine(query_engines: List[BaseQueryEngine], descriptions
 
 class Chatter:
 
-    def __init__(self):
+    def __init__(self, streaming: bool = False):
         if DEBUG:
             debug_handler = LlamaDebugHandler()
             cb_manager = CallbackManager([debug_handler])
@@ -79,12 +82,15 @@ class Chatter:
         self.service_context = service_context
         self.llm = llm
         self.debug_handler = debug_handler
+        # streaming=True 时 chat 返回 StreamingResponse，边生成边输出答案
+        self.streaming = streaming
         self.query_engine = self.create_query_engine()
 
     def create_query_engine(self):
-        index_query_engine = create_compose_query_engine(self.city_indices, self.service_context)
+        index_query_engine = create_compose_query_engine(self.city_indices, self.service_context,
+                                                         streaming=self.streaming)
         index_summary = f"提供 {', '.join(self.city_indices.keys())} 这几个城市的相关信息"
-        llm_query_engine = LlmQueryEngine(llm=self.llm, callback_manager=self.cb_manager)
+        llm_query_engine = LlmQueryEngine(llm=self.llm, callback_manager=self.cb_manager, streaming=self.streaming)
         llm_summary = f"提供其他所有信息"
         # 实现意图识别，把不同的query路由到不同的query_engine上，实现聊天和城市信息查询两个功能的分流
         # https://docs.llamaindex.ai/en/stable/module_guides/querying/router/root.html#using-as-a-query-engine
@@ -1,23 +1,81 @@
 #! coding=utf-8
+import asyncio
+import atexit
+import contextvars
+import json
 import os
-from typing import cast
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Optional, cast
+from urllib.parse import parse_qs, urlparse
 
-from llama_index import VectorStoreIndex, ServiceContext, QueryBundle, TreeIndex
+# 必须在导入项目模块之前设置：测试产生的llm和embedding缓存写到临时目录，不写入仓库的 .llm_cache
+_TEST_CACHE_DIR = tempfile.mkdtemp(prefix="test_llm_cache_")
+os.environ.setdefault("LLM_CACHE_DIR", _TEST_CACHE_DIR)
+atexit.register(shutil.rmtree, _TEST_CACHE_DIR, ignore_errors=True)
+
+import numpy as np
+import pytest
+from llama_index import VectorStoreIndex, ServiceContext, QueryBundle, TreeIndex, StorageContext
+from llama_index.callbacks import CallbackManager, CBEventType, EventPayload
+from llama_index.data_structs.data_structs import IndexGraph
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.indices.base_retriever import BaseRetriever
 from llama_index.indices.postprocessor import LLMRerank
 from llama_index.indices.vector_store import VectorIndexRetriever
+from llama_index.llms import CompletionResponse, LLMMetadata, MockLLM
 from llama_index.query_engine import ComposableGraphQueryEngine
+from llama_index.response.schema import StreamingResponse
 from llama_index.response_synthesizers import TreeSummarize
 from llama_index.schema import TextNode, NodeWithScore
+from llama_index.selectors.types import BaseSelector, SelectorResult, SingleSelection
+from llama_index.token_counter.mock_embed_model import MockEmbedding
+from llama_index.tools.types import ToolMetadata
+from llama_index.vector_stores import SimpleVectorStore
+from llama_index.vector_stores.types import VectorStoreQuery
 
-from common.llm import create_llm
-from common.prompt import CH_TREE_SUMMARIZE_PROMPT
+import build.index
+import common.cache
+from build.checkpoint import BuildCheckpoint
+from build.download import download_all
+from build.index import TREE_NUM_CHILDREN
+from build.ingest import iter_nodes
+from build.tree import TreeBuilder
+from common.cache import CacheBudget, CacheItem, FileCacheStore, SqliteCacheStore, LRUCacheStore, drop_legacy, \
+    legacy_paths, versioned_dir
+from common.config import RETRIEVE_MAX_WORKERS
+from common.embedding import CachedEmbedding, EmbeddingStore, create_embed_model
+from common.fake import FakeEmbedding, FakeLLM
+from common.metrics import MetricsHandler
+from common.llm import create_llm, CachedLLM, CacheRequest, RequestLimiter
+from common.prompt import CH_SUMMARY_PROMPT, CH_TREE_SUMMARIZE_PROMPT
+from common.single_flight import SingleFlight
 from common.utils import find_typed
+from common.vector_store import NumpyVectorStore, load_storage_context, migrate_legacy_vector_store
+from evaluate import evaluate_retrievers
+import query.registry
+import query.route
+from query.answer_cache import SemanticAnswerCache
+from query.compose import city_summary
+from query.postprocessor import ParallelLLMRerank
+from query.query_engine import load_index as load_city_index
+from query.registry import CityIndexRegistry
+from query.selectors import EmbeddingThresholdSelector, create_selector
+from query.synthesizer import ParallelTreeSummarize
 from import_route import download
 from import_route import download_and_build_index, data_dir, index_dir, build_all, build_nodes
 from import_route import create_compose_query_engine
 from import_route import load_index, DocumentQueryEngineFactory, create_response_synthesizer, load_indices
 from import_route import MultiRetriever
 from import_route import EchoNameEngine, create_route_query_engine, Chatter
+from query.retrievers import FusionMode, MultiRetriever as ReferenceMultiRetriever
+from query.route import Chatter as ReferenceChatter
 
 test_llm = create_llm()
 
@@ -98,7 +156,8 @@ def test_compose_query_engine():
     city_indices = load_indices(service_context)
     query_engine = create_compose_query_engine(city_indices, service_context)
     compose_engine = cast(ComposableGraphQueryEngine, query_engine)
-    assert len(compose_engine._custom_query_engines) == len(city_indices)
+    # 除了每个城市的query engine，还有根节点的query engine
+    assert len(compose_engine._custom_query_engines) == len(city_indices) + 1
     beijing_response = compose_engine.query(QueryBundle(query_str="北京气候如何"))
     hangzhou_response = compose_engine.query(QueryBundle(query_str="深圳气候如何"))
     wuxi_response = compose_engine.query(QueryBundle(query_str="无锡气候如何"))
@@ -122,3 +181,808 @@ def test_route_query_engine():
     print(chatter.chat("你好呀"))
     print(chatter.chat("北京气候如何"))
     print(chatter.chat("深圳在中国什么位置"))
+
+
+class CountingLLM(MockLLM):
+    # 记录实际发给模型的prompt，缓存命中时不增加；用私有属性，不会进入缓存的key
+    _prompts: list = PrivateAttr(default_factory=list)
+
+    @property
+    def prompts(self) -> list:
+        return self._prompts
+
+    def complete(self, prompt, **kwargs):
+        self._prompts.append(prompt)
+        return super().complete(prompt, **kwargs)
+
+    def stream_complete(self, prompt, **kwargs):
+        self._prompts.append(prompt)
+        return super().stream_complete(prompt, **kwargs)
+
+
+def test_llm_cache(tmp_path):
+    store = SqliteCacheStore(str(tmp_path / "llm_cache.sqlite3"), batch_size=2)
+    llm = CachedLLM(MockLLM(), str(tmp_path), enable_cache=True, cache_store=LRUCacheStore(store, capacity=1))
+    assert llm.complete("北京气候如何").text == "北京气候如何"
+    assert llm.complete("深圳气候如何").text == "深圳气候如何"
+    store.close()
+    reopened = CachedLLM(CountingLLM(), str(tmp_path), enable_cache=True,
+                         cache_store=SqliteCacheStore(str(tmp_path / "llm_cache.sqlite3")))
+    assert reopened.complete("北京气候如何").text == "北京气候如何"
+    assert reopened.complete("无锡气候如何").text == "无锡气候如何"
+    assert reopened.llm.prompts == ["无锡气候如何"]
+    # max_tokens 不同的请求不共用缓存
+    reopened.llm = MockLLM(max_tokens=1)
+    assert reopened.complete("北京气候如何").text == "text"
+
+
+def test_llm_async_cache(tmp_path):
+    llm = CachedLLM(CountingLLM(), str(tmp_path), enable_cache=True,
+                    cache_store=SqliteCacheStore(str(tmp_path / "llm_cache.sqlite3")))
+
+    async def run():
+        return await asyncio.gather(*[llm.acomplete(f"问题{i}") for i in range(4)])
+
+    assert [r.text for r in asyncio.run(run())] == [f"问题{i}" for i in range(4)]
+    # 异步调用和同步调用共用同一份缓存
+    assert llm.complete("问题0").text == "问题0"
+    assert len(llm.llm.prompts) == 4
+
+
+def test_llm_stream_cache(tmp_path):
+    llm = CachedLLM(CountingLLM(), str(tmp_path), enable_cache=True,
+                    cache_store=SqliteCacheStore(str(tmp_path / "llm_cache.sqlite3")))
+    answers = []
+    threads = [threading.Thread(target=lambda: answers.append("".join(r.delta for r in llm.stream_complete("北京"))))
+               for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert answers == ["北京"] * 3
+    assert "".join(r.delta for r in llm.stream_complete("北京")) == "北京"
+    assert llm.llm.prompts == ["北京"]
+
+
+def test_single_flight_context():
+    # 上游流在后台线程里读取，沿用发起请求时的contextvars
+    var = contextvars.ContextVar("query", default=None)
+    token = var.set("北京")
+    try:
+        assert list(SingleFlight().stream("key", lambda: iter([var.get()]), lambda chunks: None)) == ["北京"]
+    finally:
+        var.reset(token)
+
+
+class ContextRetriever(BaseRetriever):
+    def __init__(self, var: contextvars.ContextVar):
+        self.var = var
+
+    def _retrieve(self, query_bundle: QueryBundle):
+        return [NodeWithScore(node=TextNode(text=self.var.get(), id_="context"), score=1.0)]
+
+
+def test_multi_retriever_context():
+    # 线程池里的召回沿用发起查询时的contextvars，同步和异步召回都一样
+    var = contextvars.ContextVar("query", default=None)
+
+    async def aretrieve():
+        var.set("上海")
+        return await retriever.aretrieve("气候如何")
+
+    retriever = ReferenceMultiRetriever([ContextRetriever(var)])
+    token = var.set("北京")
+    try:
+        assert [n.text for n in retriever.retrieve("气候如何")] == ["北京"]
+        assert [n.text for n in asyncio.run(aretrieve())] == ["上海"]
+        # registry 反复重新加载索引时会不断创建新的 MultiRetriever，召回线程不随实例增加
+        retrievers = [ReferenceMultiRetriever([ContextRetriever(var)] * 2) for _ in range(2 * RETRIEVE_MAX_WORKERS)]
+        for retriever in retrievers:
+            retriever.retrieve("气候如何")
+        threads = [t for t in threading.enumerate() if t.name.startswith("multi_retriever")]
+        assert len(threads) <= RETRIEVE_MAX_WORKERS
+    finally:
+        var.reset(token)
+
+
+class SleepRetriever(BaseRetriever):
+    def __init__(self, seconds: float, texts):
+        self.seconds = seconds
+        self.texts = texts
+
+    def _retrieve(self, query_bundle: QueryBundle):
+        time.sleep(self.seconds)
+        return [NodeWithScore(node=TextNode(text=text, id_=text), score=1.0) for text in self.texts]
+
+
+def test_multi_retriever_timeout():
+    retriever = ReferenceMultiRetriever([SleepRetriever(0.2, ["北京"]), SleepRetriever(0.2, ["上海"]),
+                                         SleepRetriever(3, ["深圳"])], timeout=0.5)
+    start = time.monotonic()
+    nodes = retriever.retrieve("气候如何")
+    assert time.monotonic() - start < 1
+    assert sorted(n.text for n in nodes) == ["上海", "北京"]
+    nodes = asyncio.run(retriever.aretrieve("气候如何"))
+    assert sorted(n.text for n in nodes) == ["上海", "北京"]
+
+
+def test_multi_retriever_fusion():
+    retrievers = [SleepRetriever(0, ["北京", "上海", "深圳"]), SleepRetriever(0, ["上海", "无锡"])]
+    rrf = ReferenceMultiRetriever(retrievers, fusion_mode=FusionMode.RECIPROCAL_RANK, top_k=2)
+    assert [n.text for n in rrf.retrieve("气候如何")] == ["上海", "北京"]
+    weighted = ReferenceMultiRetriever(retrievers, fusion_mode=FusionMode.WEIGHTED, weights=[1.0, 0.1])
+    assert [n.text for n in weighted.retrieve("气候如何")] == ["上海", "北京", "深圳", "无锡"]
+
+
+class CountingEmbedding(MockEmbedding):
+    batches: list = []
+
+    def _get_text_embeddings(self, texts):
+        self.batches.append(list(texts))
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+def test_cached_embedding(tmp_path):
+    embed_model = CachedEmbedding(CountingEmbedding(embed_dim=2), str(tmp_path),
+                                  store=EmbeddingStore(str(tmp_path / "embeddings.sqlite3")))
+    assert embed_model.get_text_embedding_batch(["北京", "上海市", "北京"]) == [[2.0, 1.0], [3.0, 1.0], [2.0, 1.0]]
+    assert embed_model.get_text_embedding_batch(["上海市", "深圳"]) == [[3.0, 1.0], [2.0, 1.0]]
+    assert embed_model.embed_model.batches == [["北京", "上海市"], ["深圳"]]
+
+
+def test_request_limiter(tmp_path):
+    # 同步调用和两个event loop里的异步调用共用2个名额
+    limiter = RequestLimiter(2)
+    active, peaks, lock = [0], [], threading.Lock()
+
+    def enter():
+        with lock:
+            active[0] += 1
+            peaks.append(active[0])
+
+    def leave():
+        with lock:
+            active[0] -= 1
+
+    def sync_call():
+        with limiter.sync_slot():
+            enter()
+            time.sleep(0.05)
+            leave()
+
+    async def async_call():
+        async with limiter.async_slot():
+            enter()
+            await asyncio.sleep(0.05)
+            leave()
+
+    async def async_calls():
+        await asyncio.gather(*[async_call() for _ in range(4)])
+
+    threads = [threading.Thread(target=sync_call) for _ in range(4)]
+    threads += [threading.Thread(target=asyncio.run, args=(async_calls(),)) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(peaks) == 12 and max(peaks) == 2
+
+    # 等待中被取消的异步调用不会占用名额
+    limiter = RequestLimiter(1)
+
+    async def cancel_waiting():
+        task = asyncio.ensure_future(async_call())
+        await asyncio.sleep(0.05)
+        task.cancel()
+
+    with limiter.sync_slot():
+        asyncio.run(cancel_waiting())
+    time.sleep(0.05)
+    with limiter.sync_slot():
+        pass
+
+    # embedding请求也经过同一个限流器
+    embed_model = CachedEmbedding(CountingEmbedding(embed_dim=2), str(tmp_path), limiter=limiter,
+                                  store=EmbeddingStore(str(tmp_path / "embeddings.sqlite3")))
+    with limiter.sync_slot():
+        t = threading.Thread(target=embed_model.get_text_embedding, args=("无锡",))
+        t.start()
+        t.join(0.2)
+        assert t.is_alive()
+    t.join()
+
+
+def test_numpy_vector_store(tmp_path):
+    store = NumpyVectorStore()
+    store.add([TextNode(text=text, id_=text, embedding=embedding)
+               for text, embedding in [("北京", [1.0, 0.0]), ("上海", [0.6, 0.8]), ("深圳", [0.0, 1.0])]])
+    store.persist(str(tmp_path / "vector_store.json"))
+    store = NumpyVectorStore.from_persist_dir(str(tmp_path))
+    result = store.query(VectorStoreQuery(query_embedding=[2.0, 0.1], similarity_top_k=2))
+    assert result.ids == ["北京", "上海"]
+    store.delete_nodes(["北京"])
+    result = store.query(VectorStoreQuery(query_embedding=[2.0, 0.1], similarity_top_k=2))
+    assert result.ids == ["上海", "深圳"]
+    # 矩阵和ids一起生效，旧的矩阵文件被删除
+    store.persist(str(tmp_path / "vector_store.json"))
+    assert len([f for f in os.listdir(tmp_path) if f.endswith(".npy")]) == 1
+    assert NumpyVectorStore.from_persist_dir(str(tmp_path))._ids == ["上海", "深圳"]
+
+    # 多个写入者同时持久化到同一个目录，ids文件指向的矩阵总是存在
+    def persist_many():
+        writer = NumpyVectorStore(matrix=np.eye(2, dtype=np.float32), ids=["上海", "深圳"])
+        for _ in range(20):
+            writer.persist(str(tmp_path / "vector_store.json"))
+            assert NumpyVectorStore.from_persist_dir(str(tmp_path))._ids == ["上海", "深圳"]
+
+    threads = [threading.Thread(target=persist_many) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len([f for f in os.listdir(tmp_path) if f.endswith(".npy")]) == 1
+
+
+def test_legacy_vector_store(tmp_path):
+    simple_store = SimpleVectorStore()
+    simple_store.add([TextNode(text=text, id_=text, embedding=embedding)
+                      for text, embedding in [("北京", [1.0, 0.0]), ("深圳", [0.0, 1.0])]])
+    simple_store.persist(str(tmp_path / "vector_store.json"))
+    files = sorted(os.listdir(tmp_path))
+    # 查询时只在内存里转换，不写索引目录
+    store = NumpyVectorStore.from_persist_dir(str(tmp_path))
+    assert store.query(VectorStoreQuery(query_embedding=[0.1, 1.0], similarity_top_k=1)).ids == ["深圳"]
+    assert sorted(os.listdir(tmp_path)) == files
+    # 构建时转换一次
+    assert migrate_legacy_vector_store(str(tmp_path)) and not migrate_legacy_vector_store(str(tmp_path))
+    assert NumpyVectorStore.from_persist_dir(str(tmp_path))._ids == ["北京", "深圳"]
+
+
+class KeywordEmbedding(MockEmbedding):
+    def _get_vector(self, text):
+        return [float("北京" in text), float("上海" in text), 0.1]
+
+    def _get_text_embedding(self, text):
+        return self._get_vector(text)
+
+    def _get_query_embedding(self, query):
+        return self._get_vector(query)
+
+
+class FixedSelector(BaseSelector):
+    def __init__(self, index):
+        self.index = index
+        self.calls = 0
+
+    def _get_prompts(self):
+        return {}
+
+    def _update_prompts(self, prompts):
+        pass
+
+    def _select(self, choices, query):
+        self.calls += 1
+        return SelectorResult(selections=[SingleSelection(index=self.index, reason="llm")])
+
+    async def _aselect(self, choices, query):
+        return self._select(choices, query)
+
+
+def test_embedding_selector():
+    fallback = FixedSelector(1)
+    selector = EmbeddingThresholdSelector(KeywordEmbedding(embed_dim=3), fallback=fallback, threshold=0.8)
+    choices = ["北京的相关信息", "上海的相关信息"]
+    assert selector.select(choices, "北京气候如何").ind == 0
+    assert selector.select(choices, "上海在哪里").ind == 1
+    assert fallback.calls == 0
+    # 和两个选项都不相关的问题交给llm选择
+    assert selector.select(choices, "你好呀").ind == 1
+    assert fallback.calls == 1
+
+
+def test_semantic_answer_cache():
+    versions = {"北京": 1}
+    current_versions = lambda cities: {city: versions[city] for city in cities}
+    cache = SemanticAnswerCache(threshold=0.95, ttl=60, capacity=2)
+    cache.put("北京的人口是多少", [1.0, 0.1], "2184万", {"北京": 1})
+    assert cache.get([1.0, 0.12], current_versions) == "2184万"
+    assert cache.get([0.1, 1.0], current_versions) is None
+    # 北京的索引重新构建后缓存失效
+    versions["北京"] = 2
+    assert cache.get([1.0, 0.1], current_versions) is None
+    assert len(cache) == 0
+    cache.put("你好", [0.0, 1.0], "你好")
+    cache.ttl = -1
+    assert cache.get([0.0, 1.0], current_versions) is None
+    # 只差城市名的问题embedding几乎相同，路由到的城市不同时不命中
+    cache.ttl = 60
+    cache.put("北京气候如何", [1.0, 0.1], "北京四季分明", {"北京": 2}, frozenset(["北京"]))
+    assert cache.get([1.0, 0.11], current_versions, frozenset(["深圳"])) is None
+    assert cache.get([1.0, 0.11], current_versions, frozenset(["北京"])) == "北京四季分明"
+
+
+class SlowSummaryLLM(MockLLM):
+    active: list = []
+    peaks: list = []
+
+    @property
+    def metadata(self):
+        return LLMMetadata(context_window=600, num_output=100)
+
+    def complete(self, prompt, **kwargs):
+        self.active.append(prompt)
+        time.sleep(0.1)
+        self.peaks.append(len(self.active))
+        self.active.remove(prompt)
+        return CompletionResponse(text="小结")
+
+
+def test_parallel_tree_summarize():
+    llm = SlowSummaryLLM()
+    service_context = ServiceContext.from_defaults(llm=llm, embed_model=MockEmbedding(embed_dim=2))
+    synthesizer = ParallelTreeSummarize(summary_template=CH_TREE_SUMMARIZE_PROMPT, service_context=service_context)
+    nodes = [NodeWithScore(node=TextNode(text=f"第{i}段" + "北京的气候很好。" * 30)) for i in range(8)]
+    assert synthesizer.synthesize("北京气候如何", nodes).response == "小结"
+    # 同一层的chunk是并发总结的
+    assert max(llm.peaks) > 1
+
+
+class FlakySummaryLLM(MockLLM):
+    calls: list = []
+
+    def complete(self, prompt, **kwargs):
+        self.calls.append(prompt)
+        if len(self.calls) == 1:
+            raise ConnectionError("timeout")
+        return CompletionResponse(text="小结")
+
+
+def test_tree_builder():
+    llm = FlakySummaryLLM()
+    service_context = ServiceContext.from_defaults(llm=llm, embed_model=MockEmbedding(embed_dim=2))
+    storage_context = StorageContext.from_defaults()
+    nodes = [TextNode(text=f"第{i}段") for i in range(20)]
+    builder = TreeBuilder(4, CH_SUMMARY_PROMPT, service_context, storage_context.docstore, retry_backoff=0)
+    index_graph = builder.build(nodes)
+    # 20个叶子 -> 5个parent -> 2个parent，第一次失败的summary请求被重试
+    assert [count for count, _ in builder.level_timings] == [5, 2]
+    assert len(index_graph.root_nodes) == 2
+    assert len(llm.calls) == 8
+    assert all(storage_context.docstore.document_exists(node_id) for node_id in index_graph.root_nodes.values())
+
+
+def test_iter_nodes(tmp_path):
+    data_file = tmp_path / "城市"
+    paragraphs = [f"第{i}段：" + "".join(f"{i}号区的第{j}项指标是{i * j}。" for j in range(60)) for i in range(40)]
+    data_file.write_text("\n\n".join(paragraphs), encoding="utf-8")
+    text = data_file.read_text(encoding="utf-8")
+    node_parser = build.index.service_context.node_parser
+    whole = list(iter_nodes(str(data_file), node_parser, block_chars=len(text) + 1))
+    # 分成多块解析，块边界上的overlap不丢失，char_idx是在整个文件中的位置
+    for block_chars in (8000, 3000):
+        nodes = list(iter_nodes(str(data_file), node_parser, block_chars=block_chars))
+        assert [node.get_content() for node in nodes] == [node.get_content() for node in whole]
+        assert all(text[node.start_char_idx:node.end_char_idx] == node.get_content() for node in nodes)
+        assert len({node.ref_doc_id for node in nodes}) == 1
+        assert all(node.next_node.node_id == next_node.node_id and next_node.prev_node.node_id == node.node_id
+                   for node, next_node in zip(nodes, nodes[1:]))
+
+
+class BuildInterrupted(BaseException):
+    # 和 KeyboardInterrupt 一样不会被summary的重试捕获
+    pass
+
+
+class InterruptingLLM(FakeLLM):
+    # 第 fail_after 次调用，或者prompt里包含 fail_on 时中断
+    fail_after: int = 10 ** 6
+    fail_on: Optional[str] = None
+
+    def _respond(self, prompt):
+        if self.calls >= self.fail_after or (self.fail_on and self.fail_on in prompt):
+            raise BuildInterrupted()
+        return super()._respond(prompt)
+
+
+@pytest.fixture
+def fake_build_models(tmp_path, monkeypatch) -> ServiceContext:
+    # 构建索引时使用本地模拟的llm和embedding，数据和索引都放在 tmp_path 下；llm默认不中断
+    service_context = ServiceContext.from_defaults(llm=InterruptingLLM(latency=0), embed_model=FakeEmbedding(latency=0),
+                                                   node_parser=build.index.service_context.node_parser)
+    monkeypatch.setattr(build.index, "service_context", service_context)
+    monkeypatch.setattr(build.index, "data_dir", str(tmp_path / "data"))
+    monkeypatch.setattr(build.index, "index_dir", str(tmp_path / "index"))
+    return service_context
+
+
+CITY_TEXTS = {"北京": "北京是中国的首都，有故宫和天安门。", "上海": "上海是经济中心，有外滩和东方明珠。",
+              "深圳": "深圳是科技创新城市，毗邻香港。"}
+
+
+def build_cities(texts: Dict[str, str]) -> str:
+    # 每个城市一个node的小索引，返回索引目录
+    for city, text in texts.items():
+        build.index.build_index_from_nodes(os.path.join(build.index.index_dir, city), [TextNode(text=text * 3)])
+    return build.index.index_dir
+
+
+def test_update_index(tmp_path, fake_build_models):
+    llm, embed_model = fake_build_models.llm, fake_build_models.embed_model
+    data_file = tmp_path / "城市"
+    paragraphs = [f"第{i}段：" + "".join(f"{i}号区的第{j}项指标是{i * j}。" for j in range(60)) for i in range(40)]
+    data_file.write_text("\n\n".join(paragraphs), encoding="utf-8")
+    index_file = os.path.join(build.index.index_dir, "城市")
+    build.index.build_index_from_nodes(index_file, build.index.build_nodes(str(data_file)))
+
+    def snapshot():
+        storage_context = load_storage_context(index_file)
+        tree = find_typed(storage_context.index_store.index_structs(), IndexGraph)
+        return set(storage_context.vector_store._ids), set(tree.all_nodes.values()), (llm.calls, embed_model.calls)
+
+    leaf_ids, tree_ids, calls = snapshot()
+    assert len(tree_ids) > len(leaf_ids) > TREE_NUM_CHILDREN
+    # 文件被重新下载，只有日期类的metadata变化，所有的embedding和summary都沿用
+    mtime = data_file.stat().st_mtime - 3 * 86400
+    os.utime(data_file, (mtime, mtime))
+    build.index.update_index(index_file, build.index.build_nodes(str(data_file)))
+    assert snapshot() == (leaf_ids, tree_ids, calls)
+    # 修改最后一段，只重新计算末尾node的embedding和它们所在分支的summary
+    data_file.write_text("\n\n".join(paragraphs[:-1] + ["最后一段被修改了。"]), encoding="utf-8")
+    build.index.update_index(index_file, build.index.build_nodes(str(data_file)))
+    new_leaf_ids, new_tree_ids, new_calls = snapshot()
+    assert 0 < len(leaf_ids - new_leaf_ids) < len(leaf_ids) / 4
+    assert new_calls[1] == calls[1] + 1 and new_calls[0] - calls[0] < calls[0] / 2
+
+
+def test_update_index_insert_middle(fake_build_models):
+    # 100个叶子 -> 13个parent -> 2个parent，在中间插入一个chunk，每层只重新生成插入位置附近的summary
+    llm = fake_build_models.llm
+    index_file = os.path.join(build.index.index_dir, "城市")
+    texts = [f"第{i}段" for i in range(100)]
+    build.index.build_index_from_nodes(index_file, [TextNode(text=text) for text in texts])
+    calls = llm.calls
+    assert calls == 13 + 2
+    texts.insert(50, "插入的一段")
+    build.index.update_index(index_file, [TextNode(text=text) for text in texts])
+    assert llm.calls - calls <= 2 * 2
+    tree = find_typed(load_storage_context(index_file).index_store.index_structs(), IndexGraph)
+    num_parents = sum(1 for children_ids in tree.node_id_to_children_ids.values() if children_ids)
+    assert len(tree.all_nodes) == 101 + num_parents and num_parents <= 13 + 2 + 2
+
+
+def test_resume_build(fake_build_models):
+    # 100个叶子 -> 13个parent -> 2个parent，第二层的第一个summary请求时中断
+    service_context = fake_build_models
+    llm = service_context.llm
+    llm.fail_after = 13
+    index_file = os.path.join(build.index.index_dir, "城市")
+    nodes = [TextNode(text=f"第{i}段") for i in range(100)]
+    with pytest.raises(BuildInterrupted):
+        build.index.build_index_from_nodes(index_file, nodes)
+    assert not os.path.exists(index_file)
+    checkpoint = BuildCheckpoint(index_file)
+    assert checkpoint.load() and len(checkpoint.tree_parents()) == 13 and len(checkpoint.embedded_ids()) == 100
+
+    # 继续构建只生成第二层的summary，embedding和第一层的summary都不重新计算
+    llm.fail_after = 1000
+    embed_calls = service_context.embed_model.calls
+    build.index.build_index_from_checkpoint(checkpoint)
+    assert llm.calls == 15 and service_context.embed_model.calls == embed_calls
+    assert os.path.exists(index_file) and not os.path.exists(checkpoint.partial_dir)
+    storage_context = load_storage_context(index_file)
+    assert len(find_typed(storage_context.index_store.index_structs(), IndexGraph).all_nodes) == 115
+    assert len(storage_context.vector_store._ids) == 100
+    # 增量更新在副本上进行，中断时原来的索引不受影响
+    llm.fail_after = llm.calls
+    with pytest.raises(BuildInterrupted):
+        build.index.update_index(index_file, [TextNode(text=f"新的第{i}段") for i in range(100)])
+    assert load_storage_context(index_file).vector_store._ids == storage_context.vector_store._ids
+
+
+def test_city_index_registry(fake_build_models, monkeypatch):
+    service_context = fake_build_models
+    root_dir = build_cities(CITY_TEXTS)
+    loads = []
+    monkeypatch.setattr(query.registry, "load_index",
+                        lambda city, *args: loads.append(city) or load_city_index(city, *args))
+    registry = CityIndexRegistry(service_context, root_dir=root_dir)
+    # 启动时只扫描目录和城市简介，不加载索引
+    assert registry.cities() == ["上海", "北京", "深圳"] and registry.loaded_cities() == [] and loads == []
+    assert registry.profile("上海").startswith("上海：")
+
+    # 和 create_lazy_compose_query_engine 一样：选项是模板化的描述，embedding用城市的简介计算
+    choices = [ToolMetadata(description=city_summary(city), name=city) for city in registry.cities()]
+    selector = create_selector(service_context)
+    selector.precompute([choice.description for choice in choices],
+                        [registry.profile(city) for city in registry.cities()])
+    llm = service_context.llm
+    calls = llm.calls
+    assert choices[selector.select(choices, "上海的外滩和东方明珠在哪里").ind].name == "上海"
+    assert choices[selector.select(choices, "深圳是什么样的科技创新城市").ind].name == "深圳"
+    assert llm.calls == calls
+    # 和哪个城市都不相关的问题仍然交给llm选择
+    selector.select(choices, "你好呀")
+    assert llm.calls == calls + 1
+
+    # 内存预算只能放下两个城市
+    registry.memory_budget = 2 * max(summary.size_bytes for summary in registry.summaries.values())
+    registry.get_query_engine("北京")
+    registry.get_query_engine("上海")
+    registry.get_query_engine("北京")
+    assert loads == ["北京", "上海"]
+    registry.get_query_engine("深圳")
+    assert registry.loaded_cities() == ["北京", "深圳"]
+    # 被卸载的城市再次用到时重新加载
+    assert len(registry.get_indices("上海")) == 2
+    assert loads == ["北京", "上海", "深圳", "上海"] and registry.loaded_cities() == ["深圳", "上海"]
+
+
+def test_chatter_streaming(fake_build_models, monkeypatch):
+    root_dir = build_cities(CITY_TEXTS)
+    monkeypatch.setattr(query.route, "create_llm", lambda *args: create_llm(*args, backend="fake"))
+    monkeypatch.setattr(query.route, "create_embed_model", lambda *args: create_embed_model(*args, backend="fake"))
+    query_str = "上海的外滩和东方明珠在哪里"
+    expected = ReferenceChatter(root_dir=root_dir, debug=False, metrics=False).chat(query_str).response
+
+    chatter = ReferenceChatter(streaming=True, root_dir=root_dir, debug=False, metrics=False)
+    response = chatter.chat(query_str)
+    assert isinstance(response, StreamingResponse)
+    chunks = list(response.response_gen)
+    assert len(chunks) > 1 and "".join(chunks) == expected
+    # 流式输出结束后答案写入缓存，相同的问题不再调用llm
+    cached = chatter.chat(query_str)
+    assert not isinstance(cached, StreamingResponse) and cached.response == expected
+    # 即使相似度阈值放到最低，路由到其他城市的问题也不会拿到上海的答案
+    chatter.answer_cache.threshold = 0.0
+    other = chatter.chat("北京是中国的首都，有故宫和天安门吗")
+    assert isinstance(other, StreamingResponse) and "".join(other.response_gen) != expected
+
+
+class FakeWikiHandler(BaseHTTPRequestHandler):
+    # 模拟 MediaWiki API，记录每次请求的 prop
+    pages = {"北京": (1, "北京是中国的首都"), "上海": (2, "上海是中国的经济中心")}
+    requests = []
+
+    def do_GET(self):
+        params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        self.requests.append(params["prop"])
+        pages = []
+        for title in params["titles"].split("|"):
+            revid, text = self.pages[title]
+            page = {"title": title, "lastrevid": revid}
+            if params["prop"] == "extracts":
+                page["extract"] = text
+            pages.append(page)
+        body = json.dumps({"query": {"pages": pages}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def wiki_api(monkeypatch):
+    # 本地的模拟 MediaWiki API，测试里修改的页面和请求记录在测试结束后恢复
+    monkeypatch.setattr(FakeWikiHandler, "pages", dict(FakeWikiHandler.pages))
+    monkeypatch.setattr(FakeWikiHandler, "requests", [])
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeWikiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}/w/api.php"
+    finally:
+        server.shutdown()
+
+
+def test_build_all(fake_build_models, monkeypatch, wiki_api):
+    def document(city, last=""):
+        paragraphs = [f"{city}第{i}段：" + "".join(f"{city}{i}区的第{j}项指标是{i * j}。" for j in range(40))
+                      for i in range(12)]
+        return "\n\n".join(paragraphs[:-1] + [last or paragraphs[-1]])
+
+    FakeWikiHandler.pages = {"北京": (1, document("北京")), "深圳": (1, document("深圳"))}
+    llm, embed_model = fake_build_models.llm, fake_build_models.embed_model
+    llm.fail_on = "深圳"
+    index_dir = Path(build.index.index_dir)
+    monkeypatch.setattr(build.index, "download_all",
+                        lambda titles, data_dir: download_all(titles, data_dir, api_url=wiki_api))
+    # 两个城市同时构建，深圳的第一个summary请求时中断，北京照常完成
+    with pytest.raises(BuildInterrupted):
+        build.index.build_all(["北京", "深圳"], max_workers=2)
+    assert os.path.exists(index_dir / "北京") and not os.path.exists(index_dir / "深圳")
+    checkpoint = BuildCheckpoint(str(index_dir / "深圳"))
+    assert checkpoint.load() and len(checkpoint.embedded_ids()) == len(checkpoint.state["leaf_ids"])
+
+    # 再次运行时北京跳过，深圳从checkpoint继续，embedding不重新计算
+    llm.fail_on = None
+    embed_calls = embed_model.calls
+    build.index.build_all(["北京", "深圳"], max_workers=2)
+    assert embed_model.calls == embed_calls and not os.path.exists(checkpoint.partial_dir)
+    leaf_ids = set(load_storage_context(str(index_dir / "深圳")).vector_store._ids)
+    assert leaf_ids == set(checkpoint.state["leaf_ids"])
+
+    # 增量更新：只有深圳的最后一段变了，北京的索引不需要重新计算
+    FakeWikiHandler.pages = {**FakeWikiHandler.pages, "深圳": (2, document("深圳", "深圳的最后一段被修改了。"))}
+    llm_calls = llm.calls
+    build.index.build_all(["北京", "深圳"], max_workers=2, incremental=True)
+    assert embed_model.calls == embed_calls + 1 and 0 < llm.calls - llm_calls < llm_calls / 4
+    assert 0 < len(leaf_ids - set(load_storage_context(str(index_dir / "深圳")).vector_store._ids)) < len(leaf_ids)
+
+
+def test_download_all(tmp_path, wiki_api):
+    files = download_all(["北京", "上海"], str(tmp_path), api_url=wiki_api)
+    assert [open(f, encoding="utf-8").read() for f in files] == ["北京是中国的首都", "上海是中国的经济中心"]
+    assert FakeWikiHandler.requests == ["info", "extracts"]
+    # revision没有变化时只查询info，不再下载正文
+    download_all(["北京", "上海"], str(tmp_path), api_url=wiki_api)
+    assert FakeWikiHandler.requests == ["info", "extracts", "info"]
+    FakeWikiHandler.pages = {**FakeWikiHandler.pages, "上海": (3, "上海是直辖市")}
+    download_all(["北京", "上海"], str(tmp_path), api_url=wiki_api)
+    assert FakeWikiHandler.requests[-2:] == ["info", "extracts"]
+    assert open(files[1], encoding="utf-8").read() == "上海是直辖市"
+
+
+class KeywordRetriever(BaseRetriever):
+    # 返回query中的数字作为node id，记录被调用的query
+    def __init__(self):
+        self.queries = []
+
+    def _retrieve(self, query_bundle: QueryBundle):
+        self.queries.append(query_bundle.query_str)
+        return [NodeWithScore(node=TextNode(text="", id_=query_bundle.query_str[-1]), score=1.0)]
+
+
+def test_evaluate_retrievers(tmp_path):
+    result_file = str(tmp_path / "city.jsonl")
+    pairs = [(f"问题{i}", [str(i)]) for i in range(6)]
+    retriever = KeywordRetriever()
+    results = evaluate_retrievers({"keyword": retriever}, pairs[:4], result_file, max_workers=4)
+    assert [r.query for r in results["keyword"]] == [q for q, _ in pairs[:4]]
+    assert all(r.metric_vals_dict == {"mrr": 1.0, "hit_rate": 1.0} for r in results["keyword"])
+    # 模拟中断：结果文件末尾有写了一半的行，重新运行只评估新增的query
+    with open(result_file, "a", encoding="utf-8") as f:
+        f.write('{"retriever": "keyword", "res')
+    retriever.queries.clear()
+    results = evaluate_retrievers({"keyword": retriever}, pairs, result_file, max_workers=4)
+    assert sorted(retriever.queries) == ["问题4", "问题5"]
+    assert len(results["keyword"]) == 6
+
+
+def test_fake_models():
+    llm = FakeLLM(latency=0)
+    service_context = ServiceContext.from_defaults(llm=llm, embed_model=FakeEmbedding(latency=0))
+    # 相同的prompt得到相同的回答，rerank的输出可以被解析
+    assert llm.complete("北京").text == llm.complete("北京").text != llm.complete("上海").text
+    nodes = [NodeWithScore(node=TextNode(text=f"第{i}段")) for i in range(3)]
+    rerank = LLMRerank(top_n=2, choice_batch_size=3, service_context=service_context)
+    assert len(rerank.postprocess_nodes(nodes, QueryBundle("问题"))) == 2
+    assert llm.calls == 4
+    embed_model = service_context.embed_model
+    query = embed_model.get_query_embedding("北京的人口")
+    scores = [sum(a * b for a, b in zip(query, embed_model.get_text_embedding(text))) for text in ["北京的人口", "上海的气候"]]
+    assert scores[0] > 0.99 > scores[1]
+
+
+def test_parallel_llm_rerank():
+    latency = 0.2
+    service_context = ServiceContext.from_defaults(llm=FakeLLM(latency=latency), embed_model=FakeEmbedding(latency=0))
+    nodes = [NodeWithScore(node=TextNode(text=f"第{i}段", id_=str(i))) for i in range(12)]
+    query = QueryBundle("北京气候如何")
+    expected = LLMRerank(top_n=5, choice_batch_size=3, service_context=service_context).postprocess_nodes(nodes, query)
+    rerank = ParallelLLMRerank(top_n=5, choice_batch_size=3, service_context=service_context)
+    start = time.monotonic()
+    results = rerank.postprocess_nodes(nodes, query)
+    # 4个batch并发调用llm，结果的顺序和分数与串行的 LLMRerank 一致
+    assert time.monotonic() - start < latency * 2
+    assert [(n.node.node_id, n.score) for n in results] == [(n.node.node_id, n.score) for n in expected]
+
+
+def test_metrics_handler(tmp_path):
+    handler = MetricsHandler(jsonl_file=str(tmp_path / "metrics.jsonl"))
+    cb_manager = CallbackManager([handler])
+    llm = CachedLLM(FakeLLM(latency=0, callback_manager=cb_manager), str(tmp_path), enable_cache=True,
+                    callback_manager=cb_manager)
+    with cb_manager.event(CBEventType.QUERY, payload={EventPayload.QUERY_STR: "问题"}):
+        with cb_manager.event(CBEventType.SYNTHESIZE):
+            llm.complete("北京")
+            llm.complete("北京")
+    # 第二次命中缓存，llm调用计在所在的 synthesize 阶段
+    stats = handler.llm["synthesize"]
+    assert (stats.calls, stats.cache_hits) == (1, 1) and stats.prompt_tokens > 0
+    with open(tmp_path / "metrics.jsonl", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) == 1 and records[0]["query"] == "问题"
+    assert records[0]["llm"]["synthesize"]["calls"] == 1
+    text = handler.to_prometheus()
+    assert 'rag_llm_cache_hits_total{stage="synthesize"} 1' in text
+    assert 'rag_stage_duration_seconds_count{stage="llm"} 1' in text
+
+
+def test_llm_cache_budget(tmp_path):
+    store = SqliteCacheStore(str(tmp_path / "llm_cache.sqlite3"), batch_size=1)
+    llm = CachedLLM(CountingLLM(), str(tmp_path), enable_cache=True, cache_store=store)
+    prompts = [f"问题{i}" * 50 for i in range(6)]
+    for prompt in prompts:
+        llm.complete(prompt)
+    llm.complete(prompts[0])
+    assert store.stats.snapshot()["by_method"]["complete"] == {"hits": 1, "misses": 6, "puts": 6}
+    usage = store.usage()
+    assert usage["entries"] == 6 and usage["by_method"]["complete"]["hits"] == 1
+    # lfu 先淘汰没有命中过的，淘汰到预算的90%以下
+    assert store.prune(CacheBudget(max_bytes=usage["bytes"] // 2, policy="lfu")) == 4
+    assert llm.complete(prompts[0]).text == prompts[0] and len(llm.llm.prompts) == 6
+    assert store.prune(CacheBudget(max_age=0)) == 2
+
+
+def test_cache_request_key():
+    params = {"model": "gpt-3.5-turbo", "temperature": 0.1}
+    req = CacheRequest("complete", ("问题",), {"a": 1, "b": 2}, params)
+    assert req.key == CacheRequest("complete", ("问题",), {"b": 2, "a": 1, "callback_manager": CallbackManager([])},
+                                   dict(reversed(params.items()))).key
+    assert req.dump() is req.dump()
+    assert req.key != CacheRequest("complete", ("问题",), {"a": 1, "b": 2}, {**params, "temperature": 0.7}).key
+    assert req.key != CacheRequest("complete", ("问题",), {"a": 1, "b": 2}, {**params, "model": "gpt-4"}).key
+
+
+def test_llm_cache_version(tmp_path):
+    # 旧版本的缓存: 一个请求一个的pickle文件、根目录下的sqlite文件和旧版本号的子目录，key的格式不同，不会再命中
+    FileCacheStore(str(tmp_path)).put("a" * 32, CacheItem(b"req", "resp", "complete"))
+    SqliteCacheStore(str(tmp_path / "llm_cache.sqlite3"), batch_size=1).put("b" * 32, CacheItem(b"req", "resp"))
+    (tmp_path / "v1").mkdir()
+    (tmp_path / "fake").mkdir()
+    (tmp_path / "embeddings.sqlite3").write_bytes(b"embedding")
+    llm = CachedLLM(MockLLM(), str(tmp_path), enable_cache=True)
+    assert llm.complete("北京气候如何").text == "北京气候如何"
+    llm.cache_store.flush()
+    assert os.path.exists(os.path.join(versioned_dir(str(tmp_path)), "llm_cache.sqlite3"))
+    assert drop_legacy(str(tmp_path)) > 0 and legacy_paths(str(tmp_path)) == []
+    current = os.path.basename(versioned_dir(str(tmp_path)))
+    assert sorted(os.listdir(tmp_path)) == ["embeddings.sqlite3", "fake", current]
+
+
+def test_cache_store_corruption(tmp_path):
+    store = FileCacheStore(str(tmp_path / "files"))
+    store.put("a" * 32, CacheItem(b"req", "resp", "complete"))
+    assert store.get("a" * 32).response == "resp"
+    # 写了一半的文件删除后当作未命中，写入不会留下临时文件
+    (tmp_path / "files" / ("b" * 32)).write_bytes(pickle.dumps(CacheItem(b"req", "resp"))[:10])
+    assert store.get("b" * 32) is None
+    assert sorted(os.listdir(tmp_path / "files")) == [".lock", "a" * 32]
+
+    db_path = str(tmp_path / "llm_cache.sqlite3")
+    store = SqliteCacheStore(db_path, batch_size=1)
+    store.put("c" * 32, CacheItem(b"req", "resp", "complete"))
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("UPDATE llm_cache SET response = ?", (b"broken",))
+    assert store.get("c" * 32) is None
+    assert store.stats.snapshot()["corrupted"] == 1 and store.usage()["entries"] == 0
+
+
+def test_cache_store_busy_writer(tmp_path, monkeypatch):
+    monkeypatch.setattr(common.cache, "LLM_CACHE_LOCK_TIMEOUT", 1.0)
+    db_path = str(tmp_path / "llm_cache.sqlite3")
+    store = SqliteCacheStore(db_path, batch_size=100)
+    store.put("a" * 32, CacheItem(b"req", "resp", "complete"))
+    # 其他进程持有写锁，提交要等到超时，期间读缓存不受影响
+    blocker = sqlite3.connect(db_path)
+    blocker.execute("BEGIN IMMEDIATE")
+    flusher = threading.Thread(target=store.flush)
+    flusher.start()
+    time.sleep(0.2)
+    start = time.monotonic()
+    assert store.get("a" * 32).response == "resp" and store.get("b" * 32) is None
+    assert time.monotonic() - start < 0.5
+    flusher.join()
+    blocker.rollback()
+    blocker.close()
+    # 提交失败的这一批保留在内存里，下次提交
+    assert store.usage()["entries"] == 1
+
+    # 文件缓存写入时也按预算淘汰
+    budget = CacheBudget(max_bytes=1)
+    store = FileCacheStore(str(tmp_path / "files"), budget=budget, prune_interval=2)
+    for key in ("a", "b", "c"):
+        store.put(key * 32, CacheItem(b"req", "resp", "complete"))
+    assert store.usage()["entries"] == 1 and store.stats.snapshot()["evicted"] == 2